@@ -1,9 +1,12 @@
 
+from collections import deque
 from django.db.models import Q
 from zerver.models import UserProfile, Realm
-from zerver.lib.cache import cache_with_key, realm_alert_words_cache_key
+from zerver.lib.cache import cache_get, cache_set, cache_with_key, \
+    realm_alert_words_cache_key, realm_alert_word_automaton_generation_cache_key
+from zerver.lib.utils import generate_random_token
 import ujson
-from typing import Dict, Iterable, List, Text
+from typing import Dict, Iterable, List, Set, Text, Tuple
 
 @cache_with_key(realm_alert_words_cache_key, timeout=3600*24)
 def alert_words_in_realm(realm):
@@ -14,6 +17,126 @@ def alert_words_in_realm(realm):
     user_ids_with_words = dict((user_id, w) for (user_id, w) in all_user_words.items() if len(w))
     return user_ids_with_words
 
+# An alert word only matches when surrounded by whitespace, the
+# start/end of the message, or one of these punctuation characters.
+ALERT_WORD_ALLOWED_BEFORE = frozenset(u'(".,\';[*`>')
+ALERT_WORD_ALLOWED_AFTER = frozenset(u')"?:.,\';]!*`')
+
+class AlertWordAutomaton(object):
+    """An Aho-Corasick automaton for all the alert words in a realm,
+    which finds every alert word in a message in a single pass over
+    its content, plus an index from (lowercased) words to the users
+    who have them as alert words."""
+
+    def __init__(self, realm_alert_words):
+        # type: (Dict[int, List[Text]]) -> None
+        self.user_ids_by_word = {}  # type: Dict[Text, Set[int]]
+        for user_id, words in realm_alert_words.items():
+            for word in words:
+                if word:
+                    self.user_ids_by_word.setdefault(word.lower(), set()).add(user_id)
+
+        # The trie of words: node 0 is the root, and goto[node] maps
+        # characters to child nodes.  outputs maps nodes to the words
+        # ending there, including via failure links.
+        self.goto = [{}]  # type: List[Dict[Text, int]]
+        self.fail = [0]  # type: List[int]
+        self.outputs = {}  # type: Dict[int, List[Text]]
+        for word in self.user_ids_by_word:
+            node = 0
+            for char in word:
+                child = self.goto[node].get(char)
+                if child is None:
+                    child = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.goto[node][char] = child
+                node = child
+            self.outputs.setdefault(node, []).append(word)
+
+        # Compute failure links in breadth-first order, so that a
+        # node's failure target is always complete before the node.
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                if self.fail[child] in self.outputs:
+                    self.outputs.setdefault(child, []).extend(self.outputs[self.fail[child]])
+
+    def find_words(self, content):
+        # type: (Text) -> Set[Text]
+        """Returns the alert words in `content`, which must already be
+        lowercased."""
+        found = set()  # type: Set[Text]
+        if not self.outputs:
+            return found
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        node = 0
+        for (i, char) in enumerate(content):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if node not in outputs:
+                continue
+            for word in outputs[node]:
+                if word in found:
+                    continue
+                start = i - len(word) + 1
+                if start > 0:
+                    before = content[start - 1]
+                    if not (before.isspace() or before in ALERT_WORD_ALLOWED_BEFORE):
+                        continue
+                if i + 1 < len(content):
+                    after = content[i + 1]
+                    if not (after.isspace() or after in ALERT_WORD_ALLOWED_AFTER):
+                        continue
+                found.add(word)
+        return found
+
+    def user_ids_for_words(self, words):
+        # type: (Iterable[Text]) -> Set[int]
+        user_ids = set()  # type: Set[int]
+        for word in words:
+            user_ids |= self.user_ids_by_word.get(word, set())
+        return user_ids
+
+# The automaton for a large realm is too big to keep in memcached (and
+# to unpickle on every message), so each process keeps its own, with
+# the realm's "generation" (a random token in memcached) it was built
+# for; changing anyone's alert words deletes the generation.  See
+# zerver/lib/realm_name_index.py for the same scheme.
+#
+# realm_id -> (generation, automaton)
+realm_alert_word_automatons = {}  # type: Dict[int, Tuple[str, AlertWordAutomaton]]
+
+def alert_word_automaton_for_realm(realm):
+    # type: (Realm) -> AlertWordAutomaton
+    key = realm_alert_word_automaton_generation_cache_key(realm)
+    cached = cache_get(key)
+    if cached is not None and realm.id in realm_alert_word_automatons:
+        (generation, automaton) = realm_alert_word_automatons[realm.id]
+        if generation == cached[0]:
+            return automaton
+
+    if cached is None:
+        # We set the new generation before reading the alert words,
+        # so a change that races with the read invalidates our
+        # automaton.
+        generation = generate_random_token(32)
+        cache_set(key, generation, timeout=3600*24*7)
+    else:
+        generation = cached[0]
+    automaton = AlertWordAutomaton(alert_words_in_realm(realm))
+    realm_alert_word_automatons[realm.id] = (generation, automaton)
+    return automaton
+
 def user_alert_words(user_profile):
     # type: (UserProfile) -> List[Text]
     return ujson.loads(user_profile.alert_words)
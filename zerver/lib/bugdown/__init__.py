@@ -1,8 +1,7 @@
 import subprocess
 # Zulip's main markdown implementation.  See docs/markdown.md for
 # detailed documentation on our markdown syntax.
-from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Text, Tuple, TypeVar, Union
-from mypy_extensions import TypedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Text, Tuple, TypeVar, Union, cast
 from typing.re import Match
 
 import markdown
@@ -16,7 +15,7 @@ import html
 import twitter
 import platform
 import time
-import functools
+import hashlib
 import httplib2
 import itertools
 import ujson
@@ -24,26 +23,29 @@ from six.moves import urllib
 import xml.etree.cElementTree as etree
 from xml.etree.cElementTree import Element, SubElement
 
-from collections import defaultdict, deque
-
-import requests
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core import mail
 from django.conf import settings
-from django.db.models import Q
+from django.db import connection
 
 from markdown.extensions import codehilite
 from zerver.lib.bugdown import fenced_code
 from zerver.lib.bugdown.fenced_code import FENCE_RE
+from zerver.lib.bugdown_pool import get_bugdown_worker_pool
 from zerver.lib.camo import get_camo_url
 from zerver.lib.mention import possible_mentions
+from zerver.lib.realm_name_index import FullNameInfo, get_realm_name_index
 from zerver.lib.timeout import timeout, TimeoutExpired
 from zerver.lib.cache import (
-    cache_with_key, cache_get_many, cache_set_many, NotFoundInCache)
+    cache_with_key, cache_get, cache_get_many, cache_set, cache_set_many, get_cache_with_key,
+    NotFoundInCache)
+import zerver.lib.cache
 from zerver.lib.url_preview import preview as link_preview
+from zerver.lib.url_preview.parsers import HeadMetadataParser
+from zerver.lib.utils import statsd
 from zerver.models import (
-    all_realm_filters,
-    get_active_streams,
     get_system_bot,
     Message,
     Realm,
@@ -57,12 +59,6 @@ from zerver.lib.str_utils import force_str, force_text
 from zerver.lib.tex import render_tex
 from six.moves import html_parser
 
-FullNameInfo = TypedDict('FullNameInfo', {
-    'id': int,
-    'email': Text,
-    'full_name': Text,
-})
-
 # Format version of the bugdown rendering; stored along with rendered
 # messages so that we can efficiently determine what needs to be re-rendered
 version = 1
@@ -212,7 +208,11 @@ def add_embed(root, link, extracted_data):
         description_elm.text = description
 
 
-@cache_with_key(lambda tweet_id: tweet_id, cache_name="database", with_statsd_key="tweet_data")
+def tweet_data_cache_key(tweet_id):
+    # type: (Text) -> Text
+    return tweet_id
+
+@cache_with_key(tweet_data_cache_key, cache_name="database", with_statsd_key="tweet_data")
 def fetch_tweet_data(tweet_id):
     # type: (Text) -> Optional[Dict[Text, Any]]
     if settings.TEST_SUITE:
@@ -268,76 +268,113 @@ def fetch_tweet_data(tweet_id):
                 return None
     return res
 
-HEAD_START_RE = re.compile(u'^head[ >]')
-HEAD_END_RE = re.compile(u'^/head[ >]')
-META_START_RE = re.compile(u'^meta[ >]')
-META_END_RE = re.compile(u'^/meta[ >]')
+@get_cache_with_key(tweet_data_cache_key, cache_name="database")
+def tweet_data_from_cache(tweet_id):
+    # type: (Text) -> Optional[Dict[Text, Any]]
+    return None
+
+def open_graph_image_cache_key(url):
+    # type: (Text) -> Text
+    return u'open_graph_image:%s' % (hashlib.sha1(url.encode('utf-8')).hexdigest(),)
 
+@cache_with_key(open_graph_image_cache_key, cache_name="database", with_statsd_key="open_graph_image")
 def fetch_open_graph_image(url):
     # type: (Text) -> Optional[Dict[str, Any]]
-    in_head = False
-    # HTML will auto close meta tags, when we start the next tag add a closing tag if it has not been closed yet.
-    last_closed = True
-    head = []
-
-    # TODO: What if response content is huge? Should we get headers first?
+    # We only read the page's <head>, where the Open Graph tags are.
+    # Connection errors propagate, so that we don't cache them
+    # forever; fetch_link_preview_data caches them for a while.
+    parser = HeadMetadataParser()
+    chunks = link_preview.iter_url_text(url, timeout=1)
     try:
-        content = requests.get(url, timeout=1).text
-    except Exception:
+        link_preview.read_head(parser, chunks)
+    finally:
+        chunks.close()
+
+    og = parser.open_graph
+    if 'image' not in og:
         return None
+    return {'image': og['image'], 'title': og.get('title'), 'desc': og.get('description')}
+
+@get_cache_with_key(open_graph_image_cache_key, cache_name="database")
+def open_graph_image_from_cache(url):
+    # type: (Text) -> Optional[Dict[str, Any]]
+    return None
 
-    # Extract the head and meta tags
-    # All meta tags are self closing, have no children or are closed
-    # automatically.
-    for part in content.split('<'):
-        if not in_head and HEAD_START_RE.match(part):
-            # Started the head node output it to have a document root
-            in_head = True
-            head.append('<head>')
-        elif in_head and HEAD_END_RE.match(part):
-            # Found the end of the head close any remaining tag then stop
-            # processing
-            in_head = False
-            if not last_closed:
-                last_closed = True
-                head.append('</meta>')
-            head.append('</head>')
-            break
-
-        elif in_head and META_START_RE.match(part):
-            # Found a meta node copy it
-            if not last_closed:
-                head.append('</meta>')
-                last_closed = True
-            head.append('<')
-            head.append(part)
-            if '/>' not in part:
-                last_closed = False
-
-        elif in_head and META_END_RE.match(part):
-            # End of a meta node just copy it to close the tag
-            head.append('<')
-            head.append(part)
-            last_closed = True
+def is_dropbox_share_url(url):
+    # type: (Text) -> bool
+    parsed_url = urllib.parse.urlparse(url)
+    if not (parsed_url.netloc == 'dropbox.com' or parsed_url.netloc.endswith('.dropbox.com')):
+        return False
+    return any(parsed_url.path.startswith(prefix) for prefix in ['/s/', '/sh/', '/sc/', '/photos/'])
+
+# How long we remember that we couldn't fetch a link's preview, so
+# that e.g. editing the message doesn't fetch it again.
+LINK_PREVIEW_FAILURE_CACHE_SECS = 60 * 60
 
+def link_preview_failure_cache_key(url):
+    # type: (Text) -> Text
+    return u'link_preview_failure:%s' % (hashlib.sha1(url.encode('utf-8')).hexdigest(),)
+
+def check_failed_preview(url, data):
+    # type: (Text, Any) -> Any
+    """Returns data, the cached preview data for url.  If there's none
+    because we recently failed to fetch it, we note that in
+    current_message, so that we don't cache the rendered content
+    without the preview for longer than that; see do_convert_many."""
+    if (data is None and current_message is not None and
+            cache_get(link_preview_failure_cache_key(url)) is not None):
+        current_message.links_with_failed_previews.add(url)
+    return data
+
+def get_link_preview_fetcher(url):
+    # type: (Text) -> Tuple[Callable[[Text], Any], Text, Text]
+    """Returns (fetch, arg, cache_key): fetch(arg) fetches, and caches
+    under cache_key, the data for previewing url."""
+    tweet_id = get_tweet_id(url)
+    if tweet_id is not None:
+        return (fetch_tweet_data, tweet_id, tweet_data_cache_key(tweet_id))
+    if is_dropbox_share_url(url):
+        return (fetch_open_graph_image, url, open_graph_image_cache_key(url))
+    return (link_preview.get_link_embed_data, url, link_preview.cache_key_func(url))
+
+def fetch_link_preview_data(url):
+    # type: (Text) -> None
+    """Fetches, and caches, the data for previewing a link that
+    InlineInterestingLinkProcessor added to links_for_preview; see
+    the embed_links queue worker."""
+    (fetch, arg, key) = get_link_preview_fetcher(url)
     try:
-        doc = etree.fromstring(''.join(head))
-    except etree.ParseError:
-        return None
-    og_image = doc.find('meta[@property="og:image"]')
-    og_title = doc.find('meta[@property="og:title"]')
-    og_desc = doc.find('meta[@property="og:description"]')
-    title = None
-    desc = None
-    if og_image is not None:
-        image = og_image.get('content')
-    else:
-        return None
-    if og_title is not None:
-        title = og_title.get('content')
-    if og_desc is not None:
-        desc = og_desc.get('content')
-    return {'image': image, 'title': title, 'desc': desc}
+        with link_preview.domain_fetch_slot(url):
+            fetch(arg)
+    except Exception:
+        # E.g. Twitter rate-limiting us; we'll go without the preview.
+        logging.warning('Could not fetch preview data for %s: %s' % (url, traceback.format_exc()))
+        cache_set(key, None, cache_name="database", timeout=LINK_PREVIEW_FAILURE_CACHE_SECS)
+        cache_set(link_preview_failure_cache_key(url), True, timeout=LINK_PREVIEW_FAILURE_CACHE_SECS)
+
+def fetch_link_preview_data_in_thread(url):
+    # type: (Text) -> None
+    try:
+        fetch_link_preview_data(url)
+    finally:
+        # The database cache opens a connection in each thread.
+        connection.close()
+
+def fetch_link_preview_data_many(urls, threads=None):
+    # type: (Iterable[Text], Optional[int]) -> None
+    """Fetches the preview data for urls (each only once) concurrently,
+    in settings.EMBED_LINKS_FETCH_THREADS threads."""
+    urls = sorted(set(urls))
+    if threads is None:
+        threads = settings.EMBED_LINKS_FETCH_THREADS
+    if len(urls) <= 1 or threads <= 1:
+        for url in urls:
+            fetch_link_preview_data(url)
+        return
+    with ThreadPoolExecutor(max_workers=min(threads, len(urls))) as executor:
+        # fetch_link_preview_data catches its exceptions, so list()
+        # just waits for them all.
+        list(executor.map(fetch_link_preview_data_in_thread, urls))
 
 def get_tweet_id(url):
     # type: (Text) -> Optional[Text]
@@ -402,6 +439,21 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
                 return True
         return False
 
+    def fetch_or_defer(self, url, fetch, from_cache, *args):
+        # type: (Text, Callable[..., Any], Callable[..., Any], *Any) -> Any
+        """Returns fetch(*args), the data for previewing url from a remote
+        server.  When we're rendering a message, we don't wait for the
+        remote server: we use the data only if it's already cached, and
+        otherwise add url to links_for_preview, so that the embed_links
+        queue worker fetches it and re-renders the message."""
+        if current_message is None:
+            return fetch(*args)
+        try:
+            return check_failed_preview(url, from_cache(*args))
+        except NotFoundInCache:
+            current_message.links_for_preview.add(url)
+            return None
+
     def dropbox_image(self, url):
         # type: (Text) -> Optional[Dict]
         # TODO: specify details of returned Dict
@@ -409,9 +461,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
         if (parsed_url.netloc == 'dropbox.com' or parsed_url.netloc.endswith('.dropbox.com')):
             is_album = parsed_url.path.startswith('/sc/') or parsed_url.path.startswith('/photos/')
             # Only allow preview Dropbox shared links
-            if not (parsed_url.path.startswith('/s/') or
-                    parsed_url.path.startswith('/sh/') or
-                    is_album):
+            if not is_dropbox_share_url(url):
                 return None
 
             # Try to retrieve open graph protocol info for a preview
@@ -419,7 +469,17 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             # However, we might want to make use of title and description
             # in the future. If the actual image is too big, we might also
             # want to use the open graph image.
-            image_info = fetch_open_graph_image(url)
+            try:
+                image_info = self.fetch_or_defer(url, fetch_open_graph_image,
+                                                 open_graph_image_from_cache, url)
+            except Exception:
+                # We only fetch here when rendering something other
+                # than a message.
+                logging.warning(traceback.format_exc())
+                image_info = None
+            if image_info is not None:
+                # Don't modify the cached value.
+                image_info = dict(image_info)
 
             is_image = is_album or self.is_image(url)
 
@@ -584,7 +644,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             return None
 
         try:
-            res = fetch_tweet_data(tweet_id)
+            res = self.fetch_or_defer(url, fetch_tweet_data, tweet_data_from_cache, tweet_id)
             if res is None:
                 return None
             user = res['user']  # type: Dict[Text, Any]
@@ -709,7 +769,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             if current_message is None or not url_embed_preview_enabled_for_realm(current_message):
                 continue
             try:
-                extracted_data = link_preview.link_embed_data_from_cache(url)
+                extracted_data = check_failed_preview(url, link_preview.link_embed_data_from_cache(url))
             except NotFoundInCache:
                 current_message.links_for_preview.add(url)
                 continue
@@ -1118,20 +1178,109 @@ def prepare_realm_pattern(source):
     characters directly after, and saves what was matched as "name". """
     return r"""(?<![^\s'"\(,:<])(?P<name>""" + source + ')(?!\w)'
 
-# Given a regular expression pattern, linkifies groups that match it
-# using the provided format string to construct the URL.
+# Matches the named groups, and references to them, in a realm filter.
+REALM_FILTER_GROUP_RE = re.compile(r'(?<!\\)(\(\?P[<=])(\w+)')
+
+# Python's re module (before Python 3.5) can't compile a regex with
+# more than 100 groups, and markdown adds two groups around each inline
+# pattern, so each combined regex gets at most this many.
+MAX_REALM_FILTER_GROUPS = 90
+
+class RealmFilterRegex(object):
+    """Some of a realm's filters, combined into a single regex.  Each
+    filter is an alternative, in order, with its named groups prefixed
+    to keep them apart; where two filters match at the same place,
+    the first wins."""
+
+    def __init__(self, indexed_filters):
+        # type: (List[Tuple[int, Text, Text]]) -> None
+        # (name of the filter's group, format string, {prefixed name: name})
+        self.alternatives = []  # type: List[Tuple[str, Text, Dict[str, str]]]
+        sources = []  # type: List[Text]
+        for (i, source, format_string) in indexed_filters:
+            prefix = 'f%d_' % (i,)
+            group_names = {
+                prefix + name: name
+                for (start, name) in REALM_FILTER_GROUP_RE.findall(source)
+                if start == '(?P<'
+            }
+            renamed = REALM_FILTER_GROUP_RE.sub(lambda m: m.group(1) + prefix + m.group(2), source)
+            sources.append(u'(?P<f%d>%s)' % (i, renamed))
+            self.alternatives.append(('f%d' % (i,), format_string, group_names))
+        self.pattern = prepare_realm_pattern(u'|'.join(sources))
+        self.regex = re.compile(self.pattern)
+
+    def url_for_match(self, m):
+        # type: (Match[Text]) -> Text
+        for (group, format_string, group_names) in self.alternatives:
+            if m.group(group) is not None:
+                values = {name: m.group(prefixed) for (prefixed, name) in group_names.items()}
+                values['name'] = m.group('name')
+                return format_string % values
+        raise AssertionError('No realm filter matched')
+
+    def find_urls(self, text):
+        # type: (Text) -> List[Text]
+        return [self.url_for_match(m) for m in self.regex.finditer(text)]
+
+class RealmFilterMatcher(object):
+    """All of a realm's filters, combined into as few regexes as the
+    group limit allows, so that we scan a message or topic once per
+    regex rather than once per filter."""
+
+    def __init__(self, realm_filters):
+        # type: (List[Tuple[Text, Text, int]]) -> None
+        self.realm_filters = realm_filters
+        self.regexes = []  # type: List[RealmFilterRegex]
+        indexed_filters = []  # type: List[Tuple[int, Text, Text]]
+        num_groups = 1  # The "name" group
+        for (i, (source, format_string, filter_id)) in enumerate(realm_filters):
+            # The filter's own groups, plus the one we wrap it in.
+            filter_groups = re.compile(source).groups + 1
+            if indexed_filters and num_groups + filter_groups > MAX_REALM_FILTER_GROUPS:
+                self.regexes.append(RealmFilterRegex(indexed_filters))
+                indexed_filters = []
+                num_groups = 1
+            indexed_filters.append((i, source, format_string))
+            num_groups += filter_groups
+        if indexed_filters:
+            self.regexes.append(RealmFilterRegex(indexed_filters))
+
+    def find_urls(self, text):
+        # type: (Text) -> List[Text]
+        urls = []  # type: List[Text]
+        for regex in self.regexes:
+            urls += regex.find_urls(text)
+        return urls
+
+# realm_filters_key -> RealmFilterMatcher
+realm_filter_matchers = {}  # type: Dict[int, RealmFilterMatcher]
+
+def get_realm_filter_matcher(realm_filters_key, realm_filters=None):
+    # type: (int, Optional[List[Tuple[Text, Text, int]]]) -> RealmFilterMatcher
+    """Returns the cached matcher for the realm's filters, rebuilding it
+    only when they've changed (see flush_realm_filter)."""
+    if realm_filters is None:
+        realm_filters = realm_filters_for_realm(realm_filters_key)
+    matcher = realm_filter_matchers.get(realm_filters_key)
+    if matcher is None or matcher.realm_filters != realm_filters:
+        matcher = RealmFilterMatcher(realm_filters)
+        realm_filter_matchers[realm_filters_key] = matcher
+    return matcher
+
+# Given a RealmFilterRegex, linkifies text that matches any of its
+# filters, using that filter's format string to construct the URL.
 class RealmFilterPattern(markdown.inlinepatterns.Pattern):
-    """ Applied a given realm filter to the input """
+    """ Applies some of a realm's filters to the input """
 
-    def __init__(self, source_pattern, format_string, markdown_instance=None):
-        # type: (Text, Text, Optional[markdown.Markdown]) -> None
-        self.pattern = prepare_realm_pattern(source_pattern)
-        self.format_string = format_string
-        markdown.inlinepatterns.Pattern.__init__(self, self.pattern, markdown_instance)
+    def __init__(self, regex, markdown_instance=None):
+        # type: (RealmFilterRegex, Optional[markdown.Markdown]) -> None
+        self.realm_filter_regex = regex
+        markdown.inlinepatterns.Pattern.__init__(self, regex.pattern, markdown_instance)
 
     def handleMatch(self, m):
         # type: (Match[Text]) -> Union[Element, Text]
-        return url_to_a(self.format_string % m.groupdict(),
+        return url_to_a(self.realm_filter_regex.url_for_match(m),
                         m.group("name"))
 
 class UserMentionPattern(markdown.inlinepatterns.Pattern):
@@ -1209,28 +1358,15 @@ class AlertWordsNotificationProcessor(markdown.preprocessors.Preprocessor):
     def run(self, lines):
         # type: (Iterable[Text]) -> Iterable[Text]
         if current_message and db_data is not None:
-            # We check for alert words here, the set of which are
-            # dependent on which users may see this message.
-            #
-            # Our caller passes in the list of possible_words.  We
-            # don't do any special rendering; we just append the alert words
-            # we find to the set current_message.alert_words.
-
-            realm_words = db_data['possible_words']
-
-            content = '\n'.join(lines).lower()
-
-            allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
-            allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
-
-            for word in realm_words:
-                escaped = re.escape(word.lower())
-                match_re = re.compile(u'(?:%s)%s(?:%s)' %
-                                      (allowed_before_punctuation,
-                                       escaped,
-                                       allowed_after_punctuation))
-                if re.search(match_re, content):
-                    current_message.alert_words.add(word)
+            # We check for alert words here, using the realm's
+            # AlertWordAutomaton, which our caller passes in.  We
+            # don't do any special rendering; we just append the
+            # (lowercased) alert words we find to the set
+            # current_message.alert_words.
+            automaton = db_data['alert_word_automaton']
+            if automaton is not None:
+                content = '\n'.join(lines).lower()
+                current_message.alert_words.update(automaton.find_words(content))
 
         return lines
 
@@ -1321,9 +1457,14 @@ class Bugdown(markdown.Extension):
         md.inlinePatterns.add('unicodeemoji', UnicodeEmoji(unicode_emoji_regex), '_end')
         md.inlinePatterns.add('link', AtomicLinkPattern(markdown.inlinepatterns.LINK_RE, md), '>avatar')
 
-        for (pattern, format_string, id) in self.getConfig("realm_filters"):
-            md.inlinePatterns.add('realm_filters/%s' % (pattern,),
-                                  RealmFilterPattern(pattern, format_string), '>link')
+        realm_filters = self.getConfig("realm_filters")
+        if realm_filters:
+            matcher = get_realm_filter_matcher(self.getConfig("realm"), realm_filters)
+            location = '>link'
+            for (i, regex) in enumerate(matcher.regexes):
+                name = 'realm_filters' if i == 0 else 'realm_filters/%d' % (i,)
+                md.inlinePatterns.add(name, RealmFilterPattern(regex), location)
+                location = '>' + name
 
         # A link starts at a word boundary, and ends at space, punctuation, or end-of-input.
         #
@@ -1398,7 +1539,14 @@ class Bugdown(markdown.Extension):
                 if k not in ["paragraph"]:
                     del md.parser.blockprocessors[k]
 
-md_engines = {}  # type: Dict[int, markdown.Markdown]
+# The markdown engines we've built, keyed by realm_filters_key, least
+# recently used first.  Building an engine is slow, so we build each
+# the first time we render a message for its realm (realms without
+# realm filters share the DEFAULT_BUGDOWN_KEY engine), and only keep
+# the MAX_MD_ENGINES most recently used.
+MAX_MD_ENGINES = 100
+md_engines = OrderedDict()  # type: OrderedDict
+# The filters each engine in md_engines was built with.
 realm_filter_data = {}  # type: Dict[int, List[Tuple[Text, Text, int]]]
 
 class EscapeHtml(markdown.Extension):
@@ -1409,6 +1557,8 @@ class EscapeHtml(markdown.Extension):
 
 def make_md_engine(key, opts):
     # type: (int, Dict[str, Any]) -> None
+    start = time.time()
+    md_engines.pop(key, None)
     md_engines[key] = markdown.Markdown(
         output_format = 'html',
         extensions    = [
@@ -1422,24 +1572,19 @@ def make_md_engine(key, opts):
             EscapeHtml(),
             Bugdown(realm_filters=opts["realm_filters"][0],
                     realm=opts["realm"][0])])
+    statsd.timing("bugdown.engine_build_time", (time.time() - start) * 1000)
+
+    while len(md_engines) > MAX_MD_ENGINES:
+        (evicted_key, evicted_engine) = md_engines.popitem(last=False)
+        realm_filter_data.pop(evicted_key, None)
+    statsd.gauge("bugdown.engines", len(md_engines))
 
 def subject_links(realm_filters_key, subject):
     # type: (int, Text) -> List[Text]
-    matches = []  # type: List[Text]
-
-    realm_filters = realm_filters_for_realm(realm_filters_key)
-
-    for realm_filter in realm_filters:
-        pattern = prepare_realm_pattern(realm_filter[0])
-        for m in re.finditer(pattern, subject):
-            matches += [realm_filter[1] % m.groupdict()]
-    return matches
+    return get_realm_filter_matcher(realm_filters_key).find_urls(subject)
 
 def make_realm_filters(realm_filters_key, filters):
     # type: (int, List[Tuple[Text, Text, int]]) -> None
-    global md_engines, realm_filter_data
-    if realm_filters_key in md_engines:
-        del md_engines[realm_filters_key]
     realm_filter_data[realm_filters_key] = filters
 
     # Because of how the Markdown config API works, this has confusing
@@ -1450,20 +1595,14 @@ def make_realm_filters(realm_filters_key, filters):
                     "realm": [realm_filters_key, "Realm name"]})
 
 def maybe_update_realm_filters(realm_filters_key):
-    # type: (Optional[int]) -> None
-    # If realm_filters_key is None, load all filters
-    if realm_filters_key is None:
-        all_filters = all_realm_filters()
-        all_filters[DEFAULT_BUGDOWN_KEY] = []
-        for realm_filters_key, filters in all_filters.items():
-            make_realm_filters(realm_filters_key, filters)
-        # Hack to ensure that getConfig("realm") is right for mirrored Zephyrs
-        make_realm_filters(ZEPHYR_MIRROR_BUGDOWN_KEY, [])
+    # type: (int) -> None
+    if realm_filters_key in (DEFAULT_BUGDOWN_KEY, ZEPHYR_MIRROR_BUGDOWN_KEY):
+        realm_filters = []  # type: List[Tuple[Text, Text, int]]
     else:
         realm_filters = realm_filters_for_realm(realm_filters_key)
-        if realm_filters_key not in realm_filter_data or realm_filter_data[realm_filters_key] != realm_filters:
-            # Data has changed, re-load filters
-            make_realm_filters(realm_filters_key, realm_filters)
+    if realm_filters_key not in md_engines or realm_filter_data.get(realm_filters_key) != realm_filters:
+        # We haven't built this engine yet, or its filters have changed.
+        make_realm_filters(realm_filters_key, realm_filters)
 
 # We want to log Markdown parser failures, but shouldn't log the actual input
 # message for privacy reasons.  The compromise is to replace all alphanumeric
@@ -1495,86 +1634,203 @@ def log_bugdown_error(msg):
     logging.getLogger('').error(msg)
 
 def get_email_info(realm_id, emails):
-    # type: (int, Set[Text]) -> Dict[Text, FullNameInfo]
+    # type: (int, Set[Text]) -> Dict[Text, Dict[str, Any]]
     if not emails:
         return dict()
-
-    q_list = {
-        Q(email__iexact=email.strip().lower())
-        for email in emails
-    }
-
-    rows = UserProfile.objects.filter(
-        realm_id=realm_id
-    ).filter(
-        functools.reduce(lambda a, b: a | b, q_list),
-    ).values(
-        'id',
-        'email',
-    )
-
-    dct = {
-        row['email'].strip().lower(): row
-        for row in rows
-    }
-    return dct
+    return get_realm_name_index(realm_id).get_email_info(emails)
 
 def get_full_name_info(realm_id, full_names):
     # type: (int, Set[Text]) -> Dict[Text, FullNameInfo]
     if not full_names:
         return dict()
-
-    q_list = {
-        Q(full_name__iexact=full_name)
-        for full_name in full_names
-    }
-
-    rows = UserProfile.objects.filter(
-        realm_id=realm_id,
-        is_active=True,
-    ).filter(
-        functools.reduce(lambda a, b: a | b, q_list),
-    ).values(
-        'id',
-        'full_name',
-        'email',
-    )
-
-    dct = {
-        row['full_name'].lower(): row
-        for row in rows
-    }
-    return dct
+    return get_realm_name_index(realm_id).get_full_name_info(full_names)
 
 def get_stream_name_info(realm, stream_names):
-    # type: (Realm, Set[Text]) -> Dict[Text, FullNameInfo]
+    # type: (Realm, Set[Text]) -> Dict[Text, Dict[str, Any]]
     if not stream_names:
         return dict()
+    return get_realm_name_index(realm.id).get_stream_name_info(stream_names)
 
-    q_list = {
-        Q(name=name)
-        for name in stream_names
-    }
+def get_md_engine(realm_filters_key):
+    # type: (int) -> markdown.Markdown
+    if (realm_filters_key not in (DEFAULT_BUGDOWN_KEY, ZEPHYR_MIRROR_BUGDOWN_KEY) and
+            not realm_filters_for_realm(realm_filters_key)):
+        realm_filters_key = DEFAULT_BUGDOWN_KEY
+    maybe_update_realm_filters(realm_filters_key)
 
-    rows = get_active_streams(
-        realm=realm,
-    ).filter(
-        functools.reduce(lambda a, b: a | b, q_list),
-    ).values(
-        'id',
-        'name',
-    )
-
-    dct = {
-        row['name']: row
-        for row in rows
-    }
-    return dct
+    engine = md_engines.pop(realm_filters_key)
+    md_engines[realm_filters_key] = engine
+    return engine
+
+def render_with_engine(_md_engine, content, message, message_db_data):
+    # type: (markdown.Markdown, Text, Any, Optional[Dict[Text, Any]]) -> Text
+    global current_message
+    global db_data
+    # Reset the parser; otherwise it will get slower over time.
+    _md_engine.reset()
+    current_message = message
+    db_data = message_db_data
+    try:
+        return _md_engine.convert(content)
+    finally:
+        current_message = None
+        db_data = None
 
+class RenderedMessageMetadata(object):
+    """Stands in for the Message being rendered in a bugdown worker
+    process (see zerver.lib.bugdown_pool), collecting what the
+    processors find out about the message."""
+
+    def __init__(self, realm):
+        # type: (Realm) -> None
+        self.realm = realm
+        self.mentions_wildcard = False
+        self.mentions_user_ids = set()  # type: Set[int]
+        self.alert_words = set()  # type: Set[Text]
+        self.links_for_preview = set()  # type: Set[Text]
+        self.links_with_failed_previews = set()  # type: Set[Text]
+
+    def get_realm(self):
+        # type: () -> Realm
+        return self.realm
+
+    def to_dict(self):
+        # type: () -> Dict[str, Any]
+        return dict(mentions_wildcard=self.mentions_wildcard,
+                    mentions_user_ids=self.mentions_user_ids,
+                    alert_words=self.alert_words,
+                    links_for_preview=self.links_for_preview,
+                    links_with_failed_previews=self.links_with_failed_previews)
+
+# A job for a bugdown worker: (content, realm_filters_key, the realm
+# of the message if we're rendering one, db_data, the realm whose alert
+# words to look for).  A realm's AlertWordAutomaton can be large, so
+# rather than pickling it into every job, the worker looks it up
+# itself; alert_word_automaton_for_realm keeps it in the worker's
+# memory.
+RenderJob = Tuple[Text, int, Optional[Realm], Optional[Dict[Text, Any]], Optional[Realm]]
+
+def make_render_job(content, realm_filters_key, message, message_db_data, alert_words_realm=None):
+    # type: (Text, int, Optional[Message], Optional[Dict[Text, Any]], Optional[Realm]) -> RenderJob
+    message_realm = message.get_realm() if message is not None else None
+    if message_db_data is not None and message_db_data['alert_word_automaton'] is not None:
+        assert alert_words_realm is not None
+        message_db_data = dict(message_db_data, alert_word_automaton=None)
+    else:
+        alert_words_realm = None
+    return (content, realm_filters_key, message_realm, message_db_data, alert_words_realm)
+
+def render_job(job):
+    # type: (RenderJob) -> Tuple[Text, Optional[Dict[str, Any]]]
+    """Runs in a bugdown worker process; returns the rendered content
+    and, if it's for a message, RenderedMessageMetadata.to_dict()."""
+    (content, realm_filters_key, message_realm, message_db_data, alert_words_realm) = job
+    if alert_words_realm is not None:
+        assert message_db_data is not None
+        message_db_data['alert_word_automaton'] = alert_words.alert_word_automaton_for_realm(
+            alert_words_realm)
+    metadata = None  # type: Optional[RenderedMessageMetadata]
+    if message_realm is not None:
+        metadata = RenderedMessageMetadata(message_realm)
+    rendered_content = render_with_engine(get_md_engine(realm_filters_key), content,
+                                          metadata, message_db_data)
+    return (rendered_content, metadata.to_dict() if metadata is not None else None)
+
+def apply_render_result(result, message):
+    # type: (Any, Optional[Message]) -> Text
+    if isinstance(result, Exception):
+        raise result
+    (rendered_content, metadata) = result
+    if message is not None and metadata is not None:
+        for (key, value) in metadata.items():
+            setattr(message, key, value)
+    return rendered_content
+
+# Rendering the same content again, e.g. for a bot that sends the same
+# notification many times, gives the same result, unless it uses
+# syntax that depends on the realm's users and streams (mentions,
+# avatars, stream links) or alert words.  For other content, we cache
+# the rendered content in memcached, with a small LRU cache in front
+# of it, keyed by a hash of the content and everything else that
+# affects how it's rendered.
+RENDERED_CONTENT_LRU_SIZE = 1000
+rendered_content_lru = OrderedDict()  # type: OrderedDict
+
+def get_rendering_code_fingerprint():
+    # type: () -> Text
+    """A hash of the code that renders messages, so that cached renderings
+    don't outlive a deploy that changes it, even if we forget to bump
+    version."""
+    sha = hashlib.sha1()
+    lib_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    paths = (sorted(glob.glob(os.path.join(lib_dir, 'bugdown', '*.py'))) +
+             [os.path.join(lib_dir, name) for name in ['camo.py', 'mention.py', 'tex.py']])
+    for path in paths:
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    sha.update(markdown.version.encode('utf-8'))
+    return sha.hexdigest()
+
+rendering_code_fingerprint = get_rendering_code_fingerprint()
+
+def rendered_content_cache_key(content, message, message_realm, realm_filters_key,
+                               alert_word_automaton, sent_by_bot):
+    # type: (Text, Optional[Message], Optional[Realm], int, Optional[alert_words.AlertWordAutomaton], Optional[bool]) -> Optional[Text]
+    """Returns the cache key for rendering this content, or None if the
+    content uses syntax that we can't cache the rendering of."""
+    if (re.search(mention.find_mentions, content) is not None or
+            possible_avatar_emails(content) or
+            possible_linked_stream_names(content)):
+        return None
+    if alert_word_automaton is not None and alert_word_automaton.find_words(content.lower()):
+        return None
 
-def do_convert(content, message=None, message_realm=None, possible_words=None, sent_by_bot=False):
-    # type: (Text, Optional[Message], Optional[Realm], Optional[Set[Text]], Optional[bool]) -> Text
-    """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
+    if realm_filters_key in (DEFAULT_BUGDOWN_KEY, ZEPHYR_MIRROR_BUGDOWN_KEY):
+        realm_filters = []  # type: List[Tuple[Text, Text, int]]
+    else:
+        realm_filters = realm_filters_for_realm(realm_filters_key)
+    realm_emoji = None  # type: Optional[Dict[Text, Any]]
+    if message is not None and message_realm is not None and content_has_emoji_syntax(content):
+        realm_emoji = message_realm.get_emoji()
+    preview_realm = message.get_realm() if message is not None else None
+    preview_settings = [settings.INLINE_IMAGE_PREVIEW, settings.INLINE_URL_EMBED_PREVIEW]
+    if preview_realm is not None:
+        preview_settings += [preview_realm.inline_image_preview, preview_realm.inline_url_embed_preview]
+
+    # The settings that affect how we render anything.
+    rendering_settings = [settings.ENABLE_FILE_LINKS, settings.CAMO_URI]
+
+    key_data = [version, rendering_code_fingerprint, rendering_settings, realm_filters_key,
+                realm_filters, realm_emoji, preview_settings, message is not None,
+                bool(sent_by_bot), content]
+    digest = hashlib.sha1(ujson.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+    return u'rendered_content:%s' % (digest,)
+
+def get_cached_rendered_content(key):
+    # type: (Text) -> Optional[Text]
+    # The remote cache key prefix changes between tests, so we include
+    # it in the local cache's key.
+    local_key = zerver.lib.cache.KEY_PREFIX + key
+    rendered_content = rendered_content_lru.pop(local_key, None)
+    if rendered_content is None:
+        remote_value = cache_get(key)
+        if remote_value is None:
+            return None
+        rendered_content = remote_value[0]
+    rendered_content_lru[local_key] = rendered_content
+    return rendered_content
+
+def set_cached_rendered_content(key, rendered_content):
+    # type: (Text, Text) -> None
+    cache_set(key, rendered_content, timeout=3600*24*7)
+    rendered_content_lru[zerver.lib.cache.KEY_PREFIX + key] = rendered_content
+    while len(rendered_content_lru) > RENDERED_CONTENT_LRU_SIZE:
+        rendered_content_lru.popitem(last=False)
+
+def get_realm_filters_key(message, message_realm):
+    # type: (Optional[Message], Optional[Realm]) -> Tuple[int, Optional[Realm]]
+    """Returns the key of the md_engine to render with, and the realm to
+    render for."""
     # This logic is a bit convoluted, but the overall goal is to support a range of use cases:
     # * Nothing is passed in other than content -> just run default options (e.g. for docs)
     # * message is passed, but no realm is -> look up realm from message
@@ -1592,83 +1848,143 @@ def do_convert(content, message=None, message_realm=None, possible_words=None, s
         # Use slightly customized Markdown processor for content
         # delivered via zephyr_mirror
         realm_filters_key = ZEPHYR_MIRROR_BUGDOWN_KEY
-
-    maybe_update_realm_filters(realm_filters_key)
-
-    if realm_filters_key in md_engines:
-        _md_engine = md_engines[realm_filters_key]
+    return (realm_filters_key, message_realm)
+
+def get_message_db_data(content, message_realm, alert_word_automaton, sent_by_bot):
+    # type: (Text, Realm, Optional[alert_words.AlertWordAutomaton], Optional[bool]) -> Dict[Text, Any]
+    """Pre-fetches the data from the DB that bugdown needs to render a
+    message; we don't query the DB while rendering."""
+    # Here we fetch the data structures needed to render
+    # mentions/avatars/stream mentions from the database, but only
+    # if there is syntax in the message that might use them, since
+    # the fetches are somewhat expensive and these types of syntax
+    # are uncommon enough that it's a useful optimization.
+    full_names = possible_mentions(content)
+    full_name_info = get_full_name_info(message_realm.id, full_names)
+
+    emails = possible_avatar_emails(content)
+    email_info = get_email_info(message_realm.id, emails)
+
+    stream_names = possible_linked_stream_names(content)
+    stream_name_info = get_stream_name_info(message_realm, stream_names)
+
+    if content_has_emoji_syntax(content):
+        realm_emoji = message_realm.get_emoji()
     else:
-        if DEFAULT_BUGDOWN_KEY not in md_engines:
-            maybe_update_realm_filters(realm_filters_key=None)
-
-        _md_engine = md_engines[DEFAULT_BUGDOWN_KEY]
-    # Reset the parser; otherwise it will get slower over time.
-    _md_engine.reset()
+        realm_emoji = dict()
+
+    return {
+        'alert_word_automaton': alert_word_automaton,
+        'email_info': email_info,
+        'full_name_info': full_name_info,
+        'realm_emoji': realm_emoji,
+        'sent_by_bot': sent_by_bot,
+        'stream_names': stream_name_info,
+    }
 
-    global current_message
-    current_message = message
+# The arguments to do_convert: (content, message, message_realm,
+# alert_word_automaton, sent_by_bot).
+ConvertJob = Tuple[Text, Optional[Message], Optional[Realm],
+                   Optional[alert_words.AlertWordAutomaton], Optional[bool]]
 
+def do_convert(content, message=None, message_realm=None, alert_word_automaton=None, sent_by_bot=False):
+    # type: (Text, Optional[Message], Optional[Realm], Optional[alert_words.AlertWordAutomaton], Optional[bool]) -> Text
+    """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
+    return do_convert_many([(content, message, message_realm, alert_word_automaton, sent_by_bot)])[0]
+
+def do_convert_many(jobs):
+    # type: (List[ConvertJob]) -> List[Text]
+    """do_convert for each of jobs; with settings.BUGDOWN_WORKER_PROCESSES,
+    the ones we don't find in the cache are rendered in parallel."""
+    rendered = [None] * len(jobs)  # type: List[Optional[Text]]
+    to_render = []  # type: List[Tuple[int, Optional[Text], RenderContentJob]]
+    for (i, (content, message, message_realm, alert_word_automaton, sent_by_bot)) in enumerate(jobs):
+        (realm_filters_key, message_realm) = get_realm_filters_key(message, message_realm)
+
+        cache_key = rendered_content_cache_key(content, message, message_realm, realm_filters_key,
+                                               alert_word_automaton, sent_by_bot)
+        if cache_key is not None:
+            cached_rendered_content = get_cached_rendered_content(cache_key)
+            bugdown_stats_cache(hit=cached_rendered_content is not None)
+            if cached_rendered_content is not None:
+                rendered[i] = cached_rendered_content
+                continue
+        to_render.append((i, cache_key, (content, message, message_realm, realm_filters_key,
+                                         alert_word_automaton, sent_by_bot)))
+
+    if to_render:
+        results = render_contents([job for (i, cache_key, job) in to_render])
+        for ((i, cache_key, job), rendered_content) in zip(to_render, results):
+            message = job[1]
+            # A rendering that's waiting for link previews will be replaced
+            # once they're fetched, so we don't cache it; nor one that's
+            # missing previews we'll try fetching again soon.
+            if (cache_key is not None and not getattr(message, 'links_for_preview', None) and
+                    not getattr(message, 'links_with_failed_previews', None)):
+                set_cached_rendered_content(cache_key, rendered_content)
+            rendered[i] = rendered_content
+    return cast(List[Text], rendered)
+
+# (content, message, message_realm, realm_filters_key,
+# alert_word_automaton, sent_by_bot)
+RenderContentJob = Tuple[Text, Optional[Message], Optional[Realm], int,
+                         Optional[alert_words.AlertWordAutomaton], Optional[bool]]
+
+def render_contents(jobs):
+    # type: (List[RenderContentJob]) -> List[Text]
     # Pre-fetch data from the DB that is used in the bugdown thread
-    global db_data
-    if message is not None:
-        assert message_realm is not None  # ensured above if message is not None
-        if possible_words is None:
-            possible_words = set()  # Set[Text]
-
-        # Here we fetch the data structures needed to render
-        # mentions/avatars/stream mentions from the database, but only
-        # if there is syntax in the message that might use them, since
-        # the fetches are somewhat expensive and these types of syntax
-        # are uncommon enough that it's a useful optimization.
-        full_names = possible_mentions(content)
-        full_name_info = get_full_name_info(message_realm.id, full_names)
-
-        emails = possible_avatar_emails(content)
-        email_info = get_email_info(message_realm.id, emails)
-
-        stream_names = possible_linked_stream_names(content)
-        stream_name_info = get_stream_name_info(message_realm, stream_names)
-
-        if content_has_emoji_syntax(content):
-            realm_emoji = message_realm.get_emoji()
-        else:
-            realm_emoji = dict()
-
-        db_data = {
-            'possible_words': possible_words,
-            'email_info': email_info,
-            'full_name_info': full_name_info,
-            'realm_emoji': realm_emoji,
-            'sent_by_bot': sent_by_bot,
-            'stream_names': stream_name_info,
-        }
+    message_db_datas = []  # type: List[Optional[Dict[Text, Any]]]
+    for (content, message, message_realm, realm_filters_key, alert_word_automaton, sent_by_bot) in jobs:
+        message_db_data = None  # type: Optional[Dict[Text, Any]]
+        if message is not None:
+            assert message_realm is not None  # ensured above if message is not None
+            message_db_data = get_message_db_data(content, message_realm, alert_word_automaton, sent_by_bot)
+        message_db_datas.append(message_db_data)
+
+    pool = get_bugdown_worker_pool()
+    if pool is not None:
+        # The alert word automaton our caller passes in is the one
+        # for message_realm.
+        results = pool.render_many([
+            make_render_job(content, realm_filters_key, message, message_db_data, message_realm)
+            for ((content, message, message_realm, realm_filters_key, alert_word_automaton, sent_by_bot),
+                 message_db_data) in zip(jobs, message_db_datas)
+        ])  # type: List[Any]
+    else:
+        results = [None] * len(jobs)
 
-    try:
-        # Spend at most 5 seconds rendering.
-        # Sometimes Python-Markdown is really slow; see
-        # https://trac.zulip.net/ticket/345
-        return timeout(5, _md_engine.convert, content)
-    except Exception:
-        from zerver.lib.actions import internal_send_message
+    rendered = []  # type: List[Text]
+    for ((content, message, message_realm, realm_filters_key, alert_word_automaton, sent_by_bot),
+         message_db_data, result) in zip(jobs, message_db_datas, results):
+        try:
+            if pool is not None:
+                rendered.append(apply_render_result(result, message))
+                continue
 
-        cleaned = privacy_clean_markdown(content)
+            _md_engine = get_md_engine(realm_filters_key)
+            # Spend at most 5 seconds rendering.
+            # Sometimes Python-Markdown is really slow; see
+            # https://trac.zulip.net/ticket/345
+            rendered.append(timeout(5, render_with_engine, _md_engine, content, message, message_db_data))
+        except Exception:
+            cleaned = privacy_clean_markdown(content)
 
-        # Output error to log as well as sending a zulip and email
-        log_bugdown_error('Exception in Markdown parser: %sInput (sanitized) was: %s'
-                          % (traceback.format_exc(), cleaned))
-        subject = "Markdown parser failure on %s" % (platform.node(),)
-        mail.mail_admins(
-            subject, "Failed message: %s\n\n%s\n\n" % (cleaned, traceback.format_exc()),
-            fail_silently=False)
+            # Output error to log as well as sending a zulip and email
+            log_bugdown_error('Exception in Markdown parser: %sInput (sanitized) was: %s'
+                              % (traceback.format_exc(), cleaned))
+            subject = "Markdown parser failure on %s" % (platform.node(),)
+            mail.mail_admins(
+                subject, "Failed message: %s\n\n%s\n\n" % (cleaned, traceback.format_exc()),
+                fail_silently=False)
 
-        raise BugdownRenderingException()
-    finally:
-        current_message = None
-        db_data = None
+            raise BugdownRenderingException()
+    return rendered
 
 bugdown_time_start = 0.0
 bugdown_total_time = 0.0
 bugdown_total_requests = 0
+bugdown_cache_hits = 0
+bugdown_cache_misses = 0
 
 def get_bugdown_time():
     # type: () -> float
@@ -1678,6 +1994,14 @@ def get_bugdown_requests():
     # type: () -> int
     return bugdown_total_requests
 
+def get_bugdown_cache_hits():
+    # type: () -> int
+    return bugdown_cache_hits
+
+def get_bugdown_cache_misses():
+    # type: () -> int
+    return bugdown_cache_misses
+
 def bugdown_stats_start():
     # type: () -> None
     global bugdown_time_start
@@ -1691,9 +2015,25 @@ def bugdown_stats_finish():
     bugdown_total_requests += 1
     bugdown_total_time += (time.time() - bugdown_time_start)
 
-def convert(content, message=None, message_realm=None, possible_words=None, sent_by_bot=False):
-    # type: (Text, Optional[Message], Optional[Realm], Optional[Set[Text]], Optional[bool]) -> Text
+def bugdown_stats_cache(hit):
+    # type: (bool) -> None
+    global bugdown_cache_hits
+    global bugdown_cache_misses
+    if hit:
+        bugdown_cache_hits += 1
+    else:
+        bugdown_cache_misses += 1
+
+def convert(content, message=None, message_realm=None, alert_word_automaton=None, sent_by_bot=False):
+    # type: (Text, Optional[Message], Optional[Realm], Optional[alert_words.AlertWordAutomaton], Optional[bool]) -> Text
+    bugdown_stats_start()
+    ret = do_convert(content, message, message_realm, alert_word_automaton, sent_by_bot)
+    bugdown_stats_finish()
+    return ret
+
+def convert_many(jobs):
+    # type: (List[ConvertJob]) -> List[Text]
     bugdown_stats_start()
-    ret = do_convert(content, message, message_realm, possible_words, sent_by_bot)
+    ret = do_convert_many(jobs)
     bugdown_stats_finish()
     return ret
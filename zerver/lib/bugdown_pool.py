@@ -0,0 +1,173 @@
+# A pool of worker processes that render markdown for bugdown, enabled
+# with settings.BUGDOWN_WORKER_PROCESSES.  Compared to rendering in
+# the calling process, this lets us enforce the rendering timeout by
+# killing (and replacing) the worker, where zerver.lib.timeout can only
+# try to interrupt a thread; it also lets callers render many messages
+# in parallel with render_many, since each worker has its own copy of
+# bugdown's module-level state (md_engines, current_message, db_data).
+#
+# Workers are started with the 'spawn' method, so that they don't share
+# database or memcached connections with the process that started them.
+# This module is imported by the workers before Django is set up, so it
+# must not import anything from Django or Zulip at the top level.
+#
+# We only start a pool in our own Python processes (queue workers and
+# management commands, which send and re-render messages in bulk).
+# uwsgi's processes render in-process: there, sys.executable is the
+# uwsgi binary, which 'spawn' can't start workers with, and each of
+# uwsgi's processes would start its own pool.
+#
+# So the pool does not cover the most common case: messages sent
+# through the web app and the API are rendered in uwsgi, in-process,
+# with bugdown's module-level state and zerver.lib.timeout's
+# thread-based timeout, as before.  Covering them would mean running
+# the pool as a separate, supervisor-managed service that uwsgi's
+# processes send render jobs to; we don't do that yet.
+from collections import deque
+from multiprocessing.connection import wait
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import logging
+import multiprocessing
+import time
+import traceback
+
+from zerver.lib.timeout import TimeoutExpired
+
+# The timeout for rendering a single message, in seconds.
+BUGDOWN_TIMEOUT = 5
+
+class BugdownWorkerError(Exception):
+    """Raised for a job that failed in a worker; the message is the
+    worker's traceback."""
+
+def serve_jobs(conn, handler):
+    # type: (Any, Callable[[Any], Any]) -> None
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            # Our parent has gone away.
+            return
+        try:
+            result = handler(job)
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+        else:
+            conn.send((True, result))
+
+def bugdown_worker_main(conn):
+    # type: (Any) -> None
+    import django
+    django.setup()
+
+    from zerver.lib import bugdown
+    # Pre-warm the engine used for most content.
+    bugdown.get_md_engine(bugdown.DEFAULT_BUGDOWN_KEY)
+    serve_jobs(conn, bugdown.render_job)
+
+class BugdownWorker(object):
+    def __init__(self, target, args):
+        # type: (Callable[..., None], Sequence[Any]) -> None
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=target, args=(child_conn,) + tuple(args))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        # type: () -> None
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+class BugdownWorkerPool(object):
+    def __init__(self, size, target=bugdown_worker_main, args=()):
+        # type: (int, Callable[..., None], Sequence[Any]) -> None
+        self.target = target
+        self.args = args
+        self.workers = [BugdownWorker(target, args) for i in range(size)]
+
+    def replace_worker(self, worker):
+        # type: (BugdownWorker) -> BugdownWorker
+        worker.kill()
+        replacement = BugdownWorker(self.target, self.args)
+        self.workers[self.workers.index(worker)] = replacement
+        return replacement
+
+    def render_many(self, jobs, timeout=BUGDOWN_TIMEOUT):
+        # type: (Sequence[Any], float) -> List[Any]
+        """Runs the jobs on the pool's workers, in parallel, and returns
+        their results in order.  The result for a job that failed is
+        the exception (TimeoutExpired or BugdownWorkerError) to raise
+        for it, rather than raising, so that one bad message doesn't
+        lose the results for the others."""
+        results = [None] * len(jobs)  # type: List[Any]
+        pending = deque(enumerate(jobs))
+        idle = list(self.workers)
+        busy = {}  # type: Dict[BugdownWorker, Tuple[int, float]]
+
+        while pending or busy:
+            while pending and idle:
+                worker = idle.pop()
+                (index, job) = pending.popleft()
+                try:
+                    worker.conn.send(job)
+                except OSError:
+                    # The worker died while idle.
+                    worker = self.replace_worker(worker)
+                    worker.conn.send(job)
+                busy[worker] = (index, time.time() + timeout)
+
+            next_deadline = min(deadline for (index, deadline) in busy.values())
+            ready = wait([worker.conn for worker in busy],
+                         max(0.0, next_deadline - time.time()))
+            now = time.time()
+            for worker in list(busy):
+                (index, deadline) = busy[worker]
+                if worker.conn in ready:
+                    del busy[worker]
+                    try:
+                        (succeeded, result) = worker.conn.recv()
+                    except (EOFError, OSError):
+                        logging.error('Bugdown worker %s exited unexpectedly' % (worker.process.pid,))
+                        results[index] = BugdownWorkerError('Bugdown worker exited unexpectedly')
+                        worker = self.replace_worker(worker)
+                    else:
+                        results[index] = result if succeeded else BugdownWorkerError(result)
+                    idle.append(worker)
+                elif now >= deadline:
+                    del busy[worker]
+                    logging.warning('Killing bugdown worker %s after %ss' % (worker.process.pid, timeout))
+                    results[index] = TimeoutExpired()
+                    idle.append(self.replace_worker(worker))
+        return results
+
+    def close(self):
+        # type: () -> None
+        for worker in self.workers:
+            worker.kill()
+        self.workers = []
+
+worker_pool = None  # type: Optional[BugdownWorkerPool]
+
+def running_under_uwsgi():
+    # type: () -> bool
+    # uwsgi provides the uwsgi module to the applications it runs.
+    try:
+        import uwsgi  # noqa
+    except ImportError:
+        return False
+    return True
+
+def get_bugdown_worker_pool():
+    # type: () -> Optional[BugdownWorkerPool]
+    """This process's pool of settings.BUGDOWN_WORKER_PROCESSES workers,
+    or None if it should render messages itself."""
+    global worker_pool
+    if worker_pool is None:
+        from django.conf import settings
+        if not settings.BUGDOWN_WORKER_PROCESSES or running_under_uwsgi():
+            return None
+        worker_pool = BugdownWorkerPool(settings.BUGDOWN_WORKER_PROCESSES)
+    return worker_pool
@@ -333,6 +333,20 @@ def realm_user_dicts_cache_key(realm_id):
     # type: (int) -> Text
     return u"realm_user_dicts:%s" % (realm_id,)
 
+def realm_name_index_generation_cache_key(realm_id):
+    # type: (int) -> Text
+    # See zerver/lib/realm_name_index.py.
+    return u"realm_name_index_generation:%s" % (realm_id,)
+
+def recent_window_cache_key(user_profile_id):
+    # type: (int) -> Text
+    # See zerver/lib/recent_window.py.
+    return u"recent_window:%s" % (user_profile_id,)
+
+def recent_window_generation_cache_key(user_profile_id):
+    # type: (int) -> Text
+    return u"recent_window_generation:%s" % (user_profile_id,)
+
 def active_user_ids_cache_key(realm_id):
     # type: (int) -> Text
     return u"active_user_ids:%s" % (realm_id,)
@@ -401,6 +415,11 @@ def flush_user_profile(sender, **kwargs):
     if changed(['is_active']):
         cache_delete(active_user_ids_cache_key(user_profile.realm_id))
 
+    # This has to come after we flush realm_user_dicts, which the name
+    # index is built from.
+    if changed(['email', 'full_name', 'is_active']):
+        cache_delete(realm_name_index_generation_cache_key(user_profile.realm_id))
+
     if changed(['email', 'full_name', 'short_name', 'id', 'is_mirror_dummy']):
         delete_display_recipient_cache(user_profile)
 
@@ -413,6 +432,7 @@ def flush_user_profile(sender, **kwargs):
     # alert words
     if changed(['alert_words']):
         cache_delete(realm_alert_words_cache_key(user_profile.realm))
+        cache_delete(realm_alert_word_automaton_generation_cache_key(user_profile.realm))
 
 # Called by models.py to flush various caches whenever we save
 # a Realm object.  The main tricky thing here is that Realm info is
@@ -428,11 +448,19 @@ def flush_realm(sender, **kwargs):
         cache_delete(active_user_ids_cache_key(realm.id))
         cache_delete(bot_dicts_in_realm_cache_key(realm))
         cache_delete(realm_alert_words_cache_key(realm))
+        cache_delete(realm_alert_word_automaton_generation_cache_key(realm))
+        cache_delete(realm_name_index_generation_cache_key(realm.id))
 
 def realm_alert_words_cache_key(realm):
     # type: (Realm) -> Text
     return u"realm_alert_words:%s" % (realm.string_id,)
 
+def realm_alert_word_automaton_generation_cache_key(realm):
+    # type: (Realm) -> Text
+    # See alert_word_automaton_for_realm; flushed along with
+    # realm_alert_words.
+    return realm_alert_words_cache_key(realm) + u":automaton_generation"
+
 # Called by models.py to flush the stream cache whenever we save a stream
 # object.
 def flush_stream(sender, **kwargs):
@@ -442,6 +470,7 @@ def flush_stream(sender, **kwargs):
     items_for_remote_cache = {}
     items_for_remote_cache[get_stream_cache_key(stream.name, stream.realm_id)] = (stream,)
     cache_set_many(items_for_remote_cache)
+    cache_delete(realm_name_index_generation_cache_key(stream.realm_id))
 
     if kwargs.get('update_fields') is None or 'name' in kwargs['update_fields'] and \
        UserProfile.objects.filter(
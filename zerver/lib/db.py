@@ -34,6 +34,13 @@ class TimeTrackingCursor(cursor):
         # type: (NonBinaryStr, Iterable[Any]) -> TimeTrackingCursor
         return wrapper_execute(self, super(TimeTrackingCursor, self).executemany, query, vars)
 
+    def copy_expert(self, sql, file, size=8192):
+        # type: (NonBinaryStr, Any, int) -> None
+        def action(sql, file):
+            # type: (NonBinaryStr, Any) -> None
+            super(TimeTrackingCursor, self).copy_expert(sql, file, size)
+        wrapper_execute(self, action, sql, file)  # type: ignore # action returns None
+
 class TimeTrackingConnection(connection):
     """A psycopg2 connection class that uses TimeTrackingCursors."""
 
@@ -23,6 +23,7 @@ from zerver.models import UserProfile, Realm, Client, Huddle, Stream, \
     UserPresence, UserActivity, UserActivityInterval, \
     get_display_recipient, Attachment, get_system_bot
 from zerver.lib.parallel import run_parallel
+from zerver.lib.topic_history import rebuild_all_topic_history
 from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 # Custom mypy types follow:
@@ -1292,6 +1293,26 @@ def fix_bitfield_keys(data, table, field_name):
         item[field_name] = item[field_name + '_mask']
         del item[field_name + '_mask']
 
+def fix_is_private_flag(data):
+    # type: (TableData) -> None
+    """Exports from older servers may have the is_private bit set to
+    something else (it used to be is_me_message), or not set at all,
+    so we recompute it from the messages' recipients."""
+    message_recipient_ids = {
+        message['id']: message['recipient_id']
+        for message in data['zerver_message']
+    }
+    private_recipient_ids = set(Recipient.objects.filter(
+        id__in=set(message_recipient_ids.values()),
+        type__in=[Recipient.PERSONAL, Recipient.HUDDLE],
+    ).values_list('id', flat=True))
+    is_private = int(UserMessage.flags.is_private)
+    for item in data['zerver_usermessage']:
+        if message_recipient_ids[item['message_id']] in private_recipient_ids:
+            item['flags'] |= is_private
+        else:
+            item['flags'] &= ~is_private
+
 def fix_realm_authentication_bitfield(data, table, field_name):
     # type: (TableData, TableName, Field) -> None
     """Used to fixup the authentication_methods bitfield to be a string"""
@@ -1513,6 +1534,11 @@ def do_import_realm(import_dir):
     # Import zerver_message and zerver_usermessage
     import_message_data(import_dir)
 
+    rebuild_all_topic_history(list(Recipient.objects.filter(
+        type=Recipient.STREAM,
+        type_id__in=Stream.objects.filter(realm=realm).values('id'),
+    ).values_list('id', flat=True)))
+
     # Do attachments AFTER message data is loaded.
     # TODO: de-dup how we read these json files.
     fn = os.path.join(import_dir, "attachment.json")
@@ -1549,6 +1575,7 @@ def import_message_data(import_dir):
         convert_to_id_fields(data, 'zerver_usermessage', 'message')
         re_map_foreign_keys(data, 'zerver_usermessage', 'user_profile', related_table="user_profile")
         fix_bitfield_keys(data, 'zerver_usermessage', 'flags')
+        fix_is_private_flag(data)
         bulk_import_model(data, UserMessage, 'zerver_usermessage')
 
         dump_file_id += 1
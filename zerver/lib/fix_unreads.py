@@ -8,6 +8,7 @@ CursorObj = TypeVar('CursorObj', bound=cursor)
 
 from django.db import connection
 
+from zerver.lib.recent_window import flush_recent_windows
 from zerver.models import UserProfile
 
 '''
@@ -253,3 +254,4 @@ def fix(user_profile):
     with connection.cursor() as cursor:
         fix_unsubscribed(cursor, user_profile)
         fix_pre_pointer(cursor, user_profile)
+    flush_recent_windows([user_profile.id])
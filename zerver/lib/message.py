@@ -3,10 +3,12 @@ import datetime
 import ujson
 import zlib
 
+from django.db import connection
 from django.utils.translation import ugettext as _
 from django.utils.timezone import now as timezone_now
 from six import binary_type
 
+from zerver.lib.alert_words import AlertWordAutomaton
 from zerver.lib.avatar import get_avatar_field
 import zerver.lib.bugdown as bugdown
 from zerver.lib.cache import cache_with_key, to_dict_cache_key
@@ -35,8 +37,6 @@ from zerver.models import (
 from typing import Any, Dict, List, Optional, Set, Tuple, Text, Union
 from mypy_extensions import TypedDict
 
-RealmAlertWords = Dict[int, List[Text]]
-
 UnreadMessagesResult = TypedDict('UnreadMessagesResult', {
     'pms': List[Dict[str, Any]],
     'streams': List[Dict[str, Any]],
@@ -96,6 +96,68 @@ def message_to_dict_json(message, apply_markdown):
     # type: (Message, bool) -> binary_type
     return MessageDict.to_dict_uncached(message, apply_markdown)
 
+# The columns of RAW_DB_ROWS_QUERY, named like the .values() fields
+# that build_dict_from_raw_db_row expects.
+RAW_DB_ROWS_FIELDS = [
+    'id',
+    'subject',
+    'pub_date',
+    'last_edit_time',
+    'edit_history',
+    'content',
+    'rendered_content',
+    'rendered_content_version',
+    'recipient_id',
+    'recipient__type',
+    'recipient__type_id',
+    'sender_id',
+    'sending_client__name',
+    'sender__realm_id',
+    'reactions',
+]
+
+# The reaction fields match Reaction.get_raw_db_rows; json_agg
+# gives NULL for messages without reactions.
+RAW_DB_ROWS_QUERY = '''
+    SELECT
+        zerver_message.id,
+        zerver_message.subject,
+        zerver_message.pub_date,
+        zerver_message.last_edit_time,
+        zerver_message.edit_history,
+        zerver_message.content,
+        zerver_message.rendered_content,
+        zerver_message.rendered_content_version,
+        zerver_message.recipient_id,
+        zerver_recipient.type,
+        zerver_recipient.type_id,
+        zerver_message.sender_id,
+        zerver_client.name,
+        sender.realm_id,
+        COALESCE(reactions.reactions, '[]')
+    FROM zerver_message
+    JOIN zerver_recipient ON zerver_recipient.id = zerver_message.recipient_id
+    JOIN zerver_client ON zerver_client.id = zerver_message.sending_client_id
+    JOIN zerver_userprofile sender ON sender.id = zerver_message.sender_id
+    LEFT OUTER JOIN LATERAL (
+        SELECT json_agg(reaction ORDER BY reaction.id) AS reactions
+        FROM (
+            SELECT
+                zerver_reaction.id,
+                zerver_reaction.emoji_name,
+                zerver_reaction.emoji_code,
+                zerver_reaction.reaction_type,
+                zerver_userprofile.email AS user_profile__email,
+                zerver_userprofile.id AS user_profile__id,
+                zerver_userprofile.full_name AS user_profile__full_name
+            FROM zerver_reaction
+            JOIN zerver_userprofile ON zerver_userprofile.id = zerver_reaction.user_profile_id
+            WHERE zerver_reaction.message_id = zerver_message.id
+        ) reaction
+    ) reactions ON true
+    WHERE zerver_message.id = ANY(%s)
+'''
+
 class MessageDict(object):
     @staticmethod
     def post_process_dicts(objs, client_gravatar):
@@ -148,31 +210,19 @@ class MessageDict(object):
     def get_raw_db_rows(needed_ids):
         # type: (List[int]) -> List[Dict[str, Any]]
         # This is a special purpose function optimized for
-        # callers like get_messages_backend().
-        fields = [
-            'id',
-            'subject',
-            'pub_date',
-            'last_edit_time',
-            'edit_history',
-            'content',
-            'rendered_content',
-            'rendered_content_version',
-            'recipient_id',
-            'recipient__type',
-            'recipient__type_id',
-            'sender_id',
-            'sending_client__name',
-            'sender__realm_id',
-        ]
-        messages = Message.objects.filter(id__in=needed_ids).values(*fields)
-        """Adding one-many or Many-Many relationship in values results in N X
-        results.
-
-        Link: https://docs.djangoproject.com/en/1.8/ref/models/querysets/#values
-        """
-        reactions = Reaction.get_raw_db_rows(needed_ids)
-        return sew_messages_and_reactions(messages, reactions)
+        # callers like get_messages_backend().  It fetches the
+        # messages and their reactions in a single query, aggregating
+        # each message's reactions into a JSON array, rather than
+        # querying Reaction separately and stitching the results
+        # together with sew_messages_and_reactions.
+        if not needed_ids:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(RAW_DB_ROWS_QUERY, [list(needed_ids)])
+            return [
+                dict(zip(RAW_DB_ROWS_FIELDS, row))
+                for row in cursor.fetchall()
+            ]
 
     @staticmethod
     def build_dict_from_raw_db_row(row, apply_markdown):
@@ -445,56 +495,61 @@ def access_message(user_profile, message_id):
     # stream in your realm, so return the message, user_message pair
     return (message, user_message)
 
-def render_markdown(message, content, realm=None, realm_alert_words=None, user_ids=None):
-    # type: (Message, Text, Optional[Realm], Optional[RealmAlertWords], Optional[Set[int]]) -> Text
+def render_markdown(message, content, realm=None, realm_alert_word_automaton=None, user_ids=None):
+    # type: (Message, Text, Optional[Realm], Optional[AlertWordAutomaton], Optional[Set[int]]) -> Text
     """Return HTML for given markdown. Bugdown may add properties to the
     message object such as `mentions_user_ids` and `mentions_wildcard`.
     These are only on this Django object and are not saved in the
     database.
     """
-
-    if user_ids is None:
-        message_user_ids = set()  # type: Set[int]
-    else:
-        message_user_ids = user_ids
-
-    if message is not None:
-        message.mentions_wildcard = False
-        message.mentions_user_ids = set()
-        message.alert_words = set()
-        message.links_for_preview = set()
-
-        if realm is None:
-            realm = message.get_realm()
-
-    possible_words = set()  # type: Set[Text]
-    if realm_alert_words is not None:
-        for user_id, words in realm_alert_words.items():
-            if user_id in message_user_ids:
-                possible_words.update(set(words))
-
-    if message is None:
-        # If we don't have a message, then we are in the compose preview
-        # codepath, so we know we are dealing with a human.
-        sent_by_bot = False
-    else:
-        sent_by_bot = get_user_profile_by_id(message.sender_id).is_bot
+    return render_markdown_many([(message, content, realm, realm_alert_word_automaton, user_ids)])[0]
+
+# The arguments to render_markdown: (message, content, realm,
+# realm_alert_word_automaton, user_ids).
+RenderMarkdownJob = Tuple[Message, Text, Optional[Realm], Optional[AlertWordAutomaton], Optional[Set[int]]]
+
+def render_markdown_many(jobs):
+    # type: (List[RenderMarkdownJob]) -> List[Text]
+    """render_markdown for each of jobs; with a bugdown worker pool,
+    the messages are rendered in parallel."""
+    convert_jobs = []  # type: List[bugdown.ConvertJob]
+    for (message, content, realm, realm_alert_word_automaton, user_ids) in jobs:
+        if message is not None:
+            message.mentions_wildcard = False
+            message.mentions_user_ids = set()
+            message.alert_words = set()
+            message.links_for_preview = set()
+            message.links_with_failed_previews = set()
+
+            if realm is None:
+                realm = message.get_realm()
+
+        if message is None:
+            # If we don't have a message, then we are in the compose preview
+            # codepath, so we know we are dealing with a human.
+            sent_by_bot = False
+        else:
+            sent_by_bot = get_user_profile_by_id(message.sender_id).is_bot
+        convert_jobs.append((content, message, realm, realm_alert_word_automaton, sent_by_bot))
 
     # DO MAIN WORK HERE -- call bugdown to convert
-    rendered_content = bugdown.convert(content, message=message, message_realm=realm,
-                                       possible_words=possible_words,
-                                       sent_by_bot=sent_by_bot)
+    rendered = bugdown.convert_many(convert_jobs)
+
+    for (message, content, realm, realm_alert_word_automaton, user_ids) in jobs:
+        if message is not None:
+            if user_ids is None:
+                message_user_ids = set()  # type: Set[int]
+            else:
+                message_user_ids = user_ids
 
-    if message is not None:
-        message.user_ids_with_alert_words = set()
+            message.user_ids_with_alert_words = set()
 
-        if realm_alert_words is not None:
-            for user_id, words in realm_alert_words.items():
-                if user_id in message_user_ids:
-                    if set(words).intersection(message.alert_words):
-                        message.user_ids_with_alert_words.add(user_id)
+            if realm_alert_word_automaton is not None:
+                message.user_ids_with_alert_words = (
+                    realm_alert_word_automaton.user_ids_for_words(message.alert_words) &
+                    message_user_ids)
 
-    return rendered_content
+    return rendered
 
 def huddle_users(recipient_id):
     # type: (int) -> str
@@ -1,7 +1,7 @@
 from zerver.lib.request import JsonableError
 from django.utils.translation import ugettext as _
 
-from typing import Any, Callable, Iterable, Mapping, Sequence, Text
+from typing import Any, Callable, Iterable, List, Mapping, Optional, Sequence, Text
 
 
 def check_supported_events_narrow_filter(narrow):
@@ -11,44 +11,70 @@ def check_supported_events_narrow_filter(narrow):
         if operator not in ["stream", "topic", "sender", "is"]:
             raise JsonableError(_("Operator %s not supported.") % (operator,))
 
+NarrowTermPredicate = Callable[[Mapping[str, Any], Any], bool]
+
+def matches_lowercased(value, operand, lowered_operand):
+    # type: (Text, Text, Text) -> bool
+    # Most events match the operand exactly, if at all; we only pay
+    # for lowercasing the message's field when they don't.
+    return value == operand or value.lower() == lowered_operand
+
+def compile_narrow_term(operator, operand):
+    # type: (Text, Text) -> Optional[NarrowTermPredicate]
+    """Returns a predicate taking (message, flags), or None for terms
+    that don't restrict which events are accepted."""
+    lowered_operand = operand.lower()
+    if operator == "stream":
+        return lambda message, flags: (
+            message["type"] == "stream" and
+            matches_lowercased(message["display_recipient"], operand, lowered_operand))
+    elif operator == "topic":
+        return lambda message, flags: (
+            message["type"] == "stream" and
+            matches_lowercased(message["subject"], operand, lowered_operand))
+    elif operator == "sender":
+        return lambda message, flags: matches_lowercased(
+            message["sender_email"], operand, lowered_operand)
+    elif operator == "is" and operand == "private":
+        return lambda message, flags: message["type"] == "private"
+    elif operator == "is" and operand in ["starred"]:
+        return lambda message, flags: operand in flags
+    elif operator == "is" and operand == "unread":
+        return lambda message, flags: "read" not in flags
+    elif operator == "is" and operand in ["alerted", "mentioned"]:
+        return lambda message, flags: "mentioned" in flags
+    return None
+
 def build_narrow_filter(narrow):
     # type: (Iterable[Sequence[Text]]) -> Callable[[Mapping[str, Any]], bool]
     """Changes to this function should come with corresponding changes to
     BuildNarrowFilterTest."""
     check_supported_events_narrow_filter(narrow)
 
+    # The narrow is compiled once, when the event queue is created, so
+    # that filtering an event doesn't need to interpret the narrow.
+    predicates = []  # type: List[NarrowTermPredicate]
+    for element in narrow:
+        predicate = compile_narrow_term(element[0], element[1])
+        if predicate is not None:
+            predicates.append(predicate)
+
     def narrow_filter(event):
         # type: (Mapping[str, Any]) -> bool
         message = event["message"]
         flags = event["flags"]
-        for element in narrow:
-            operator = element[0]
-            operand = element[1]
-            if operator == "stream":
-                if message["type"] != "stream":
-                    return False
-                if operand.lower() != message["display_recipient"].lower():
-                    return False
-            elif operator == "topic":
-                if message["type"] != "stream":
-                    return False
-                if operand.lower() != message["subject"].lower():
-                    return False
-            elif operator == "sender":
-                if operand.lower() != message["sender_email"].lower():
-                    return False
-            elif operator == "is" and operand == "private":
-                if message["type"] != "private":
-                    return False
-            elif operator == "is" and operand in ["starred"]:
-                if operand not in flags:
-                    return False
-            elif operator == "is" and operand == "unread":
-                if "read" in flags:
-                    return False
-            elif operator == "is" and operand in ["alerted", "mentioned"]:
-                if "mentioned" not in flags:
-                    return False
-
+        for predicate in predicates:
+            if not predicate(message, flags):
+                return False
         return True
     return narrow_filter
+
+def narrow_stream_name(narrow):
+    # type: (Iterable[Sequence[Text]]) -> Optional[Text]
+    """Returns the (lowercased) stream that all messages matching the
+    narrow must be sent to, if any; Tornado uses this to index event
+    queues with narrows by stream."""
+    for element in narrow:
+        if element[0] == "stream":
+            return element[1].lower()
+    return None
@@ -141,14 +141,14 @@ class SimpleQueueClient(object):
             callback(ujson.loads(body))
         self.register_consumer(queue_name, wrapped_callback)
 
-    def drain_queue(self, queue_name, json=False):
-        # type: (str, bool) -> List[Dict[str, Any]]
-        "Returns all messages in the desired queue"
+    def drain_queue(self, queue_name, json=False, max_messages=None):
+        # type: (str, bool, Optional[int]) -> List[Dict[str, Any]]
+        "Returns all messages in the desired queue, or the first max_messages"
         messages = []
 
         def opened():
             # type: () -> None
-            while True:
+            while max_messages is None or len(messages) < max_messages:
                 (meta, _, message) = self.channel.basic_get(queue_name)
 
                 if not message:
@@ -0,0 +1,112 @@
+from contextlib import contextmanager
+from mypy_extensions import TypedDict
+from typing import Any, Dict, Iterator, Optional, Set, Text, Tuple
+
+from zerver.lib.cache import cache_get, cache_set, realm_name_index_generation_cache_key
+from zerver.lib.utils import generate_random_token
+from zerver.models import Stream, get_realm_user_dicts
+
+# Bugdown needs to look up the users and streams named by the mentions,
+# avatars and stream links in a message.  Rather than querying the
+# database for each message, we keep an index of the names of each
+# realm's users and streams in memory.
+#
+# Other processes change users and streams, so each index records the
+# realm's "generation" (a random token in memcached) it was built for;
+# the user and stream flush signals in zerver/lib/cache.py delete the
+# generation, and we rebuild the index when it has changed.
+
+FullNameInfo = TypedDict('FullNameInfo', {
+    'id': int,
+    'email': Text,
+    'full_name': Text,
+})
+
+class RealmNameIndex(object):
+    def __init__(self, realm_id):
+        # type: (int) -> None
+        self.users_by_email = {}  # type: Dict[Text, Dict[str, Any]]
+        self.active_users_by_full_name = {}  # type: Dict[Text, FullNameInfo]
+        for row in sorted(get_realm_user_dicts(realm_id), key=lambda row: row['id']):
+            self.users_by_email.setdefault(row['email'].strip().lower(), dict(
+                id=row['id'],
+                email=row['email'],
+            ))
+            if row['is_active']:
+                self.active_users_by_full_name.setdefault(row['full_name'].lower(), FullNameInfo(
+                    id=row['id'],
+                    full_name=row['full_name'],
+                    email=row['email'],
+                ))
+
+        rows = Stream.objects.filter(realm_id=realm_id, deactivated=False).values('id', 'name')
+        self.streams_by_name = {
+            row['name']: row
+            for row in rows
+        }  # type: Dict[Text, Dict[str, Any]]
+
+    def get_email_info(self, emails):
+        # type: (Set[Text]) -> Dict[Text, Dict[str, Any]]
+        keys = {email.strip().lower() for email in emails}
+        return {key: self.users_by_email[key] for key in keys if key in self.users_by_email}
+
+    def get_full_name_info(self, full_names):
+        # type: (Set[Text]) -> Dict[Text, FullNameInfo]
+        keys = {full_name.lower() for full_name in full_names}
+        return {key: self.active_users_by_full_name[key] for key in keys
+                if key in self.active_users_by_full_name}
+
+    def get_stream_name_info(self, stream_names):
+        # type: (Set[Text]) -> Dict[Text, Dict[str, Any]]
+        return {name: self.streams_by_name[name] for name in stream_names
+                if name in self.streams_by_name}
+
+# realm_id -> (generation, index)
+realm_name_indexes = {}  # type: Dict[int, Tuple[str, RealmNameIndex]]
+
+# Inside a name_index_batch, the realms whose index we've already
+# checked is current.
+batch_checked_realm_ids = None  # type: Optional[Set[int]]
+
+def get_realm_name_index(realm_id):
+    # type: (int) -> RealmNameIndex
+    if batch_checked_realm_ids is not None and realm_id in batch_checked_realm_ids:
+        return realm_name_indexes[realm_id][1]
+
+    key = realm_name_index_generation_cache_key(realm_id)
+    cached = cache_get(key)
+    if cached is not None and realm_id in realm_name_indexes:
+        (generation, index) = realm_name_indexes[realm_id]
+        if generation == cached[0]:
+            if batch_checked_realm_ids is not None:
+                batch_checked_realm_ids.add(realm_id)
+            return index
+
+    if cached is None:
+        # We set the new generation before reading the realm's data,
+        # so a change that races with the read invalidates our index.
+        generation = generate_random_token(32)
+        cache_set(key, generation, timeout=3600*24*7)
+    else:
+        generation = cached[0]
+    index = RealmNameIndex(realm_id)
+    realm_name_indexes[realm_id] = (generation, index)
+    if batch_checked_realm_ids is not None:
+        batch_checked_realm_ids.add(realm_id)
+    return index
+
+@contextmanager
+def name_index_batch():
+    # type: () -> Iterator[None]
+    """Checks that each realm's index is current only once, rather than
+    on every lookup, for rendering a batch of messages together."""
+    global batch_checked_realm_ids
+    if batch_checked_realm_ids is not None:
+        # Nested batches share the outer one.
+        yield
+        return
+    batch_checked_realm_ids = set()
+    try:
+        yield
+    finally:
+        batch_checked_realm_ids = None
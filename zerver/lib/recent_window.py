@@ -0,0 +1,144 @@
+from typing import Callable, Iterable, List, Optional, Text, Tuple
+
+from django.conf import settings
+
+from zerver.lib.cache import cache_delete_many, cache_get_many, cache_set, \
+    recent_window_cache_key, recent_window_generation_cache_key
+from zerver.lib.utils import generate_random_token
+from zerver.models import UserMessage
+
+# The home view fetch that the webapp and mobile apps make on startup
+# (no narrow, with use_first_unread_anchor) is the most common request
+# to get_messages_backend.  To answer it without querying
+# zerver_usermessage, we cache each user's "recent window": the ids,
+# flags, recipients and topics of their last settings.RECENT_WINDOW_SIZE
+# messages.
+#
+# New messages don't invalidate a window: when we read it, we fetch
+# just the user's UserMessage rows after the end of the window (an
+# index range scan on (user_profile_id, message_id)) and append them.
+# Messages can commit slightly out of id order, so we re-read the last
+# RECENT_WINDOW_OVERLAP rows of the window along with the new ones.
+#
+# Everything else that changes a user's UserMessage rows (flags, topic
+# edits, deletions, and rows added for older messages) calls
+# flush_recent_windows once the change is saved.  That deletes the
+# user's window "generation" (a random token in memcached), and we only
+# use a window built for the current generation; see
+# zerver/lib/realm_name_index.py for the same scheme.
+
+# (message_id, flags, recipient_id, subject)
+WindowRow = Tuple[int, int, int, Text]
+
+RECENT_WINDOW_CACHE_TIMEOUT = 3600*24
+RECENT_WINDOW_OVERLAP = 20
+
+class RecentWindow(object):
+    def __init__(self, rows, complete):
+        # type: (List[WindowRow], bool) -> None
+        # rows are in increasing message id order; complete is True
+        # if they're all of the user's messages.
+        self.rows = rows
+        self.complete = complete
+
+    def covers(self, message_id):
+        # type: (int) -> bool
+        """Whether the window has all of the user's messages with ids
+        at least message_id."""
+        return self.complete or (len(self.rows) > 0 and self.rows[0][0] <= message_id)
+
+    def first_unread_message_id(self, pointer, is_muted):
+        # type: (int, Callable[[int, Text], bool]) -> Optional[int]
+        for (message_id, flags, recipient_id, subject) in self.rows:
+            if message_id < pointer or flags & UserMessage.flags.read.mask:
+                continue
+            if is_muted(recipient_id, subject):
+                continue
+            return message_id
+        return None
+
+    def get_rows(self, anchor, num_before, num_after):
+        # type: (int, int, int) -> Optional[List[Tuple[int, int]]]
+        """The (message_id, flags) rows for the last num_before messages
+        at or before anchor and the first num_after messages after it,
+        like get_messages_backend's query with no narrow; None if the
+        window doesn't have them all."""
+        before = [row for row in self.rows if row[0] <= anchor]
+        if len(before) < num_before and not self.complete:
+            return None
+        if num_after > 0 and not self.covers(anchor + 1):
+            return None
+        after = [row for row in self.rows if row[0] > anchor]
+        rows = (before[-num_before:] if num_before > 0 else []) + after[:num_after]
+        return [(message_id, flags) for (message_id, flags, recipient_id, subject) in rows]
+
+def fetch_recent_window(user_profile_id, size, min_message_id=0):
+    # type: (int, int, int) -> RecentWindow
+    """The user's last `size` messages with ids at least min_message_id;
+    complete if there were no more."""
+    rows = UserMessage.objects.filter(
+        user_profile_id=user_profile_id,
+        message_id__gte=min_message_id,
+    ).order_by('-message_id').values_list(
+        'message_id', 'flags', 'message__recipient_id', 'message__subject',
+    )[:size + 1]
+    rows = list(rows)
+    complete = len(rows) <= size
+    return RecentWindow(
+        rows=[(message_id, int(flags), recipient_id, subject)
+              for (message_id, flags, recipient_id, subject) in reversed(rows[:size])],
+        complete=complete,
+    )
+
+def extend_recent_window(user_profile_id, window, size):
+    # type: (int, RecentWindow, int) -> bool
+    """Adds the user's messages since the window was built; returns
+    whether the window changed."""
+    tail_start = max(len(window.rows) - RECENT_WINDOW_OVERLAP, 0)
+    min_message_id = window.rows[tail_start][0] if window.rows else 0
+    tail = fetch_recent_window(user_profile_id, size, min_message_id)
+    if not tail.complete:
+        # More than a window's worth of new messages.
+        rows = tail.rows
+        complete = False
+    else:
+        rows = window.rows[:tail_start] + tail.rows
+        complete = window.complete and len(rows) <= size
+        rows = rows[-size:]
+    if rows == window.rows and complete == window.complete:
+        return False
+    window.rows = rows
+    window.complete = complete
+    return True
+
+def get_recent_window(user_profile_id):
+    # type: (int) -> RecentWindow
+    generation_key = recent_window_generation_cache_key(user_profile_id)
+    window_key = recent_window_cache_key(user_profile_id)
+    cached = cache_get_many([generation_key, window_key])
+    if generation_key in cached and window_key in cached:
+        (generation, rows, complete) = cached[window_key][0]
+        if generation == cached[generation_key][0]:
+            window = RecentWindow(list(rows), complete)
+            if extend_recent_window(user_profile_id, window, settings.RECENT_WINDOW_SIZE):
+                cache_set(window_key, (generation, window.rows, window.complete),
+                          timeout=RECENT_WINDOW_CACHE_TIMEOUT)
+            return window
+
+    if generation_key in cached:
+        generation = cached[generation_key][0]
+    else:
+        # We set the new generation before reading the user's
+        # messages, so a change that races with the read invalidates
+        # the window we build.
+        generation = generate_random_token(32)
+        cache_set(generation_key, generation, timeout=RECENT_WINDOW_CACHE_TIMEOUT)
+    window = fetch_recent_window(user_profile_id, settings.RECENT_WINDOW_SIZE)
+    cache_set(window_key, (generation, window.rows, window.complete),
+              timeout=RECENT_WINDOW_CACHE_TIMEOUT)
+    return window
+
+def flush_recent_windows(user_profile_ids):
+    # type: (Iterable[int]) -> None
+    cache_delete_many(recent_window_generation_cache_key(user_profile_id)
+                      for user_profile_id in set(user_profile_ids))
@@ -0,0 +1,158 @@
+import logging
+import time
+
+from typing import Any, List, Optional, Set, Text, Tuple, TypeVar
+from psycopg2.extensions import cursor
+CursorObj = TypeVar('CursorObj', bound=cursor)
+
+from django.db import connection
+from django.db.models import Q
+
+from zerver.lib import bugdown
+from zerver.lib.bugdown_pool import BUGDOWN_TIMEOUT, BugdownWorkerPool
+from zerver.lib.cache import cache_delete_many, to_dict_cache_key_id
+from zerver.lib.queue import queue_json_publish
+from zerver.lib.timeout import timeout
+from zerver.models import Message, Realm
+
+# Re-rendering messages in bulk, for when a new bugdown version, or a
+# change to a realm's filters or emoji, leaves old messages with stale
+# rendered_content.  We walk the message table in batches by id, render
+# each batch on a BugdownWorkerPool, and write each batch back with a
+# single UPDATE, so that no transaction holds locks for long.  We don't
+# fetch link previews; so re-rendered messages only have the previews
+# that are already cached, unless we're asked to queue the rest for the
+# embed_links worker, like do_send_messages does.  That's opt-in, since
+# the worker re-renders each such message, and sends an update_message
+# event for it, again.  See the rerender_messages management command.
+
+logger = logging.getLogger('zulip.rerender')
+
+def get_message_batch(after_id, end_id, realm, rerender_all, batch_size):
+    # type: (int, Optional[int], Optional[Realm], bool, int) -> List[Message]
+    query = Message.objects.filter(id__gt=after_id)
+    if end_id is not None:
+        query = query.filter(id__lte=end_id)
+    if realm is not None:
+        query = query.filter(sender__realm=realm)
+    if not rerender_all:
+        query = query.filter(Q(rendered_content=None) |
+                             Q(rendered_content_version=None) |
+                             Q(rendered_content_version__lt=bugdown.version))
+    query = query.select_related('sender', 'sender__realm', 'sending_client').order_by('id')
+    return list(query[:batch_size])
+
+def render_job_in_process(job):
+    # type: (bugdown.RenderJob) -> Any
+    try:
+        return timeout(BUGDOWN_TIMEOUT, bugdown.render_job, job)
+    except Exception as e:
+        return e
+
+def render_message_batch(messages, pool):
+    # type: (List[Message], Optional[BugdownWorkerPool]) -> List[Optional[Tuple[Text, Set[Text]]]]
+    """Returns the new rendered_content for each message and the links
+    whose previews we still need to fetch, or None for messages we
+    couldn't render."""
+    jobs = []  # type: List[bugdown.RenderJob]
+    for message in messages:
+        (realm_filters_key, message_realm) = bugdown.get_realm_filters_key(message, None)
+        assert message_realm is not None
+        db_data = bugdown.get_message_db_data(message.content, message_realm, None,
+                                              message.sender.is_bot)
+        jobs.append(bugdown.make_render_job(message.content, realm_filters_key, message, db_data))
+
+    if pool is not None:
+        results = pool.render_many(jobs)
+    else:
+        results = [render_job_in_process(job) for job in jobs]
+
+    rendered = []  # type: List[Optional[Tuple[Text, Set[Text]]]]
+    for message, result in zip(messages, results):
+        if isinstance(result, Exception):
+            logger.warning('Could not render message %s: %r' % (message.id, result))
+            rendered.append(None)
+        else:
+            (rendered_content, metadata) = result
+            rendered.append((rendered_content, metadata['links_for_preview']))
+    return rendered
+
+def queue_link_previews(messages, rendered):
+    # type: (List[Message], List[Optional[Tuple[Text, Set[Text]]]]) -> None
+    for (message, result) in zip(messages, rendered):
+        if result is None or not result[1]:
+            continue
+        event_data = {
+            'message_id': message.id,
+            'message_content': message.content,
+            'message_realm_id': message.get_realm().id,
+            'urls': list(result[1])}
+        queue_json_publish('embed_links', event_data, lambda x: None)
+
+def update_rendered_content(cursor, rows):
+    # type: (CursorObj, List[Tuple[int, Text, Text]]) -> int
+    """Saves (message_id, content, rendered_content) rows.  We skip
+    messages whose content has changed since we read it, since they
+    were re-rendered when they were edited."""
+    query = '''
+        UPDATE zerver_message
+        SET
+            rendered_content = v.rendered_content,
+            rendered_content_version = %%s
+        FROM (VALUES %s) AS v(id, content, rendered_content)
+        WHERE
+            zerver_message.id = v.id AND
+            zerver_message.content = v.content
+    ''' % (', '.join(['(%s, %s, %s)'] * len(rows)),)
+    params = [bugdown.version]  # type: List[Any]
+    for row in rows:
+        params.extend(row)
+    cursor.execute(query, params)
+    return cursor.rowcount
+
+def rerender_messages(start_id=0, end_id=None, realm=None, rerender_all=False,
+                      batch_size=1000, processes=0, sleep_secs=0.0, queue_previews=False):
+    # type: (int, Optional[int], Optional[Realm], bool, int, int, float, bool) -> int
+    """Re-renders the messages with ids in (start_id, end_id] that have
+    stale rendered_content (or all of them, with rerender_all), using a
+    pool of `processes` bugdown workers, or rendering in this process
+    if that's 0.  With queue_previews, link previews that aren't cached
+    are queued for the embed_links worker.  Returns the last message id
+    processed; pass it as start_id to resume."""
+    pool = None  # type: Optional[BugdownWorkerPool]
+    if processes > 0:
+        pool = BugdownWorkerPool(processes)
+
+    last_id = start_id
+    try:
+        while True:
+            messages = get_message_batch(last_id, end_id, realm, rerender_all, batch_size)
+            if not messages:
+                break
+
+            rendered = render_message_batch(messages, pool)
+            rows = [
+                (message.id, message.content, result[0])
+                for (message, result) in zip(messages, rendered)
+                if result is not None
+            ]
+            updated = 0
+            if rows:
+                with connection.cursor() as cursor:
+                    updated = update_rendered_content(cursor, rows)
+                cache_delete_many(
+                    to_dict_cache_key_id(message_id, apply_markdown)
+                    for (message_id, content, rendered_content) in rows
+                    for apply_markdown in (True, False))
+                if queue_previews:
+                    queue_link_previews(messages, rendered)
+
+            last_id = messages[-1].id
+            logger.info('Re-rendered %s of %s messages, through message id %s' % (
+                updated, len(messages), last_id))
+            if sleep_secs:
+                time.sleep(sleep_secs)
+    finally:
+        if pool is not None:
+            pool.close()
+    return last_id
@@ -4,8 +4,9 @@ from datetime import timedelta
 from django.db import connection, transaction
 from django.forms.models import model_to_dict
 from django.utils.timezone import now as timezone_now
+from zerver.lib.topic_history import rebuild_topic_history
 from zerver.models import Realm, Message, UserMessage, ArchivedMessage, ArchivedUserMessage, \
-    Attachment, ArchivedAttachment
+    Attachment, ArchivedAttachment, Recipient
 
 from typing import Any, Dict, Optional, Generator
 
@@ -81,3 +82,7 @@ def move_message_to_archive(message_id):
                          message_id__isnull=True).delete()
     archived_attachments = ArchivedAttachment.objects.filter(messages__id=message_id)
     Attachment.objects.filter(messages__isnull=True, id__in=archived_attachments).delete()
+
+    recipient = Recipient.objects.get(id=arc_message.recipient_id)
+    if recipient.type == Recipient.STREAM:
+        rebuild_topic_history(recipient.id, [arc_message.subject])
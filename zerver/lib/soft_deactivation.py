@@ -7,6 +7,7 @@ from django.conf import settings
 from django.utils.timezone import now as timezone_now
 from typing import DefaultDict, List, Union, Any
 
+from zerver.lib.recent_window import flush_recent_windows
 from zerver.models import UserProfile, UserMessage, RealmAuditLog, \
     Subscription, Message, Recipient, UserActivity, Realm
 
@@ -155,6 +156,7 @@ def add_missing_messages(user_profile):
     # Doing a bulk create for all the UserMessage objects stored for creation.
     if len(user_messages_to_insert) > 0:
         UserMessage.objects.bulk_create(user_messages_to_insert)
+        flush_recent_windows([user_profile.id])
 
 def do_soft_deactivate_user(user_profile):
     # type: (UserProfile) -> None
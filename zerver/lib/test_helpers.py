@@ -296,12 +296,23 @@ class MockPythonResponse(object):
         # type: (Text, int) -> None
         self.text = text
         self.status_code = status_code
+        self.encoding = 'utf-8'
 
     @property
     def ok(self):
         # type: () -> bool
         return self.status_code == 200
 
+    def iter_content(self, chunk_size=1):
+        # type: (int) -> Iterator[bytes]
+        content = self.text.encode('utf-8')
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+
+    def close(self):
+        # type: () -> None
+        pass
+
 INSTRUMENTING = os.environ.get('TEST_INSTRUMENT_URL_COVERAGE', '') == 'TRUE'
 INSTRUMENTED_CALLS = []  # type: List[Dict[str, Any]]
 
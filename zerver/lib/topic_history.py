@@ -0,0 +1,162 @@
+from typing import Any, Dict, Iterable, List, Text, Tuple
+
+from django.db import connection, transaction, IntegrityError
+
+from zerver.models import Message, Recipient
+
+# Topic history used to be computed by grouping all of a stream's
+# messages by subject, which is slow on streams with millions of
+# messages.  Instead, zerver_streamtopic has a row per (stream
+# recipient, lowercased topic) with the latest message in the topic and
+# that message's spelling of the topic name, so a stream's topic
+# history is a scan of its topics.
+#
+# Sending a message updates its topic's row in the same transaction;
+# editing a topic or deleting a message recomputes the rows for the
+# affected topics from zerver_message (using upper_subject_idx).
+# Postgres 9.3 doesn't have INSERT ... ON CONFLICT, so we insert
+# missing rows inside a savepoint and retry if another process beat us
+# to it.
+#
+# Topic keys are always computed by Postgres' lower(), so that they
+# agree with the migration that backfilled the table.
+
+# A message with a later id may have been committed to the topic
+# first, so we keep the row's values if they're newer.
+UPSERT_TOPIC_QUERY = '''
+    WITH updated AS (
+        UPDATE zerver_streamtopic
+        SET topic_name = CASE WHEN max_message_id < %(message_id)s
+                              THEN %(topic_name)s ELSE topic_name END,
+            max_message_id = GREATEST(max_message_id, %(message_id)s)
+        WHERE recipient_id = %(recipient_id)s AND topic_key = lower(%(topic_name)s)
+        RETURNING id
+    )
+    INSERT INTO zerver_streamtopic (recipient_id, topic_key, topic_name, max_message_id)
+    SELECT %(recipient_id)s, lower(%(topic_name)s), %(topic_name)s, %(message_id)s
+    WHERE NOT EXISTS (SELECT 1 FROM updated)
+'''
+
+def update_topic_history(messages):
+    # type: (Iterable[Message]) -> None
+    """Record newly saved messages in their topics' rows.  This should
+    run in the transaction that saves the messages."""
+    latest = {}  # type: Dict[Tuple[int, Text], Tuple[int, Text]]
+    for message in messages:
+        if message.recipient.type != Recipient.STREAM:
+            continue
+        key = (message.recipient_id, message.topic_name().lower())
+        if key not in latest or latest[key][0] < message.id:
+            latest[key] = (message.id, message.topic_name())
+    if not latest:
+        return
+
+    while True:
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                # We lock the rows in a consistent order to avoid
+                # deadlocks between batches of messages to the same
+                # topics.
+                for ((recipient_id, topic_key), (message_id, topic_name)) in sorted(latest.items()):
+                    cursor.execute(UPSERT_TOPIC_QUERY, dict(
+                        recipient_id=recipient_id,
+                        topic_name=topic_name,
+                        message_id=message_id,
+                    ))
+            return
+        except IntegrityError:
+            # Another transaction created one of the topics first; now
+            # that it has committed, our UPDATE will find its row.
+            pass
+
+def insert_topic_row(cursor, recipient_id, topic_name, message_id):
+    # type: (Any, int, Text, int) -> bool
+    """Insert the row for a topic that doesn't have one; False if another
+    transaction inserted it first."""
+    try:
+        with transaction.atomic():
+            cursor.execute('''
+                INSERT INTO zerver_streamtopic (recipient_id, topic_key, topic_name, max_message_id)
+                VALUES (%s, lower(%s), %s, %s)
+            ''', [recipient_id, topic_name, topic_name, message_id])
+    except IntegrityError:
+        return False
+    return True
+
+def rebuild_topic_history(recipient_id, topic_names):
+    # type: (int, Iterable[Text]) -> None
+    """Recompute the rows for the given topics of a stream from its
+    messages, after messages were moved out of them or deleted."""
+    with connection.cursor() as cursor:
+        for topic_name in sorted(set(topic_names)):
+            # Each topic gets its own transaction, so that the row lock
+            # is held until we have written the row, even when we are
+            # not called inside a transaction.
+            with transaction.atomic():
+                while True:
+                    # Lock the existing row first, so that a message being
+                    # sent to the topic is either committed before we look
+                    # for the latest message, or updates the row after us.
+                    cursor.execute('''
+                        SELECT id FROM zerver_streamtopic
+                        WHERE recipient_id = %s AND topic_key = lower(%s)
+                        FOR UPDATE
+                    ''', [recipient_id, topic_name])
+                    exists = cursor.fetchone() is not None
+
+                    cursor.execute('''
+                        SELECT subject, id FROM zerver_message
+                        WHERE recipient_id = %s AND
+                              upper(subject) = upper(%s) AND lower(subject) = lower(%s)
+                        ORDER BY id DESC
+                        LIMIT 1
+                    ''', [recipient_id, topic_name, topic_name])
+                    row = cursor.fetchone()
+
+                    if row is None:
+                        cursor.execute('''
+                            DELETE FROM zerver_streamtopic
+                            WHERE recipient_id = %s AND topic_key = lower(%s)
+                        ''', [recipient_id, topic_name])
+                        break
+                    (latest_topic_name, message_id) = row
+                    if exists:
+                        cursor.execute('''
+                            UPDATE zerver_streamtopic
+                            SET topic_name = %s, max_message_id = %s
+                            WHERE recipient_id = %s AND topic_key = lower(%s)
+                        ''', [latest_topic_name, message_id, recipient_id, topic_name])
+                        break
+                    if insert_topic_row(cursor, recipient_id, latest_topic_name, message_id):
+                        break
+
+def rebuild_all_topic_history(recipient_ids):
+    # type: (List[int]) -> None
+    """Recompute all the rows for the given stream recipients, e.g. after
+    importing their messages."""
+    if not recipient_ids:
+        return
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('''
+            DELETE FROM zerver_streamtopic WHERE recipient_id = ANY(%s)
+        ''', [recipient_ids])
+        cursor.execute('''
+            INSERT INTO zerver_streamtopic (recipient_id, topic_key, topic_name, max_message_id)
+            SELECT DISTINCT ON (recipient_id, lower(subject))
+                recipient_id, lower(subject), subject, id
+            FROM zerver_message
+            WHERE recipient_id = ANY(%s)
+            ORDER BY recipient_id, lower(subject), id DESC
+        ''', [recipient_ids])
+
+def get_topic_history_from_index(recipient_id):
+    # type: (int) -> List[Dict[str, Any]]
+    with connection.cursor() as cursor:
+        cursor.execute('''
+            SELECT topic_name, max_message_id FROM zerver_streamtopic
+            WHERE recipient_id = %s
+            ORDER BY max_message_id DESC
+        ''', [recipient_id])
+        rows = cursor.fetchall()
+    return [dict(name=topic_name, max_id=max_message_id)
+            for (topic_name, max_message_id) in rows]
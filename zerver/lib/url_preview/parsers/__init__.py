@@ -1,4 +1,5 @@
 from zerver.lib.url_preview.parsers.open_graph import OpenGraphParser
 from zerver.lib.url_preview.parsers.generic import GenericParser
+from zerver.lib.url_preview.parsers.head import HeadMetadataParser
 
-__all__ = ['OpenGraphParser', 'GenericParser']
+__all__ = ['OpenGraphParser', 'GenericParser', 'HeadMetadataParser']
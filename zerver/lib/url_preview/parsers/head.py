@@ -0,0 +1,56 @@
+from typing import Dict, List, Optional, Text, Tuple
+from six.moves.html_parser import HTMLParser
+
+
+class HeadMetadataParser(HTMLParser):
+    """Collects the Open Graph properties, <title> and meta description
+    of a page fed to it in chunks.  Unlike OpenGraphParser and
+    GenericParser, it doesn't build a tree of the document, and `done`
+    is set at the end of the <head>, so that we can stop reading the
+    page there."""
+
+    def __init__(self):
+        # type: () -> None
+        HTMLParser.__init__(self)
+        self.open_graph = {}  # type: Dict[str, Text]
+        self.description = None  # type: Optional[Text]
+        self.title_parts = None  # type: Optional[List[Text]]
+        self.in_title = False
+        self.done = False
+
+    @property
+    def title(self):
+        # type: () -> Optional[Text]
+        if self.title_parts is None:
+            return None
+        return u''.join(self.title_parts)
+
+    def handle_starttag(self, tag, attrs):
+        # type: (str, List[Tuple[str, Optional[str]]]) -> None
+        if tag == 'meta':
+            attr_dict = dict(attrs)
+            prop = attr_dict.get('property')
+            content = attr_dict.get('content')
+            if content is None:
+                return
+            if prop is not None and 'og:' in prop:
+                self.open_graph[prop.replace('og:', '')] = content
+            elif attr_dict.get('name') == 'description' and self.description is None:
+                self.description = content
+        elif tag == 'title' and self.title_parts is None:
+            self.title_parts = []
+            self.in_title = True
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        # type: (str) -> None
+        if tag == 'title':
+            self.in_title = False
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        # type: (str) -> None
+        if self.in_title and self.title_parts is not None:
+            self.title_parts.append(data)
@@ -1,12 +1,16 @@
+import codecs
 import re
 import logging
+import threading
 import traceback
-from typing import Any, Optional, Text
+from contextlib import contextmanager
+from typing import Any, Dict, Generator, Iterator, Optional, Text, Tuple
 from typing.re import Match
 import requests
+from six.moves import urllib
 from zerver.lib.cache import cache_with_key, get_cache_with_key
 from zerver.lib.url_preview.oembed import get_oembed_data
-from zerver.lib.url_preview.parsers import OpenGraphParser, GenericParser
+from zerver.lib.url_preview.parsers import OpenGraphParser, GenericParser, HeadMetadataParser
 from django.utils.encoding import smart_text
 
 
@@ -20,6 +24,90 @@ link_regex = re.compile(
     r'(?:/?|[/?]\S+)$', re.IGNORECASE)
 
 
+# The embed_links worker fetches previews in several threads; see
+# bugdown.fetch_link_preview_data_many.  requests.Session isn't
+# thread-safe, so each thread keeps its own session, which reuses
+# connections, e.g. for several links to the same site.
+session_state = threading.local()
+
+# Stop reading a page after this many bytes; the metadata we want is
+# near the top.
+PREVIEW_MAX_RESPONSE_BYTES = 1024 * 1024
+PREVIEW_FETCH_TIMEOUT = 5
+
+# The number of links to each site we fetch at once, so that a message
+# with many links to one site doesn't look like an attack to it.  We
+# only keep semaphores for the sites we're fetching from right now,
+# counting the threads using each one.
+PREVIEW_DOMAIN_CONCURRENCY = 2
+domain_semaphores = {}  # type: Dict[Text, Tuple[threading.BoundedSemaphore, int]]
+domain_semaphores_lock = threading.Lock()
+
+def get_http_session():
+    # type: () -> requests.Session
+    session = getattr(session_state, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session_state.session = session
+    return session
+
+@contextmanager
+def domain_fetch_slot(url):
+    # type: (Text) -> Iterator[None]
+    domain = urllib.parse.urlparse(url).netloc.lower()
+    with domain_semaphores_lock:
+        if domain in domain_semaphores:
+            (semaphore, users) = domain_semaphores[domain]
+        else:
+            (semaphore, users) = (threading.BoundedSemaphore(PREVIEW_DOMAIN_CONCURRENCY), 0)
+        domain_semaphores[domain] = (semaphore, users + 1)
+    try:
+        with semaphore:
+            yield
+    finally:
+        with domain_semaphores_lock:
+            (semaphore, users) = domain_semaphores[domain]
+            if users == 1:
+                del domain_semaphores[domain]
+            else:
+                domain_semaphores[domain] = (semaphore, users - 1)
+
+def iter_url_text(url, timeout=PREVIEW_FETCH_TIMEOUT):
+    # type: (Text, int) -> Generator[Text, None, None]
+    """Yields the page at url in decoded chunks, stopping after
+    PREVIEW_MAX_RESPONSE_BYTES; yields nothing for an error response.
+    Raises requests' exceptions for connection errors."""
+    response = get_http_session().get(url, stream=True, timeout=timeout)
+    try:
+        if not response.ok:
+            return
+        try:
+            decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')('replace')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        size = 0
+        for chunk in response.iter_content(chunk_size=16 * 1024):
+            chunk = chunk[:PREVIEW_MAX_RESPONSE_BYTES - size]
+            size += len(chunk)
+            yield decoder.decode(chunk)
+            if size >= PREVIEW_MAX_RESPONSE_BYTES:
+                break
+        yield decoder.decode(b'', True)
+    finally:
+        response.close()
+
+def read_head(parser, chunks):
+    # type: (HeadMetadataParser, Iterator[Text]) -> Text
+    """Feeds chunks to parser up to the end of the page's <head>, and
+    returns the text it read."""
+    text = []
+    for chunk in chunks:
+        text.append(chunk)
+        parser.feed(chunk)
+        if parser.done:
+            break
+    return u''.join(text)
+
 def is_link(url):
     # type: (Text) -> Match[Text]
     return link_regex.match(smart_text(url))
@@ -47,15 +135,30 @@ def get_link_embed_data(url, maxwidth=640, maxheight=480):
         logging.error(msg.format(url, traceback.format_exc()))
         return None
     data = data or {}
-    response = requests.get(url)
-    if response.ok:
-        og_data = OpenGraphParser(response.text).extract_data()
-        if og_data:
-            data.update(og_data)
-        generic_data = GenericParser(response.text).extract_data() or {}
-        for key in ['title', 'description', 'image']:
-            if not data.get(key) and generic_data.get(key):
-                data[key] = generic_data[key]
+    chunks = iter_url_text(url)
+    try:
+        head = HeadMetadataParser()
+        text = read_head(head, chunks)
+        data.update(head.open_graph)
+        for (key, value) in [('title', head.title), ('description', head.description)]:
+            if not data.get(key) and value:
+                data[key] = value
+        if all(data.get(key) for key in ['title', 'description', 'image']):
+            # Usually the <head> has all we want, and we don't need to
+            # read (let alone parse) the rest of the page.
+            return data
+
+        text += u''.join(chunks)
+        if text:
+            og_data = OpenGraphParser(text).extract_data()
+            if og_data:
+                data.update(og_data)
+            generic_data = GenericParser(text).extract_data() or {}
+            for key in ['title', 'description', 'image']:
+                if not data.get(key) and generic_data.get(key):
+                    data[key] = generic_data[key]
+    finally:
+        chunks.close()
     return data
 
 
@@ -0,0 +1,73 @@
+
+import logging
+
+from typing import Any
+
+from argparse import ArgumentParser
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.rerender import rerender_messages
+
+logging.getLogger('zulip.rerender').setLevel(logging.INFO)
+
+class Command(ZulipBaseCommand):
+    help = """Re-render messages whose rendered_content is stale.
+
+By default, this only re-renders messages rendered with an older bugdown
+version; use --all after changing how existing messages should render,
+e.g. after adding a realm filter.  The command logs the last message id
+in each batch; if it's interrupted, pass that to --start-id to resume.
+
+Usage: ./manage.py rerender_messages -r zulip --processes=4 --sleep=0.5"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        self.add_realm_args(parser, help='Only re-render messages sent by users in this realm.')
+        parser.add_argument('--all',
+                            action='store_true',
+                            dest='all',
+                            default=False,
+                            help='Re-render all messages, not just those with stale content.')
+        parser.add_argument('--start-id',
+                            dest='start_id',
+                            type=int,
+                            default=0,
+                            help='Start after this message id.')
+        parser.add_argument('--end-id',
+                            dest='end_id',
+                            type=int,
+                            default=None,
+                            help='Stop at this message id.')
+        parser.add_argument('--batch-size',
+                            dest='batch_size',
+                            type=int,
+                            default=1000)
+        parser.add_argument('--processes',
+                            dest='processes',
+                            type=int,
+                            default=4,
+                            help='Number of bugdown worker processes to render with.')
+        parser.add_argument('--sleep',
+                            dest='sleep',
+                            type=float,
+                            default=0.0,
+                            help='Seconds to sleep between batches, to limit the load on the database.')
+        parser.add_argument('--queue-link-previews',
+                            action='store_true',
+                            dest='queue_link_previews',
+                            default=False,
+                            help='Queue fetching link previews that aren\'t cached; each message '
+                                 'with such links is then re-rendered again, and clients updated.')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm = self.get_realm(options)
+        last_id = rerender_messages(start_id=options['start_id'],
+                                    end_id=options['end_id'],
+                                    realm=realm,
+                                    rerender_all=options['all'],
+                                    batch_size=options['batch_size'],
+                                    processes=options['processes'],
+                                    sleep_secs=options['sleep'],
+                                    queue_previews=options['queue_link_previews'])
+        print('Done, through message id %s.' % (last_id,))
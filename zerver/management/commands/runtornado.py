@@ -19,6 +19,9 @@ from zerver.tornado.application import create_tornado_application, \
     setup_tornado_rabbitmq
 from zerver.tornado.event_queue import add_client_gc_hook, \
     missedmessage_hook, process_notification, setup_event_queue
+from zerver.tornado import sharding
+from zerver.tornado.sharding import get_shard_for_port, notify_tornado_queue_name, \
+    set_current_shard, tornado_return_queue_name
 from zerver.tornado.socket import respond_send_message
 
 import logging
@@ -88,11 +91,17 @@ class Command(BaseCommand):
             print("Tornado server is running at http://%s:%s/" % (addr, port))
             print("Quit the server with %s." % (quit_command,))
 
+            # When running several Tornado processes, the port
+            # determines which shard of the realms we serve.
+            set_current_shard(get_shard_for_port(int(port)))
+
             if settings.USING_RABBITMQ:
                 queue_client = get_queue_client()
                 # Process notifications received via RabbitMQ
-                queue_client.register_json_consumer('notify_tornado', process_notification)
-                queue_client.register_json_consumer('tornado_return', respond_send_message)
+                queue_client.register_json_consumer(
+                    notify_tornado_queue_name(sharding.current_shard), process_notification)
+                queue_client.register_json_consumer(
+                    tornado_return_queue_name(sharding.current_shard), respond_send_message)
 
             try:
                 # Application is an instance of Django's standard wsgi handler.
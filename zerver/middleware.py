@@ -15,7 +15,8 @@ from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
 from zerver.lib.utils import statsd
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.cache import get_remote_cache_time, get_remote_cache_requests
-from zerver.lib.bugdown import get_bugdown_time, get_bugdown_requests
+from zerver.lib.bugdown import get_bugdown_time, get_bugdown_requests, \
+    get_bugdown_cache_hits, get_bugdown_cache_misses
 from zerver.models import flush_per_request_caches, get_realm
 from zerver.lib.exceptions import RateLimited
 from django.contrib.sessions.middleware import SessionMiddleware
@@ -38,6 +39,8 @@ def record_request_stop_data(log_data):
     log_data['remote_cache_requests_stopped'] = get_remote_cache_requests()
     log_data['bugdown_time_stopped'] = get_bugdown_time()
     log_data['bugdown_requests_stopped'] = get_bugdown_requests()
+    log_data['bugdown_cache_hits_stopped'] = get_bugdown_cache_hits()
+    log_data['bugdown_cache_misses_stopped'] = get_bugdown_cache_misses()
     if settings.PROFILE_ALL_REQUESTS:
         log_data["prof"].disable()
 
@@ -54,6 +57,8 @@ def record_request_restart_data(log_data):
     log_data['remote_cache_requests_restarted'] = get_remote_cache_requests()
     log_data['bugdown_time_restarted'] = get_bugdown_time()
     log_data['bugdown_requests_restarted'] = get_bugdown_requests()
+    log_data['bugdown_cache_hits_restarted'] = get_bugdown_cache_hits()
+    log_data['bugdown_cache_misses_restarted'] = get_bugdown_cache_misses()
 
 def async_request_restart(request):
     # type: (HttpRequest) -> None
@@ -74,6 +79,8 @@ def record_request_start_data(log_data):
     log_data['remote_cache_requests_start'] = get_remote_cache_requests()
     log_data['bugdown_time_start'] = get_bugdown_time()
     log_data['bugdown_requests_start'] = get_bugdown_requests()
+    log_data['bugdown_cache_hits_start'] = get_bugdown_cache_hits()
+    log_data['bugdown_cache_misses_start'] = get_bugdown_cache_misses()
 
 def timedelta_ms(timedelta):
     # type: (float) -> float
@@ -161,12 +168,18 @@ def write_log_line(log_data, path, method, remote_ip, email, client_name,
     if 'bugdown_time_start' in log_data:
         bugdown_time_delta = get_bugdown_time() - log_data['bugdown_time_start']
         bugdown_count_delta = get_bugdown_requests() - log_data['bugdown_requests_start']
+        bugdown_cache_hits_delta = get_bugdown_cache_hits() - log_data['bugdown_cache_hits_start']
+        bugdown_cache_misses_delta = get_bugdown_cache_misses() - log_data['bugdown_cache_misses_start']
         if 'bugdown_requests_stopped' in log_data:
             # (now - restarted) + (stopped - start) = (now - start) + (stopped - restarted)
             bugdown_time_delta += (log_data['bugdown_time_stopped'] -
                                    log_data['bugdown_time_restarted'])
             bugdown_count_delta += (log_data['bugdown_requests_stopped'] -
                                     log_data['bugdown_requests_restarted'])
+            bugdown_cache_hits_delta += (log_data['bugdown_cache_hits_stopped'] -
+                                         log_data['bugdown_cache_hits_restarted'])
+            bugdown_cache_misses_delta += (log_data['bugdown_cache_misses_stopped'] -
+                                           log_data['bugdown_cache_misses_restarted'])
 
         if (bugdown_time_delta > 0.005):
             bugdown_output = " (md: %s/%s)" % (format_timedelta(bugdown_time_delta),
@@ -176,6 +189,10 @@ def write_log_line(log_data, path, method, remote_ip, email, client_name,
                 statsd.timing("%s.markdown.time" % (statsd_path,), timedelta_ms(bugdown_time_delta))
                 statsd.incr("%s.markdown.count" % (statsd_path,), bugdown_count_delta)
 
+        if not suppress_statsd and (bugdown_cache_hits_delta or bugdown_cache_misses_delta):
+            statsd.incr("markdown.cache_hits", bugdown_cache_hits_delta)
+            statsd.incr("markdown.cache_misses", bugdown_cache_misses_delta)
+
     # Get the amount of time spent doing database queries
     db_time_output = ""
     queries = connection.connection.queries if connection.connection is not None else []
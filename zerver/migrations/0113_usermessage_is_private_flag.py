@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import bitfield.models
+from django.db.backends.postgresql_psycopg2.schema import DatabaseSchemaEditor
+from django.db.migrations.state import StateApps
+from django.db import connection, migrations
+
+BATCH_SIZE = 10000
+
+# is_private reuses the bit of the removed is_me_message flag, so we
+# have to both set it on private and huddle messages and clear it on
+# stream messages.
+UPDATE_FLAGS_SQL = '''
+    UPDATE %(usermessage_table)s um
+    SET flags = CASE WHEN r.type IN (1, 3) THEN um.flags | 2048 ELSE um.flags & ~2048 END
+    FROM %(message_table)s m, zerver_recipient r
+    WHERE
+        um.message_id = m.id AND
+        m.recipient_id = r.id AND
+        um.id > %%s AND um.id <= %%s AND
+        ((um.flags & 2048) != 0) != (r.type IN (1, 3))
+'''
+
+def set_is_private_flag(apps, schema_editor):
+    # type: (StateApps, DatabaseSchemaEditor) -> None
+    for (usermessage_table, message_table) in [
+            ('zerver_usermessage', 'zerver_message'),
+            ('zerver_archivedusermessage', 'zerver_archivedmessage')]:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT MIN(id), MAX(id) FROM %s' % (usermessage_table,))
+            (min_id, max_id) = cursor.fetchone()
+        if min_id is None:
+            continue
+
+        sql = UPDATE_FLAGS_SQL % dict(usermessage_table=usermessage_table,
+                                      message_table=message_table)
+        lower_bound = min_id - 1
+        while lower_bound < max_id:
+            upper_bound = lower_bound + BATCH_SIZE
+            # Each batch commits on its own, since this migration isn't
+            # atomic, so we don't hold locks on the whole table.
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [lower_bound, upper_bound])
+            lower_bound = upper_bound
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('zerver', '0112_index_muted_topics'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archivedusermessage',
+            name='flags',
+            field=bitfield.models.BitField(['read', 'starred', 'collapsed', 'mentioned', 'wildcard_mentioned', 'summarize_in_home', 'summarize_in_stream', 'force_expand', 'force_collapse', 'has_alert_word', 'historical', 'is_private'], default=0),
+        ),
+        migrations.AlterField(
+            model_name='usermessage',
+            name='flags',
+            field=bitfield.models.BitField(['read', 'starred', 'collapsed', 'mentioned', 'wildcard_mentioned', 'summarize_in_home', 'summarize_in_stream', 'force_expand', 'force_collapse', 'has_alert_word', 'historical', 'is_private'], default=0),
+        ),
+        migrations.RunPython(set_is_private_flag,
+                             reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations, models
+import django.db.models.deletion
+import zerver.lib.str_utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zerver', '0114_index_is_private_user_messages'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StreamTopic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('topic_key', models.TextField()),
+                ('topic_name', models.CharField(max_length=60)),
+                ('max_message_id', models.IntegerField()),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='zerver.Recipient')),
+            ],
+            bases=(zerver.lib.str_utils.ModelReprMixin, models.Model),
+        ),
+        migrations.AlterUniqueTogether(
+            name='streamtopic',
+            unique_together=set([('recipient', 'topic_key')]),
+        ),
+        migrations.RunSQL(
+            '''
+            INSERT INTO zerver_streamtopic (recipient_id, topic_key, topic_name, max_message_id)
+            SELECT DISTINCT ON (zerver_message.recipient_id, lower(zerver_message.subject))
+                zerver_message.recipient_id,
+                lower(zerver_message.subject),
+                zerver_message.subject,
+                zerver_message.id
+            FROM zerver_message
+            INNER JOIN zerver_recipient ON (
+                zerver_recipient.id = zerver_message.recipient_id AND
+                zerver_recipient.type = 2
+            )
+            ORDER BY zerver_message.recipient_id, lower(zerver_message.subject), zerver_message.id DESC;
+            ''',
+            reverse_sql='DELETE FROM zerver_streamtopic;',
+        ),
+    ]
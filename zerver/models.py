@@ -959,6 +959,23 @@ class MutedTopic(ModelReprMixin, models.Model):
         # type: () -> Text
         return u"<MutedTopic: (%s, %s, %s)>" % (self.user_profile.email, self.stream.name, self.topic_name)
 
+class StreamTopic(ModelReprMixin, models.Model):
+    # The latest message in each topic of a stream; maintained by
+    # zerver/lib/topic_history.py.
+    recipient = models.ForeignKey(Recipient, on_delete=CASCADE)
+    # Postgres' lower() of the topic name.
+    topic_key = models.TextField()  # type: Text
+    # The topic name as spelled in the latest message.
+    topic_name = models.CharField(max_length=MAX_SUBJECT_LENGTH)  # type: Text
+    max_message_id = models.IntegerField()  # type: int
+
+    class Meta(object):
+        unique_together = ('recipient', 'topic_key')
+
+    def __unicode__(self):
+        # type: () -> Text
+        return u"<StreamTopic: (%s, %s, %s)>" % (self.recipient_id, self.topic_name, self.max_message_id)
+
 class Client(ModelReprMixin, models.Model):
     name = models.CharField(max_length=30, db_index=True, unique=True)  # type: Text
 
@@ -1240,13 +1257,21 @@ class Reaction(ModelReprMixin, models.Model):
 # though each row is only 4 integers.
 class AbstractUserMessage(ModelReprMixin, models.Model):
     user_profile = models.ForeignKey(UserProfile, on_delete=CASCADE)  # type: UserProfile
-    # WARNING: We removed the previously-final flag,
-    # is_me_message, without clearing any values it might have had in
-    # the database.  So when we next add a flag, you need to do a
-    # migration to set it to 0 first
+    # is_private took the bit of the removed is_me_message flag;
+    # migration 0113 rewrote that bit for every existing row.  When
+    # removing a flag, clear it in the database too, so that the bit
+    # can be reused.
+    #
+    # is_private is set iff the message is a private message or a
+    # huddle message; it duplicates the recipient's type so that
+    # is:private narrows can use a partial index on this table
+    # instead of joining zerver_recipient.
     ALL_FLAGS = ['read', 'starred', 'collapsed', 'mentioned', 'wildcard_mentioned',
                  'summarize_in_home', 'summarize_in_stream', 'force_expand', 'force_collapse',
-                 'has_alert_word', "historical"]
+                 'has_alert_word', "historical", "is_private"]
+    # Flags that we maintain on the server; clients can't see or set them.
+    NON_API_FLAGS = {"is_private"}
+    NON_API_FLAGS_MASK = 2 ** ALL_FLAGS.index("is_private")
     flags = BitField(flags=ALL_FLAGS, default=0)  # type: BitHandler
 
     class Meta(object):
@@ -1274,6 +1299,7 @@ class AbstractUserMessage(ModelReprMixin, models.Model):
         sending messages in a naive implementation.
         '''
         names = AbstractUserMessage.ALL_FLAGS
+        flags &= ~AbstractUserMessage.NON_API_FLAGS_MASK
         return [
             names[i]
             for i in range(len(names))
@@ -1301,7 +1327,7 @@ def parse_usermessage_flags(val):
     flags = []
     mask = 1
     for flag in UserMessage.ALL_FLAGS:
-        if val & mask:
+        if val & mask and flag not in UserMessage.NON_API_FLAGS:
             flags.append(flag)
         mask <<= 1
     return flags
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from zerver.lib.alert_words import (
+    AlertWordAutomaton,
     add_user_alert_words,
+    alert_word_automaton_for_realm,
     alert_words_in_realm,
     remove_user_alert_words,
     user_alert_words,
@@ -21,7 +23,7 @@ from zerver.models import (
     UserProfile,
 )
 
-from typing import Text
+from typing import Set, Text
 
 import ujson
 
@@ -105,6 +107,35 @@ class AlertWordTests(ZulipTestCase):
                          self.interesting_alert_word_list)
         self.assertEqual(realm_words[user2.id], ['another'])
 
+    def test_alert_word_automaton(self):
+        # type: () -> None
+        automaton = AlertWordAutomaton({1: ['Alert', 'multi-word word', u'☃'],
+                                        2: ['alert', 'word', 'lert']})
+        self.assertEqual(automaton.user_ids_for_words(['alert', 'word']), {1, 2})
+
+        def find(content):
+            # type: (Text) -> Set[Text]
+            return automaton.find_words(content.lower())
+
+        self.assertEqual(find(u'ALERT: a multi-word word, ☃!'),
+                         {'alert', 'multi-word word', 'word', u'☃'})
+        self.assertEqual(find('alerted (word) >alert'), {'word', 'alert'})
+        self.assertEqual(find('alerts words lert_'), set())
+        self.assertEqual(AlertWordAutomaton({}).find_words('alert'), set())
+
+    def test_alert_word_automaton_cache(self):
+        # type: () -> None
+        user = self.example_user('cordelia')
+        automaton = alert_word_automaton_for_realm(user.realm)
+        self.assertEqual(automaton.find_words('milk and cookies'), set())
+        # We reuse the process's automaton until the alert words change.
+        self.assertIs(alert_word_automaton_for_realm(user.realm), automaton)
+
+        add_user_alert_words(user, ['milk'])
+        automaton = alert_word_automaton_for_realm(user.realm)
+        self.assertEqual(automaton.find_words('milk and cookies'), {'milk'})
+        self.assertEqual(automaton.user_ids_for_words(['milk']), {user.id})
+
     def test_json_list_default(self):
         # type: () -> None
         self.login(self.example_email("hamlet"))
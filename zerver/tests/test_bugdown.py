@@ -4,16 +4,22 @@ from django.test import TestCase, override_settings
 
 from zerver.lib import bugdown
 from zerver.lib.actions import (
+    check_add_realm_emoji,
     do_remove_realm_emoji,
+    do_send_messages,
     do_set_alert_words,
     get_realm,
+    internal_prep_stream_message,
 )
-from zerver.lib.alert_words import alert_words_in_realm
+from zerver.lib.alert_words import AlertWordAutomaton, alert_word_automaton_for_realm
+from zerver.lib.bugdown_pool import BugdownWorkerError, BugdownWorkerPool, \
+    get_bugdown_worker_pool, serve_jobs
 from zerver.lib.camo import get_camo_url
 from zerver.lib.create_user import create_user
 from zerver.lib.emoji import get_emoji_url
 from zerver.lib.mention import possible_mentions
 from zerver.lib.message import render_markdown
+from zerver.lib import realm_name_index, rerender
 from zerver.lib.request import (
     JsonableError,
 )
@@ -21,6 +27,7 @@ from zerver.lib.test_classes import (
     ZulipTestCase,
 )
 from zerver.lib.test_runner import slow
+from zerver.lib.timeout import TimeoutExpired
 from zerver.lib.str_utils import force_str
 from zerver.models import (
     realm_in_local_realm_filters_cache,
@@ -35,12 +42,14 @@ from zerver.models import (
     Realm,
     RealmFilter,
     Recipient,
+    UserMessage,
     UserProfile,
 )
 
 import copy
 import mock
 import os
+import time
 import ujson
 
 from six.moves import urllib
@@ -201,6 +210,32 @@ class BugdownMiscTest(ZulipTestCase):
             id=fred2.id
         ))
 
+    def test_realm_name_index(self):
+        # type: () -> None
+        realm = get_realm('zulip')
+        hamlet = self.example_user('hamlet')
+        self.assertEqual(bugdown.get_email_info(realm.id, {' Hamlet@zulip.com'}),
+                         {'hamlet@zulip.com': dict(id=hamlet.id, email=hamlet.email)})
+        self.assertEqual(set(bugdown.get_stream_name_info(realm, {'Denmark', 'New stream'})),
+                         {'Denmark'})
+
+        # Changing users and streams invalidates the index.
+        hamlet.full_name = 'Prince Hamlet'
+        hamlet.save(update_fields=['full_name'])
+        self.assertEqual(set(bugdown.get_full_name_info(realm.id, {'King Hamlet', 'Prince Hamlet'})),
+                         {'prince hamlet'})
+        Stream.objects.create(name='New stream', realm=realm)
+        self.assertEqual(set(bugdown.get_stream_name_info(realm, {'Denmark', 'New stream'})),
+                         {'Denmark', 'New stream'})
+
+        # In a batch, we only check the index is current once.
+        with mock.patch('zerver.lib.realm_name_index.cache_get',
+                        wraps=realm_name_index.cache_get) as cache_get:
+            with realm_name_index.name_index_batch():
+                bugdown.get_email_info(realm.id, {'hamlet@zulip.com'})
+                bugdown.get_full_name_info(realm.id, {'Prince Hamlet'})
+        self.assertEqual(cache_get.call_count, 1)
+
 class BugdownTest(ZulipTestCase):
     def load_bugdown_tests(self):
         # type: () -> Tuple[Dict[Text, Any], List[List[Text]]]
@@ -253,11 +288,12 @@ class BugdownTest(ZulipTestCase):
 
         with self.settings(ENABLE_FILE_LINKS=False):
             realm = Realm.objects.create(string_id='file_links_test')
-            bugdown.make_md_engine(
-                realm.id,
-                {'realm_filters': [[], u'file_links_test.example.com'], 'realm': [u'file_links_test.example.com', 'Realm name']})
+            # This realm has no filters, so it uses the default engine,
+            # which we rebuild with the new setting.
+            bugdown.md_engines.clear()
             converted = bugdown.convert(msg, message_realm=realm)
             self.assertEqual(converted, '<p>Check out this file file:///Volumes/myserver/Users/Shared/pi.py</p>')
+        bugdown.md_engines.clear()
 
     def test_inline_youtube(self):
         # type: () -> None
@@ -534,6 +570,32 @@ class BugdownTest(ZulipTestCase):
         with self.settings(TEST_SUITE=False, TWITTER_CONSUMER_KEY=None):
             self.assertIs(None, bugdown.fetch_tweet_data('287977969287315459'))
 
+    def test_deferred_tweet_preview(self):
+        # type: () -> None
+        url = 'http://twitter.com/wdaher/status/287977969287315456'
+        sender_user_profile = self.example_user('othello')
+        msg = Message(sender=sender_user_profile, sending_client=get_client("test"))
+        caches = {
+            'default': settings.CACHES['default'],
+            'database': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'test-deferred-tweet-preview',
+            },
+        }
+        with self.settings(CACHES=caches):
+            # We don't fetch the tweet while rendering the message, but
+            # leave it for the embed_links worker.
+            with mock.patch('zerver.lib.bugdown.fetch_tweet_data') as fetch_mock:
+                converted = render_markdown(msg, url)
+            self.assertEqual(fetch_mock.call_count, 0)
+            self.assertEqual(msg.links_for_preview, {url})
+            self.assertNotIn('inline-preview-twitter', converted)
+
+            bugdown.fetch_link_preview_data(url)
+            converted = render_markdown(msg, url)
+            self.assertEqual(msg.links_for_preview, set())
+            self.assertIn('inline-preview-twitter', converted)
+
     def test_content_has_emoji(self):
         # type: () -> None
         self.assertFalse(bugdown.content_has_emoji_syntax('boring'))
@@ -637,13 +699,40 @@ class BugdownTest(ZulipTestCase):
         realm_filter.save()
 
         bugdown.realm_filter_data = {}
-        bugdown.maybe_update_realm_filters(None)
+        bugdown.maybe_update_realm_filters(realm.id)
         all_filters = bugdown.realm_filter_data
         zulip_filters = all_filters[realm.id]
         self.assertEqual(len(zulip_filters), 1)
         self.assertEqual(zulip_filters[0],
                          (u'#(?P<id>[0-9]{2,8})', u'https://trac.zulip.net/ticket/%(id)s', realm_filter.id))
 
+    def test_md_engines(self):
+        # type: () -> None
+        realm = get_realm('zulip')
+        realm_without_filters = get_realm('zephyr')
+        bugdown.md_engines.clear()
+
+        # We only build engines when we need them, and realms without
+        # filters share the default engine.
+        default_engine = bugdown.get_md_engine(realm_without_filters.id)
+        self.assertEqual(list(bugdown.md_engines.keys()), [bugdown.DEFAULT_BUGDOWN_KEY])
+        self.assertIs(bugdown.get_md_engine(bugdown.DEFAULT_BUGDOWN_KEY), default_engine)
+
+        RealmFilter(realm=realm, pattern=r"#(?P<id>[0-9]{2,8})",
+                    url_format_string=r"https://trac.zulip.net/ticket/%(id)s").save()
+        realm_engine = bugdown.get_md_engine(realm.id)
+        self.assertIsNot(realm_engine, default_engine)
+        self.assertEqual(list(bugdown.md_engines.keys()), [bugdown.DEFAULT_BUGDOWN_KEY, realm.id])
+
+        # We evict the least recently used engine.
+        bugdown.get_md_engine(bugdown.DEFAULT_BUGDOWN_KEY)
+        with mock.patch('zerver.lib.bugdown.MAX_MD_ENGINES', 2):
+            bugdown.get_md_engine(bugdown.ZEPHYR_MIRROR_BUGDOWN_KEY)
+        self.assertEqual(list(bugdown.md_engines.keys()),
+                         [bugdown.DEFAULT_BUGDOWN_KEY, bugdown.ZEPHYR_MIRROR_BUGDOWN_KEY])
+        self.assertNotIn(realm.id, bugdown.realm_filter_data)
+        self.assertIsNot(bugdown.get_md_engine(realm.id), realm_engine)
+
     def test_flush_realm_filter(self):
         # type: () -> None
         realm = get_realm('zulip')
@@ -694,6 +783,57 @@ class BugdownTest(ZulipTestCase):
         converted_boring_subject = bugdown.subject_links(realm.id, boring_msg.subject)
         self.assertEqual(converted_boring_subject, [])
 
+    def test_realm_filter_matcher(self):
+        # type: () -> None
+        realm_filters = [
+            (u'#(?P<id>[0-9]{2,8})', u'https://trac.zulip.net/ticket/%(id)s', 1),
+            (u'#(?P<id>[a-zA-Z]+-[0-9]+)', u'https://jira.example.com/%(id)s', 2),
+            (u'(?P<word>[a-z]+)-(?P=word)', u'https://example.com/%(word)s/%(name)s', 3),
+        ]
+        matcher = bugdown.RealmFilterMatcher(realm_filters)
+        self.assertEqual(matcher.find_urls(u'#224, #ZUL-123 and not #1124z, but bye-bye'), [
+            u'https://trac.zulip.net/ticket/224',
+            u'https://jira.example.com/ZUL-123',
+            u'https://example.com/bye/bye-bye',
+        ])
+        self.assertEqual(bugdown.RealmFilterMatcher([]).find_urls(u'#224'), [])
+
+        realm = get_realm('zulip')
+        matcher = bugdown.get_realm_filter_matcher(realm.id)
+        self.assertIs(bugdown.get_realm_filter_matcher(realm.id), matcher)
+        RealmFilter(realm=realm, pattern=r"#(?P<id>[0-9]{2,8})",
+                    url_format_string=r"https://trac.zulip.net/ticket/%(id)s").save()
+        new_matcher = bugdown.get_realm_filter_matcher(realm.id)
+        self.assertIsNot(new_matcher, matcher)
+        self.assertEqual(new_matcher.find_urls(u'#224'), [u'https://trac.zulip.net/ticket/224'])
+
+    def test_realm_filter_matcher_many_filters(self):
+        # type: () -> None
+        # Python's re can't compile a regex with more than 100 groups,
+        # so a realm's filters may need several combined regexes.
+        realm = get_realm('zulip')
+        for i in range(70):
+            RealmFilter(realm=realm, pattern=r'#P%d-(?P<id>[0-9]+)' % (i,),
+                        url_format_string=r'https://tracker.example.com/p%d/%%(id)s' % (i,)).save()
+        matcher = bugdown.get_realm_filter_matcher(realm.id)
+        self.assertGreater(len(matcher.regexes), 1)
+        for regex in matcher.regexes:
+            self.assertLessEqual(regex.regex.groups, bugdown.MAX_REALM_FILTER_GROUPS)
+
+        self.assertEqual(bugdown.subject_links(realm.id, u'#P3-12 and #P69-7'), [
+            u'https://tracker.example.com/p3/12',
+            u'https://tracker.example.com/p69/7',
+        ])
+
+        msg = Message(sender=self.example_user('othello'))
+        converted = bugdown.convert(u'#P3-12 and #P69-7', message_realm=realm, message=msg)
+        self.assertEqual(
+            converted,
+            '<p><a href="https://tracker.example.com/p3/12" target="_blank" '
+            'title="https://tracker.example.com/p3/12">#P3-12</a> and '
+            '<a href="https://tracker.example.com/p69/7" target="_blank" '
+            'title="https://tracker.example.com/p69/7">#P69-7</a></p>')
+
     def test_is_status_message(self):
         # type: () -> None
         user_profile = self.example_user('othello')
@@ -720,13 +860,13 @@ class BugdownTest(ZulipTestCase):
         user_profile = self.example_user('othello')
         do_set_alert_words(user_profile, ["ALERTWORD", "scaryword"])
         msg = Message(sender=user_profile, sending_client=get_client("test"))
-        realm_alert_words = alert_words_in_realm(user_profile.realm)
+        realm_alert_word_automaton = alert_word_automaton_for_realm(user_profile.realm)
 
         def render(msg, content):
             # type: (Message, Text) -> Text
             return render_markdown(msg,
                                    content,
-                                   realm_alert_words=realm_alert_words,
+                                   realm_alert_word_automaton=realm_alert_word_automaton,
                                    user_ids={user_profile.id})
 
         content = "We have an ALERTWORD day today!"
@@ -1057,6 +1197,30 @@ class BugdownApiTests(ZulipTestCase):
         self.assertEqual(result.json()['rendered'],
                          u'<p>That is a <strong>bold</strong> statement</p>')
 
+    def test_render_tweet_preview_api(self):
+        # type: () -> None
+        """Nothing queues the embed_links worker for a compose preview, so
+        the endpoint fetches Twitter previews itself."""
+        url = 'http://twitter.com/wdaher/status/287977969287315456'
+        caches = {
+            'default': settings.CACHES['default'],
+            'database': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'test-render-tweet-preview-api',
+            },
+        }
+        with self.settings(CACHES=caches), \
+                mock.patch('zerver.lib.bugdown.fetch_tweet_data',
+                           wraps=bugdown.fetch_tweet_data) as fetch_mock:
+            result = self.client_post(
+                '/api/v1/messages/render',
+                dict(content=url),
+                **self.api_auth(self.example_email("othello"))
+            )
+        self.assert_json_success(result)
+        self.assertEqual(fetch_mock.call_count, 1)
+        self.assertIn('inline-preview-twitter', result.json()['rendered'])
+
     def test_render_mention_stream_api(self):
         # type: () -> None
         """Determines whether we're correctly passing the realm context"""
@@ -1088,6 +1252,257 @@ class BugdownErrorTests(ZulipTestCase):
             with self.assertRaises(JsonableError):
                 self.send_message(self.example_email("othello"), "Denmark", Recipient.STREAM, message)
 
+class BugdownRenderedContentCacheTest(ZulipTestCase):
+    def cache_key(self, content, message=None):
+        # type: (Text, Optional[Message]) -> Optional[Text]
+        realm = get_realm('zulip')
+        return bugdown.rendered_content_cache_key(content, message, realm, realm.id, None, False)
+
+    def test_cache_hits(self):
+        # type: () -> None
+        content = 'Build **#1234** passed'
+        hits = bugdown.get_bugdown_cache_hits()
+        misses = bugdown.get_bugdown_cache_misses()
+        converted = bugdown_convert(content)
+        self.assertEqual(bugdown.get_bugdown_cache_misses(), misses + 1)
+
+        with mock.patch('zerver.lib.bugdown.render_contents') as render_contents:
+            self.assertEqual(bugdown_convert(content), converted)
+            bugdown.rendered_content_lru.clear()
+            self.assertEqual(bugdown_convert(content), converted)
+        render_contents.assert_not_called()
+        self.assertEqual(bugdown.get_bugdown_cache_hits(), hits + 2)
+
+    def test_uncacheable_content(self):
+        # type: () -> None
+        self.assertIsNotNone(self.cache_key('hello'))
+        self.assertIsNone(self.cache_key('hello @**King Hamlet**'))
+        self.assertIsNone(self.cache_key('hello @**all**'))
+        self.assertIsNone(self.cache_key('!avatar(hamlet@zulip.com)'))
+        self.assertIsNone(self.cache_key('see #**Denmark**'))
+
+        realm = get_realm('zulip')
+        automaton = AlertWordAutomaton({1: ['hello']})
+        self.assertIsNone(bugdown.rendered_content_cache_key(
+            'Hello there', None, realm, realm.id, automaton, False))
+        self.assertIsNotNone(bugdown.rendered_content_cache_key(
+            'goodbye', None, realm, realm.id, automaton, False))
+
+    def test_cache_key(self):
+        # type: () -> None
+        realm = get_realm('zulip')
+        message = Message(sender=self.example_user('othello'), sending_client=get_client("test"))
+        key = self.cache_key('hello #1234 :test_tick:', message)
+        self.assertEqual(key, self.cache_key('hello #1234 :test_tick:', message))
+        self.assertNotEqual(key, self.cache_key('hello #1235 :test_tick:', message))
+        self.assertNotEqual(key, self.cache_key('hello #1234 :test_tick:'))
+
+        RealmFilter(realm=realm, pattern=r"#(?P<id>[0-9]{2,8})",
+                    url_format_string=r"https://trac.zulip.net/ticket/%(id)s").save()
+        new_key = self.cache_key('hello #1234 :test_tick:', message)
+        self.assertNotEqual(key, new_key)
+
+        check_add_realm_emoji(realm, 'test_tick', 'test_tick.png')
+        self.assertNotEqual(new_key, self.cache_key('hello #1234 :test_tick:', message))
+
+        with mock.patch('zerver.lib.bugdown.version', bugdown.version + 1):
+            self.assertNotEqual(key, self.cache_key('hello #1234 :test_tick:', message))
+        with mock.patch('zerver.lib.bugdown.rendering_code_fingerprint', 'changed'):
+            self.assertNotEqual(key, self.cache_key('hello #1234 :test_tick:', message))
+        with self.settings(CAMO_URI='https://external.example.com/'):
+            self.assertNotEqual(key, self.cache_key('hello #1234 :test_tick:', message))
+
+    def test_failed_preview_not_cached(self):
+        # type: () -> None
+        url = 'http://twitter.com/wdaher/status/287977969287315499'
+        msg_id = self.send_message(self.example_email('othello'), 'Denmark', Recipient.STREAM)
+        msg = Message.objects.get(id=msg_id)
+        caches = {
+            'default': settings.CACHES['default'],
+            'database': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'test-failed-preview-not-cached',
+            },
+        }
+        with self.settings(CACHES=caches):
+            with mock.patch('zerver.lib.bugdown.fetch_tweet_data', side_effect=Exception('rate limited')), \
+                    mock.patch('logging.warning'):
+                bugdown.fetch_link_preview_data(url)
+
+            # We render the message without the preview, and don't cache
+            # that rendering, since we'll try fetching the preview again.
+            converted = render_markdown(msg, url)
+            self.assertEqual(msg.links_for_preview, set())
+            self.assertEqual(msg.links_with_failed_previews, {url})
+            self.assertNotIn('inline-preview-twitter', converted)
+            self.assertIsNone(bugdown.get_cached_rendered_content(self.cache_key(url, msg)))
+
+class RerenderMessagesTest(ZulipTestCase):
+    def test_rerender_messages(self):
+        # type: () -> None
+        stale_id = self.send_message(self.example_email('hamlet'), 'Denmark', Recipient.STREAM,
+                                     '**stale** @**Cordelia Lear**')
+        current_id = self.send_message(self.example_email('hamlet'), 'Denmark', Recipient.STREAM,
+                                       '**current**')
+        edited_id = self.send_message(self.example_email('hamlet'), 'Denmark', Recipient.STREAM,
+                                      '**edited**')
+        expected = {
+            message.id: message.rendered_content
+            for message in Message.objects.filter(id__in=[stale_id, current_id, edited_id])
+        }
+        Message.objects.filter(id__in=[stale_id, edited_id]).update(
+            rendered_content='<p>old</p>', rendered_content_version=bugdown.version - 1)
+        Message.objects.filter(id=current_id).update(rendered_content='<p>old</p>')
+
+        # Simulate the message being edited after we read it.
+        real_get_message_batch = rerender.get_message_batch
+
+        def get_message_batch(*args):
+            # type: (*Any) -> List[Message]
+            messages = real_get_message_batch(*args)
+            if edited_id in [message.id for message in messages]:
+                Message.objects.filter(id=edited_id).update(content='**edited again**')
+            return messages
+
+        with mock.patch('zerver.lib.rerender.get_message_batch', side_effect=get_message_batch):
+            last_id = rerender.rerender_messages(start_id=stale_id - 1, realm=get_realm('zulip'),
+                                                 batch_size=1)
+        self.assertEqual(last_id, edited_id)
+
+        stale = Message.objects.get(id=stale_id)
+        self.assertEqual(stale.rendered_content, expected[stale_id])
+        self.assertEqual(stale.rendered_content_version, bugdown.version)
+        self.assertEqual(Message.objects.get(id=current_id).rendered_content, '<p>old</p>')
+        self.assertEqual(Message.objects.get(id=edited_id).rendered_content, '<p>old</p>')
+
+        # With rerender_all, we re-render messages that look current.
+        rerender.rerender_messages(start_id=current_id - 1, end_id=current_id, rerender_all=True)
+        self.assertEqual(Message.objects.get(id=current_id).rendered_content, expected[current_id])
+
+    @override_settings(INLINE_URL_EMBED_PREVIEW=True)
+    def test_rerender_queues_link_previews(self):
+        # type: () -> None
+        url = 'http://rerender.example.com/'
+        message_id = self.send_message(self.example_email('hamlet'), 'Denmark', Recipient.STREAM, url)
+        Message.objects.filter(id=message_id).update(
+            rendered_content='<p>old</p>', rendered_content_version=bugdown.version - 1)
+
+        # Queueing link previews is opt-in.
+        with mock.patch('zerver.lib.rerender.queue_json_publish') as patched:
+            rerender.rerender_messages(start_id=message_id - 1, end_id=message_id,
+                                       rerender_all=True)
+        patched.assert_not_called()
+
+        with mock.patch('zerver.lib.rerender.queue_json_publish') as patched:
+            rerender.rerender_messages(start_id=message_id - 1, end_id=message_id,
+                                       rerender_all=True, queue_previews=True)
+        patched.assert_called_once()
+        self.assertEqual(patched.call_args[0][0], 'embed_links')
+        self.assertEqual(patched.call_args[0][1], {
+            'message_id': message_id,
+            'message_content': url,
+            'message_realm_id': get_realm('zulip').id,
+            'urls': [url],
+        })
+
+class BugdownWorkerPoolTest(ZulipTestCase):
+    def test_render_job(self):
+        # type: () -> None
+        realm = get_realm('zulip')
+        hamlet = self.example_user('hamlet')
+        message = Message(sender=self.example_user('othello'), sending_client=get_client("test"))
+        content = '@**King Hamlet** and @**all**'
+        db_data = {
+            'alert_word_automaton': None,
+            'email_info': {},
+            'full_name_info': bugdown.get_full_name_info(realm.id, possible_mentions(content)),
+            'realm_emoji': {},
+            'sent_by_bot': False,
+            'stream_names': {},
+        }
+        job = bugdown.make_render_job(content, realm.id, message, db_data)
+        result = bugdown.render_job(job)
+        self.assertEqual(result[1]['mentions_user_ids'], {hamlet.id})
+        self.assertTrue(result[1]['mentions_wildcard'])
+
+        other_message = Message(sender=self.example_user('othello'), sending_client=get_client("test"))
+        rendered_content = bugdown.apply_render_result(result, message)
+        self.assertEqual(rendered_content, bugdown.convert(content, message=other_message))
+        self.assertEqual(message.mentions_user_ids, {hamlet.id})
+        self.assertTrue(message.mentions_wildcard)
+
+        with self.assertRaises(TimeoutExpired):
+            bugdown.apply_render_result(TimeoutExpired(), message)
+
+    def test_render_job_looks_up_alert_words(self):
+        # type: () -> None
+        user_profile = self.example_user('othello')
+        do_set_alert_words(user_profile, ['lunch'])
+        realm = user_profile.realm
+        message = Message(sender=user_profile, sending_client=get_client("test"))
+        content = 'Time for lunch'
+        db_data = bugdown.get_message_db_data(content, realm, alert_word_automaton_for_realm(realm),
+                                              False)
+        job = bugdown.make_render_job(content, realm.id, message, db_data, realm)
+
+        # We don't send the automaton to the worker.
+        self.assertIsNone(job[3]['alert_word_automaton'])
+        self.assertIsNotNone(db_data['alert_word_automaton'])
+        result = bugdown.render_job(job)
+        self.assertEqual(result[1]['alert_words'], {'lunch'})
+
+    def test_send_messages_renders_together(self):
+        # type: () -> None
+        class InProcessPool(object):
+            def __init__(self):
+                # type: () -> None
+                self.batches = []  # type: List[int]
+
+            def render_many(self, jobs):
+                # type: (List[bugdown.RenderJob]) -> List[Any]
+                self.batches.append(len(jobs))
+                return [bugdown.render_job(job) for job in jobs]
+
+        pool = InProcessPool()
+        sender = self.example_user('othello')
+        messages = [internal_prep_stream_message(sender.realm, sender, 'Denmark', 'pool',
+                                                 '**batch %s** @**King Hamlet**' % (i,))
+                    for i in range(3)]
+        with self.settings(BUGDOWN_WORKER_PROCESSES=2), \
+                mock.patch('zerver.lib.bugdown.get_bugdown_worker_pool', return_value=pool):
+            message_ids = do_send_messages(messages)
+        self.assertEqual(pool.batches, [3])
+
+        hamlet = self.example_user('hamlet')
+        for (i, message_id) in enumerate(message_ids):
+            self.assertIn('<strong>batch %s</strong>' % (i,),
+                          Message.objects.get(id=message_id).rendered_content)
+            self.assertTrue(UserMessage.objects.get(user_profile=hamlet, message_id=message_id)
+                            .flags.mentioned)
+
+    def test_no_worker_pool_under_uwsgi(self):
+        # type: () -> None
+        with self.settings(BUGDOWN_WORKER_PROCESSES=2), \
+                mock.patch('zerver.lib.bugdown_pool.running_under_uwsgi', return_value=True):
+            self.assertIsNone(get_bugdown_worker_pool())
+
+    def test_worker_pool(self):
+        # type: () -> None
+        # Real bugdown workers would set up Django with the production
+        # settings, so we test the pool with workers that sleep instead.
+        pool = BugdownWorkerPool(2, target=serve_jobs, args=(time.sleep,))
+        try:
+            results = pool.render_many([0, 'not a number', 60, 0], timeout=1)
+            self.assertEqual(results[0], None)
+            self.assertIsInstance(results[1], BugdownWorkerError)
+            self.assertIsInstance(results[2], TimeoutExpired)
+            self.assertEqual(results[3], None)
+
+            # The worker that timed out was replaced.
+            self.assertEqual(pool.render_many([0, 0]), [None, None])
+        finally:
+            pool.close()
+
 
 class BugdownAvatarTestCase(ZulipTestCase):
     def test_possible_avatar_emails(self):
@@ -1,15 +1,33 @@
+import copy
 import mock
+import os
+import shutil
+import tempfile
+import time
 import ujson
 
+from django.conf import settings
 from django.http import HttpRequest, HttpResponse
-from typing import Any, Callable, Dict, Tuple
+from django.test import override_settings
+from typing import Any, Callable, Dict, List, Tuple
 
-from zerver.lib.actions import do_mute_topic
+from zerver.lib.actions import do_mute_topic, split_user_ids_by_shard
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import POSTRequestMock
 from zerver.models import Recipient, Subscription, UserProfile, get_stream
-from zerver.tornado.event_queue import maybe_enqueue_notifications, \
-    get_client_descriptor, missedmessage_hook
+from zerver.tornado.event_encoding import SharedMessageDict, encode_event, \
+    encode_events_response
+from zerver.tornado import event_queue
+from zerver.tornado.event_queue import ClientDescriptor, EventQueue, maybe_enqueue_notifications, \
+    get_client_descriptor, missedmessage_hook, build_message_event_users, \
+    count_message_event_users, message_event_user_data, send_event, \
+    allocate_client_descriptor, clear_client_event_queues_for_testing, \
+    do_gc_event_queues, gc_event_queues, dump_event_queues, get_client_descriptors_for_user, \
+    get_client_descriptors_for_realm_all_streams, get_client_descriptors_for_realm_stream, \
+    hydrate_pending_clients, \
+    load_event_queues, send_restart_events, snapshot_event_queues
+from zerver.tornado.sharding import get_shard_for_port, get_shards_for_realms, \
+    get_tornado_shard, get_tornado_uri, notify_tornado_queue_name
 from zerver.tornado.views import get_events_backend
 
 class MissedMessageNotificationsTest(ZulipTestCase):
@@ -119,6 +137,36 @@ class MissedMessageNotificationsTest(ZulipTestCase):
         request = POSTRequestMock(post_data, user_profile)
         return view_func(request, user_profile)
 
+    @override_settings(EVENT_QUEUE_MAX_EVENTS=2)
+    def test_missedmessage_hook_after_compaction(self):
+        # type: () -> None
+        user_profile = self.example_user('hamlet')
+        self.login(user_profile.email)
+        result = self.tornado_call(get_events_backend, user_profile,
+                                   {"apply_markdown": ujson.dumps(True),
+                                    "event_types": ujson.dumps(["message"]),
+                                    "user_client": "website",
+                                    "dont_block": ujson.dumps(True),
+                                    })
+        self.assert_json_success(result)
+        client_descriptor = get_client_descriptor(ujson.loads(result.content)["queue_id"])
+
+        pm_id = self.send_message(self.example_email("iago"), [user_profile.email], Recipient.PERSONAL)
+        for i in range(2):
+            self.send_message(self.example_email("iago"), "Denmark", Recipient.STREAM)
+        self.assertTrue(client_descriptor.event_queue.overflowed)
+        # Messages arriving after the queue overflowed count too.
+        mention_id = self.send_message(self.example_email("iago"), "Denmark", Recipient.STREAM,
+                                       content="@**King Hamlet** what's up?")
+
+        # The queue is garbage-collected, and we still notify the user
+        # about the PM and the mention they missed.
+        with mock.patch("zerver.tornado.event_queue.maybe_enqueue_notifications") as mock_enqueue:
+            missedmessage_hook(user_profile.id, client_descriptor, True)
+        self.assertEqual([call[0][1:3] for call in mock_enqueue.call_args_list],
+                         [(pm_id, True), (mention_id, False)])
+        self.assertTrue(mock_enqueue.call_args_list[1][0][3])
+
     def test_end_to_end_missedmessage_hook(self):
         # type: () -> None
         """Tests what arguments missedmessage_hook passes into maybe_enqueue_notifications.
@@ -244,3 +292,376 @@ class MissedMessageNotificationsTest(ZulipTestCase):
         sub.push_notifications = True
         sub.in_home_view = True
         sub.save()
+
+class MessageEventUsersTest(ZulipTestCase):
+    def test_build_message_event_users(self):
+        # type: () -> None
+        users = build_message_event_users(
+            active_user_ids={1, 2, 3, 4},
+            user_flags={2: ['mentioned'], 4: ['mentioned'], 3: ['read']},
+            push_notify_user_ids={1, 5},
+            stream_push_user_ids={4},
+        )
+        self.assertEqual(users, dict(
+            flag_groups=[
+                dict(flags=[], user_ids=[1]),
+                dict(flags=['mentioned'], user_ids=[2, 4]),
+                dict(flags=['read'], user_ids=[3]),
+            ],
+            always_push_notify=[1],
+            stream_push_notify=[4],
+        ))
+        self.assertEqual(count_message_event_users(users), 4)
+
+        # The compact format should survive the trip to Tornado and
+        # describe the same per-user data as the legacy format.
+        legacy_users = [
+            dict(id=1, flags=[], always_push_notify=True, stream_push_notify=False),
+            dict(id=2, flags=['mentioned'], always_push_notify=False, stream_push_notify=False),
+            dict(id=3, flags=['read'], always_push_notify=False, stream_push_notify=False),
+            dict(id=4, flags=['mentioned'], always_push_notify=False, stream_push_notify=True),
+        ]
+        self.assertEqual(
+            sorted(message_event_user_data(ujson.loads(ujson.dumps(users)))),
+            sorted(message_event_user_data(legacy_users)),
+        )
+        self.assertEqual(count_message_event_users(legacy_users), 4)
+
+class EventEncodingTest(ZulipTestCase):
+    def test_encode_events_response(self):
+        # type: () -> None
+        message = SharedMessageDict(id=5, content='<p>hello</p>', type='stream')
+        events = [
+            dict(type='message', message=message, flags=['mentioned'], id=0),
+            dict(type='message', message=message.copy(), flags=[], id=1),
+            dict(type='pointer', pointer=5, id=2),
+        ]
+        response = dict(result='success', msg='', events=events, queue_id='1:0')
+        encoded = encode_events_response(response)
+        self.assertEqual(ujson.loads(encoded), ujson.loads(ujson.dumps(response)))
+
+        # The message body is only encoded once, however many events use it.
+        self.assertEqual(message.encoded(), ujson.dumps(message))
+        with mock.patch('zerver.tornado.event_encoding.ujson.dumps', wraps=ujson.dumps) as mock_dumps:
+            encode_event(events[0])
+            encode_event(events[0])
+        for call in mock_dumps.call_args_list:
+            self.assertNotIn('content', call[0][0])
+
+        self.assertEqual(ujson.loads(encode_events_response(dict(events=[]))), dict(events=[]))
+
+    def test_shared_message_dict_is_immutable(self):
+        # type: () -> None
+        message = SharedMessageDict(id=5)
+        with self.assertRaises(TypeError):
+            message['id'] = 6
+        with self.assertRaises(TypeError):
+            message.update(id=6)
+        with self.assertRaises(TypeError):
+            del message['id']
+
+        copied = message.copy()
+        copied['invite_only_stream'] = True
+        self.assertEqual(message, dict(id=5))
+        self.assertEqual(copy.deepcopy(message), message)
+
+class TornadoShardingTest(ZulipTestCase):
+    @override_settings(TORNADO_PROCESSES=3, TORNADO_SERVER='http://127.0.0.1:9993')
+    def test_sharding(self):
+        # type: () -> None
+        self.assertEqual(get_tornado_shard(7), 1)
+        self.assertEqual(get_shards_for_realms([1, 4, 5]), [1, 2])
+        self.assertEqual(get_shards_for_realms(None), [0, 1, 2])
+        self.assertEqual(get_tornado_uri(2), 'http://127.0.0.1:9995')
+        self.assertEqual(get_shard_for_port(9994), 1)
+        with self.assertRaises(ValueError):
+            get_shard_for_port(9996)
+        self.assertEqual(notify_tornado_queue_name(2), 'notify_tornado_2')
+
+        with mock.patch('zerver.tornado.event_queue.queue_json_publish') as mock_publish:
+            send_event(dict(type='pointer', pointer=5), [1], realm_ids=[4])
+            send_event(dict(type='pointer', pointer=5), iter([1]))
+        queue_names = [call[0][0] for call in mock_publish.call_args_list]
+        self.assertEqual(queue_names, ['notify_tornado_1', 'notify_tornado_0',
+                                       'notify_tornado_1', 'notify_tornado_2'])
+        self.assertEqual(mock_publish.call_args_list[-1][0][1]['users'], [1])
+
+    def test_single_process(self):
+        # type: () -> None
+        self.assertEqual(get_shards_for_realms([1, 4, 5]), [0])
+        self.assertEqual(notify_tornado_queue_name(0), 'notify_tornado')
+        self.assertEqual(get_tornado_uri(0), settings.TORNADO_SERVER)
+
+    @override_settings(TORNADO_PROCESSES=2)
+    def test_private_message_notified_by_one_shard(self):
+        # type: () -> None
+        # Neither user has an event queue, so without sharding each
+        # shard would think cordelia is off Zulip and notify her.
+        cordelia = self.example_user('cordelia')
+        with mock.patch('zerver.tornado.event_queue.maybe_enqueue_notifications',
+                        return_value={}) as mock_enqueue:
+            self.send_message(self.example_email('hamlet'), cordelia.email,
+                              Recipient.PERSONAL, 'hello')
+        self.assertEqual([call[0][0] for call in mock_enqueue.call_args_list], [cordelia.id])
+
+    @override_settings(TORNADO_PROCESSES=2)
+    def test_split_user_ids_by_shard(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        mit_user = self.mit_user('sipbtest')
+
+        def get_shard(realm_id):
+            # type: (int) -> int
+            return 0 if realm_id == hamlet.realm_id else 1
+
+        with mock.patch('zerver.lib.actions.get_tornado_shard', side_effect=get_shard):
+            self.assertEqual(split_user_ids_by_shard([hamlet.id, mit_user.id]),
+                             [({hamlet.realm_id}, {hamlet.id}), ({mit_user.realm_id}, {mit_user.id})])
+            # The shards for realm_ids get the event without any users.
+            self.assertEqual(split_user_ids_by_shard([hamlet.id], [mit_user.realm_id]),
+                             [({hamlet.realm_id}, {hamlet.id}), ({mit_user.realm_id}, set())])
+
+class EventQueuePersistenceTest(ZulipTestCase):
+    def setUp(self):
+        # type: () -> None
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'event_queues.json')
+        clear_client_event_queues_for_testing()
+
+    def tearDown(self):
+        # type: () -> None
+        clear_client_event_queues_for_testing()
+        shutil.rmtree(self.tmp_dir)
+
+    def allocate(self, user_profile, all_public_streams=False):
+        # type: (UserProfile, bool) -> str
+        client = allocate_client_descriptor(dict(
+            user_profile_id=user_profile.id,
+            realm_id=user_profile.realm_id,
+            user_profile_email=user_profile.email,
+            event_types=None,
+            client_type_name='website',
+            apply_markdown=True,
+            all_public_streams=all_public_streams,
+            queue_timeout=0,
+            last_connection_time=time.time(),
+            narrow=[]))
+        return client.event_queue.id
+
+    def restart(self):
+        # type: () -> None
+        clear_client_event_queues_for_testing()
+        load_event_queues(self.filename)
+
+    def read_lines(self):
+        # type: () -> List[str]
+        with open(self.filename) as f:
+            return f.readlines()
+
+    def test_snapshot_and_lazy_load(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        hamlet_queue = self.allocate(hamlet)
+        cordelia_queue = self.allocate(cordelia, all_public_streams=True)
+        doomed_queue = self.allocate(cordelia)
+
+        # The first snapshot writes every queue.
+        snapshot_event_queues(self.filename)
+        self.assertEqual(len(self.read_lines()), 3)
+
+        # Later ones append just the changes.
+        get_client_descriptor(hamlet_queue).add_event(dict(type='pointer', pointer=10))
+        do_gc_event_queues({doomed_queue}, {cordelia.id}, {cordelia.realm_id})
+        snapshot_event_queues(self.filename)
+        lines = self.read_lines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[-1], doomed_queue + '\tdeleted\n')
+        snapshot_event_queues(self.filename)
+        self.assertEqual(len(self.read_lines()), 5)
+
+        # Simulate a crash in the middle of writing a record.
+        with open(self.filename, 'a') as f:
+            f.write(hamlet_queue + '\t%d\t%d\t0\t{"trunc' % (hamlet.id, hamlet.realm_id))
+
+        with mock.patch('logging.warning') as mock_warning:
+            self.restart()
+        mock_warning.assert_called_once_with(
+            'Ignoring incomplete event queue record for %s' % (hamlet_queue,))
+        self.assertEqual(event_queue.clients, {})
+        self.assertEqual(set(event_queue.pending_clients), {hamlet_queue, cordelia_queue})
+
+        send_restart_events()
+        client = get_client_descriptor(hamlet_queue)
+        self.assertEqual([event['type'] for event in client.event_queue.contents()],
+                         ['pointer', 'restart'])
+        self.assertEqual(set(event_queue.pending_clients), {cordelia_queue})
+
+        [client] = get_client_descriptors_for_realm_all_streams(cordelia.realm_id)
+        self.assertEqual(client.event_queue.id, cordelia_queue)
+        self.assertEqual(get_client_descriptors_for_user(cordelia.id), [client])
+        self.assertFalse(hydrate_pending_clients())
+
+    def test_dump_writes_pending_queues(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        queue_ids = {self.allocate(hamlet) for i in range(3)}
+        dump_event_queues(self.filename)
+
+        self.restart()
+        get_client_descriptor(list(queue_ids)[0])
+        dump_event_queues(self.filename)
+        self.assertEqual(len(self.read_lines()), 3)
+
+        self.restart()
+        self.assertFalse(hydrate_pending_clients())
+        self.assertEqual(set(event_queue.clients), queue_ids)
+
+    def test_load_legacy_format(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        queue_id = self.allocate(hamlet)
+        with open(self.filename, 'w') as f:
+            ujson.dump([(queue_id, get_client_descriptor(queue_id).to_dict())], f)
+
+        self.restart()
+        self.assertEqual(get_client_descriptors_for_user(hamlet.id)[0].event_queue.id, queue_id)
+
+class EventQueueGCTest(ZulipTestCase):
+    def setUp(self):
+        # type: () -> None
+        clear_client_event_queues_for_testing()
+
+    def tearDown(self):
+        # type: () -> None
+        clear_client_event_queues_for_testing()
+
+    def allocate(self, idle_secs):
+        # type: (int) -> ClientDescriptor
+        user_profile = self.example_user('hamlet')
+        return allocate_client_descriptor(dict(
+            user_profile_id=user_profile.id,
+            realm_id=user_profile.realm_id,
+            user_profile_email=user_profile.email,
+            event_types=None,
+            client_type_name='website',
+            apply_markdown=True,
+            all_public_streams=False,
+            queue_timeout=0,
+            last_connection_time=time.time() - idle_secs,
+            narrow=[]))
+
+    def test_gc_event_queues(self):
+        # type: () -> None
+        expired = self.allocate(idle_secs=1000)
+        active = self.allocate(idle_secs=0)
+        connected = self.allocate(idle_secs=1000)
+        connected.current_handler_id = 1
+        reconnected = self.allocate(idle_secs=1000)
+        reconnected.last_connection_time = time.time()
+
+        with mock.patch('zerver.tornado.event_queue.statsd') as mock_statsd:
+            gc_event_queues()
+        self.assertEqual(mock_statsd.timing.call_args[0][0], 'tornado.gc_event_queues_ms')
+        self.assertEqual(set(event_queue.clients), {active.event_queue.id,
+                                                    connected.event_queue.id,
+                                                    reconnected.event_queue.id})
+        # Connected queues are re-added to the index on disconnect.
+        self.assertEqual(event_queue.gc_indexed_queue_ids, {active.event_queue.id,
+                                                            reconnected.event_queue.id})
+        with mock.patch('zerver.tornado.event_queue.clear_handler_by_id'), \
+                mock.patch('zerver.tornado.event_queue.clear_descriptor_by_handler_id'):
+            connected.disconnect_handler()
+        self.assertIn(connected.event_queue.id, event_queue.gc_indexed_queue_ids)
+
+        gc_event_queues()
+        self.assertEqual(set(event_queue.clients), {active.event_queue.id,
+                                                    reconnected.event_queue.id})
+        self.assertEqual(len(event_queue.gc_index), 2)
+
+class EventQueueLimitsTest(ZulipTestCase):
+    def message_event(self, content):
+        # type: (str) -> Dict[str, Any]
+        return dict(type='message', flags=[], message=SharedMessageDict(id=1, type='stream',
+                                                                       content=content))
+
+    @override_settings(EVENT_QUEUE_MAX_EVENTS=3)
+    def test_max_events(self):
+        # type: () -> None
+        queue = EventQueue('1')
+        queue.push(dict(type='pointer', pointer=5))
+        for i in range(3):
+            queue.push(self.message_event('hello'))
+        self.assertFalse(queue.overflowed)
+        self.assertEqual(queue.message_bytes, 3 * len(self.message_event('hello')['message'].encoded()))
+
+        queue.push(self.message_event('hello'))
+        self.assertTrue(queue.overflowed)
+        self.assertEqual(queue.message_bytes, 0)
+        queue.push(self.message_event('hello'))
+        self.assertEqual(queue.contents(), [dict(type='restart', id=5, immediate=True,
+                                                 server_generation=settings.SERVER_GENERATION)])
+
+        pm_event = dict(type='message', flags=[],
+                        message=SharedMessageDict(id=2, type='private', content='hi'))
+        queue.push(pm_event)
+
+        restored = EventQueue.from_dict(queue.to_dict())
+        self.assertTrue(restored.overflowed)
+        self.assertEqual(restored.missed_message_events(),
+                         [dict(type='message', flags=[], message=dict(id=2, type='private'))])
+        restored.prune(5)
+        self.assertTrue(restored.empty())
+
+    @override_settings(EVENT_QUEUE_MAX_BYTES=150)
+    def test_max_bytes(self):
+        # type: () -> None
+        queue = EventQueue('1')
+        queue.push(self.message_event('x' * 20))
+        queue.push(self.message_event('x' * 20))
+        queue.prune(0)
+        queue.push(self.message_event('x' * 20))
+        self.assertFalse(queue.overflowed)
+        queue.push(self.message_event('x' * 20))
+        self.assertTrue(queue.overflowed)
+
+class NarrowedClientIndexTest(ZulipTestCase):
+    def setUp(self):
+        # type: () -> None
+        clear_client_event_queues_for_testing()
+
+    def tearDown(self):
+        # type: () -> None
+        clear_client_event_queues_for_testing()
+
+    def allocate(self, narrow, all_public_streams=False):
+        # type: (List[List[str]], bool) -> ClientDescriptor
+        user_profile = self.example_user('hamlet')
+        return allocate_client_descriptor(dict(
+            user_profile_id=user_profile.id,
+            realm_id=user_profile.realm_id,
+            user_profile_email=user_profile.email,
+            event_types=None,
+            client_type_name='website',
+            apply_markdown=True,
+            all_public_streams=all_public_streams,
+            queue_timeout=0,
+            last_connection_time=time.time(),
+            narrow=narrow))
+
+    def test_realm_stream_index(self):
+        # type: () -> None
+        realm_id = self.example_user('hamlet').realm_id
+        denmark = self.allocate([['stream', 'Denmark'], ['topic', 'lunch']])
+        verona = self.allocate([['stream', 'Verona']])
+        mentioned = self.allocate([['is', 'mentioned']])
+        everything = self.allocate([], all_public_streams=True)
+
+        self.assertEqual(get_client_descriptors_for_realm_stream(realm_id, 'DENMARK'), [denmark])
+        self.assertEqual(get_client_descriptors_for_realm_stream(realm_id, 'Scotland'), [])
+        self.assertEqual(get_client_descriptors_for_realm_all_streams(realm_id),
+                         [mentioned, everything])
+
+        do_gc_event_queues({denmark.event_queue.id}, {denmark.user_profile_id}, {realm_id})
+        self.assertEqual(get_client_descriptors_for_realm_stream(realm_id, 'Denmark'), [])
+        self.assertEqual(event_queue.realm_stream_clients, {(realm_id, 'verona'): [verona]})
@@ -1,19 +1,27 @@
 # -*- coding: utf-8 -*-
 
 import mock
+import socket
+import threading
+import time
 import ujson
-from typing import Any
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Any, Dict, List
 from requests.exceptions import ConnectionError
 from django.test import override_settings
 
 from zerver.models import Recipient, Message
+from zerver.lib import bugdown
+from zerver.lib.cache import cache_get
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import MockPythonResponse
 from zerver.worker.queue_processors import FetchLinksEmbedData
+from zerver.lib.url_preview import preview
 from zerver.lib.url_preview.preview import get_link_embed_data
 from zerver.lib.url_preview.oembed import get_oembed_data
 from zerver.lib.url_preview.parsers import (
-    OpenGraphParser, GenericParser)
+    OpenGraphParser, GenericParser, HeadMetadataParser)
 
 
 TEST_CACHES = {
@@ -151,6 +159,63 @@ class GenericParserTestCase(ZulipTestCase):
         self.assertIsNone(result.get('description'))
 
 
+class HeadMetadataParserTestCase(ZulipTestCase):
+    html = u"""<html>
+      <head>
+        <title>The Rock &amp; Alcatraz</title>
+        <meta name="description" content="A film" />
+        <meta property="og:title" content="The Rock" />
+        <meta property="og:image" content="http://ia.media-imdb.com/images/rock.jpg">
+      </head>
+      <body>
+        <h1>Main header</h1>
+        <p>Description text</p>
+        %s
+      </body>
+    </html>"""
+
+    def test_parser(self):
+        # type: () -> None
+        parser = HeadMetadataParser()
+        html = self.html % ('',)
+        for i in range(0, len(html), 10):
+            parser.feed(html[i:i + 10])
+            if parser.done:
+                break
+        self.assertLess(i, html.index('<h1>'))
+        self.assertEqual(parser.title, 'The Rock & Alcatraz')
+        self.assertEqual(parser.description, 'A film')
+        self.assertEqual(parser.open_graph, {
+            'title': 'The Rock',
+            'image': 'http://ia.media-imdb.com/images/rock.jpg'})
+
+    def test_get_link_embed_data_reads_only_head(self):
+        # type: () -> None
+        url = 'http://test.org/'
+        response = MockPythonResponse(self.html % ('<p>filler</p>' * 100000,), 200)
+        with self.settings(CACHES=TEST_CACHES), \
+                mock.patch('requests.Session.get', return_value=response), \
+                mock.patch('zerver.lib.url_preview.preview.get_oembed_data', return_value=None), \
+                mock.patch('zerver.lib.url_preview.preview.GenericParser') as generic_parser:
+            data = get_link_embed_data(url)
+        generic_parser.assert_not_called()
+        self.assertEqual(data, {
+            'title': 'The Rock',
+            'description': 'A film',
+            'image': 'http://ia.media-imdb.com/images/rock.jpg'})
+
+        # Without an og:image, we look through the whole page for one.
+        url = 'http://test.org/noimage'
+        html = (self.html % ('',)).replace('og:image', 'og:video')
+        html = html.replace('</h1>', '</h1><img src="http://test.org/main.jpg">')
+        with self.settings(CACHES=TEST_CACHES), \
+                mock.patch('requests.Session.get', return_value=MockPythonResponse(html, 200)), \
+                mock.patch('zerver.lib.url_preview.preview.get_oembed_data', return_value=None):
+            data = get_link_embed_data(url)
+        self.assertEqual(data['image'], 'http://test.org/main.jpg')
+        self.assertEqual(data['title'], 'The Rock')
+
+
 class PreviewTestCase(ZulipTestCase):
     open_graph_html = """
           <html>
@@ -179,7 +244,7 @@ class PreviewTestCase(ZulipTestCase):
         url = 'http://test.org/'
         response = MockPythonResponse(self.open_graph_html, 200)
         mocked_response = mock.Mock(
-            side_effect=lambda k: {url: response}.get(k, MockPythonResponse('', 404)))
+            side_effect=lambda k, **kwargs: {url: response}.get(k, MockPythonResponse('', 404)))
 
         with mock.patch('zerver.views.messages.queue_json_publish') as patched:
             result = self.client_patch("/json/messages/" + str(msg_id), {
@@ -192,7 +257,8 @@ class PreviewTestCase(ZulipTestCase):
             event = patched.call_args[0][1]
 
         with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
-            with mock.patch('requests.get', mocked_response):
+            with mock.patch('requests.get', mocked_response), \
+                    mock.patch('requests.Session.get', mocked_response):
                 FetchLinksEmbedData().consume(event)
 
         embedded_link = '<a href="{0}" target="_blank" title="The Rock">The Rock</a>'.format(url)
@@ -229,11 +295,12 @@ class PreviewTestCase(ZulipTestCase):
         if relative_url is True:
             response = MockPythonResponse(self.open_graph_html.replace('http://ia.media-imdb.com', ''), 200)
         mocked_response = mock.Mock(
-            side_effect=lambda k: {url: response}.get(k, MockPythonResponse('', 404)))
+            side_effect=lambda k, **kwargs: {url: response}.get(k, MockPythonResponse('', 404)))
 
         # Run the queue processor to potentially rerender things
         with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
-            with mock.patch('requests.get', mocked_response):
+            with mock.patch('requests.get', mocked_response), \
+                    mock.patch('requests.Session.get', mocked_response):
                 FetchLinksEmbedData().consume(event)
         msg = Message.objects.select_related("sender").get(id=msg_id)
         return msg
@@ -291,7 +358,8 @@ class PreviewTestCase(ZulipTestCase):
             'message_realm_id': msg.sender.realm_id,
             'message_content': url}
         with self.settings(INLINE_URL_EMBED_PREVIEW=True, TEST_SUITE=False, CACHES=TEST_CACHES):
-            with mock.patch('requests.get', mock.Mock(side_effect=ConnectionError())):
+            with mock.patch('requests.get', mock.Mock(side_effect=ConnectionError())), \
+                    mock.patch('requests.Session.get', mock.Mock(side_effect=ConnectionError())):
                 with mock.patch('logging.error') as error_mock:
                     FetchLinksEmbedData().consume(event)
         self.assertEqual(error_mock.call_count, 1)
@@ -305,3 +373,107 @@ class PreviewTestCase(ZulipTestCase):
         with self.settings(INLINE_URL_EMBED_PREVIEW=True, TEST_SUITE=False, CACHES=TEST_CACHES):
             self.assertIsNone(get_link_embed_data('com.notvalidlink'))
             self.assertIsNone(get_link_embed_data(u'μένει.com.notvalidlink'))
+
+class StubPreviewServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # type: (Any, Any) -> None
+        # E.g. we stopped reading /huge partway through.
+        pass
+
+class FetchLinkPreviewDataTest(ZulipTestCase):
+    def test_fetch_from_stub_server(self):
+        # type: () -> None
+        requested_paths = []  # type: List[str]
+        active = {'now': 0, 'max': 0}  # type: Dict[str, int]
+        lock = threading.Lock()
+        page = (u'<html><head><meta property="og:title" content="The Rock" />'
+                u'<meta property="og:description" content="Alcatraz" /></head>'
+                u'<body>%s</body></html>')
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                # type: () -> None
+                with lock:
+                    requested_paths.append(self.path)
+                    active['now'] += 1
+                    active['max'] = max(active['max'], active['now'])
+                time.sleep(0.05)
+                with lock:
+                    active['now'] -= 1
+                if self.path == '/missing':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if self.path == '/huge':
+                    body = page % ('x' * (2 * preview.PREVIEW_MAX_RESPONSE_BYTES),)
+                else:
+                    body = page % ('',)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.end_headers()
+                self.wfile.write(body.encode('utf-8'))
+
+            def log_message(self, *args):
+                # type: (*Any) -> None
+                pass
+
+        server = StubPreviewServer(('127.0.0.1', 0), Handler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        base_url = 'http://127.0.0.1:%s' % (server.server_address[1],)
+
+        # A port nothing listens on.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        closed_url = 'http://127.0.0.1:%s/' % (sock.getsockname()[1],)
+        sock.close()
+
+        urls = [base_url + '/page%s' % (i,) for i in range(6)]
+        try:
+            with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES), \
+                    mock.patch('zerver.lib.url_preview.preview.get_oembed_data', return_value=None), \
+                    mock.patch('logging.warning') as warning_mock:
+                bugdown.fetch_link_preview_data_many(
+                    urls + urls + [base_url + '/huge', base_url + '/missing', closed_url],
+                    threads=4)
+
+                # Each URL is fetched once, no more than
+                # PREVIEW_DOMAIN_CONCURRENCY at a time.
+                self.assertEqual(sorted(requested_paths),
+                                 sorted(['/page%s' % (i,) for i in range(6)] + ['/huge', '/missing']))
+                self.assertLessEqual(active['max'], preview.PREVIEW_DOMAIN_CONCURRENCY)
+                # We drop the semaphores once we're done with a site.
+                self.assertEqual(preview.domain_semaphores, {})
+
+                for url in urls + [base_url + '/huge']:
+                    data = cache_get(preview.cache_key_func(url), cache_name='database')[0]
+                    self.assertEqual(data['title'], 'The Rock')
+                    self.assertEqual(data['description'], 'Alcatraz')
+                self.assertEqual(cache_get(preview.cache_key_func(base_url + '/missing'),
+                                           cache_name='database'), ({},))
+
+                # We remember the failure, so we don't fetch it again.
+                self.assertEqual(warning_mock.call_count, 1)
+                self.assertEqual(cache_get(preview.cache_key_func(closed_url),
+                                           cache_name='database'), (None,))
+                bugdown.fetch_link_preview_data_many([closed_url])
+                self.assertEqual(warning_mock.call_count, 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_consume_batch_after_fetch_error(self):
+        # type: () -> None
+        events = [{'message_id': 1, 'urls': ['http://example.com/']},
+                  {'message_id': 2, 'urls': []}]
+        worker = FetchLinksEmbedData()
+        with mock.patch('zerver.lib.bugdown.fetch_link_preview_data_many',
+                        side_effect=Exception('fetch failed')), \
+                mock.patch('logging.exception') as exception_mock, \
+                mock.patch.object(worker, 'consume_wrapper') as consume_mock:
+            worker.consume_batch(events)
+        exception_mock.assert_called_once()
+        self.assertEqual([call[0][0] for call in consume_mock.call_args_list], events)
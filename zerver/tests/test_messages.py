@@ -13,6 +13,8 @@ from zerver.lib.str_utils import force_text
 from zerver.lib.addressee import Addressee
 
 from zerver.lib.actions import (
+    create_user_messages,
+    do_delete_message,
     do_send_messages,
     get_active_presence_idle_user_ids,
     get_user_info_for_message_updates,
@@ -60,6 +62,7 @@ from zerver.lib.actions import (
     do_add_alert_words,
 )
 
+from zerver.lib.topic_history import update_topic_history
 from zerver.lib.upload import create_attachment
 
 from zerver.views.messages import create_mirrored_message_users
@@ -103,6 +106,7 @@ class TopicHistoryTest(ZulipTestCase):
                 message=message,
                 flags=0,
             )
+            update_topic_history([message])
 
             return message.id
 
@@ -144,6 +148,63 @@ class TopicHistoryTest(ZulipTestCase):
             topic2_msg_id,
         ])
 
+    def get_topic_history(self, stream_name):
+        # type: (Text) -> List[Dict[str, Any]]
+        stream = get_stream(stream_name, get_realm('zulip'))
+        result = self.client_get('/json/users/me/%d/topics' % (stream.id,))
+        self.assert_json_success(result)
+        return result.json()['topics']
+
+    def test_topics_history_after_edit_and_delete(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        self.login(hamlet.email)
+        id1 = self.send_message(hamlet.email, "Verona", Recipient.STREAM, subject="topic1")
+        id2 = self.send_message(hamlet.email, "Verona", Recipient.STREAM, subject="topic2")
+        id3 = self.send_message(hamlet.email, "Verona", Recipient.STREAM, subject="TOPIC1")
+
+        self.assertEqual(self.get_topic_history("Verona")[:2], [
+            dict(name='TOPIC1', max_id=id3),
+            dict(name='topic2', max_id=id2),
+        ])
+
+        # Moving the latest message in a topic makes the previous one
+        # the latest, with its spelling of the topic name.
+        result = self.client_patch("/json/messages/" + str(id3), {
+            'message_id': id3,
+            'subject': 'topic2',
+            'propagate_mode': 'change_one',
+        })
+        self.assert_json_success(result)
+        self.assertEqual(self.get_topic_history("Verona")[:2], [
+            dict(name='topic2', max_id=id3),
+            dict(name='topic1', max_id=id1),
+        ])
+
+        # Deleting the last message in a topic removes the topic.
+        do_delete_message(hamlet, Message.objects.get(id=id1))
+        history = self.get_topic_history("Verona")
+        self.assertEqual(history[0], dict(name='topic2', max_id=id3))
+        self.assertNotIn('topic1', [topic['name'].lower() for topic in history])
+
+    def test_topics_history_private_stream(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        iago = self.example_user('iago')
+        self.make_stream('private_stream', invite_only=True)
+        self.subscribe(hamlet, 'private_stream')
+        self.send_message(hamlet.email, 'private_stream', Recipient.STREAM, subject="before")
+
+        # Subscribers to a private stream only see the topics of
+        # messages they received.
+        self.subscribe(iago, 'private_stream')
+        message_id = self.send_message(hamlet.email, 'private_stream', Recipient.STREAM,
+                                       subject="after")
+        self.login(iago.email)
+        self.assertEqual(self.get_topic_history('private_stream'), [
+            dict(name='after', max_id=message_id),
+        ])
+
     def test_bad_stream_id(self):
         # type: () -> None
         email = self.example_email("iago")
@@ -404,6 +465,13 @@ class PersonalMessagesTest(ZulipTestCase):
         self.assertEqual(most_recent_message(sender).recipient, recipient)
         self.assertEqual(most_recent_message(receiver).recipient, recipient)
 
+        # Both UserMessage rows are flagged is_private, which we
+        # don't show to clients.
+        for user_profile in [sender, receiver]:
+            user_message = most_recent_usermessage(user_profile)
+            self.assertTrue(user_message.flags.is_private)
+            self.assertNotIn('is_private', user_message.flags_list())
+
     def test_personal(self):
         # type: () -> None
         """
@@ -565,7 +633,7 @@ class StreamMessagesTest(ZulipTestCase):
         a lot of code to generate messages with markdown and without
         markdown.
         '''
-        self.assert_length(queries, 15)
+        self.assert_length(queries, 16)
 
     def test_stream_message_dict(self):
         # type: () -> None
@@ -721,6 +789,77 @@ class StreamMessagesTest(ZulipTestCase):
         """
         self.assert_stream_message("Scotland")
 
+    @override_settings(USERMESSAGE_COPY_THRESHOLD=1)
+    def test_message_to_stream_via_copy(self):
+        # type: () -> None
+        """
+        Large stream messages get their UserMessage rows via COPY
+        rather than INSERT; the result should be identical.
+        """
+        self.assert_stream_message("Scotland")
+
+        sender = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        self.subscribe(sender, "Scotland")
+        self.subscribe(cordelia, "Scotland")
+        self.send_message(sender.email, "Scotland", Recipient.STREAM,
+                          content="@**Cordelia Lear** hello")
+        message = most_recent_message(cordelia)
+        um = UserMessage.objects.get(user_profile=cordelia, message=message)
+        self.assertEqual(um.flags_list(), ['mentioned'])
+
+    def test_create_user_messages(self):
+        # type: () -> None
+        sender = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        othello = self.example_user('othello')
+        iago = self.example_user('iago')
+        stream = get_stream('Denmark', sender.realm)
+        recipient = get_recipient(Recipient.STREAM, stream.id)
+
+        message = Message(
+            id=12345,
+            sender=sender,
+            recipient=recipient,
+            subject='batch',
+            content='whatever',
+            pub_date=timezone_now(),
+            sending_client=make_client(name="website"),
+        )
+        message.mentions_wildcard = False
+        message.user_ids_with_alert_words = {othello.id}
+
+        batch = create_user_messages(
+            message=message,
+            um_eligible_user_ids={sender.id, cordelia.id, othello.id, iago.id},
+            long_term_idle_user_ids={othello.id, iago.id},
+            mentioned_user_ids={cordelia.id},
+        )
+
+        # iago is long-term idle and has no flags, so gets no row.
+        self.assertEqual(list(batch.user_ids), sorted([sender.id, cordelia.id, othello.id]))
+        self.assertEqual(sorted(batch.rows()), sorted([
+            (sender.id, 12345, int(UserMessage.flags.read)),
+            (cordelia.id, 12345, int(UserMessage.flags.mentioned)),
+            (othello.id, 12345, int(UserMessage.flags.has_alert_word)),
+        ]))
+        self.assertEqual(batch.nonzero_flags_lists(), {
+            sender.id: ['read'],
+            cordelia.id: ['mentioned'],
+            othello.id: ['has_alert_word'],
+        })
+
+        # With a wildcard mention, every eligible user gets a row.
+        message.mentions_wildcard = True
+        batch = create_user_messages(
+            message=message,
+            um_eligible_user_ids={sender.id, cordelia.id, othello.id, iago.id},
+            long_term_idle_user_ids={othello.id, iago.id},
+            mentioned_user_ids=set(),
+        )
+        self.assertEqual(len(batch), 4)
+        self.assertEqual(batch.nonzero_flags_lists()[iago.id], ['wildcard_mentioned'])
+
     def test_non_ascii_stream_message(self):
         # type: () -> None
         """
@@ -792,7 +931,7 @@ class MessageDictTest(ZulipTestCase):
         # slower.
         error_msg = "Number of ids: {}. Time delay: {}".format(num_ids, delay)
         self.assertTrue(delay < 0.0015 * num_ids, error_msg)
-        self.assert_length(queries, 6)
+        self.assert_length(queries, 5)
         self.assertEqual(len(rows), num_ids)
 
     def test_applying_markdown(self):
@@ -884,6 +1023,11 @@ class MessageDictTest(ZulipTestCase):
         self.assertEqual(msg_dict['reactions'][0]['user']['full_name'],
                          sender.full_name)
 
+        # Messages without reactions get an empty list.
+        Reaction.objects.filter(message=message).delete()
+        row = MessageDict.get_raw_db_rows([message.id])[0]
+        self.assertEqual(row['reactions'], [])
+
 
 class SewMessageAndReactionTest(ZulipTestCase):
     def test_sew_messages_and_reaction(self):
@@ -2159,6 +2303,21 @@ class StarTests(ZulipTestCase):
         ).order_by("id").reverse()[0]
         self.assertEqual(sent_message.message.content, content)
         self.assertFalse(sent_message.flags.starred)
+        self.assertFalse(sent_message.flags.is_private)
+
+    def test_change_non_api_flag(self):
+        # type: () -> None
+        """
+        Clients can't change the flags we maintain on the server.
+        """
+        self.login(self.example_email("hamlet"))
+        message_id = self.send_message(self.example_email("hamlet"), "Verona",
+                                       Recipient.STREAM, "test")
+        result = self.client_post("/json/messages/flags",
+                                  {"messages": ujson.dumps([message_id]),
+                                   "op": "add",
+                                   "flag": "is_private"})
+        self.assert_json_error(result, "Invalid flag: 'is_private'")
 
 class AttachmentTest(ZulipTestCase):
     def test_basics(self):
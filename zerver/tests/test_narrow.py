@@ -18,6 +18,7 @@ from zerver.lib.message import (
 )
 from zerver.lib.narrow import (
     build_narrow_filter,
+    narrow_stream_name,
 )
 from zerver.lib.request import JsonableError
 from zerver.lib.str_utils import force_bytes
@@ -35,7 +36,7 @@ from zerver.lib.topic_mutes import (
 )
 from zerver.views.messages import (
     exclude_muting_conditions,
-    get_messages_backend, ok_to_include_history,
+    get_messages_backend, highlight_string, ok_to_include_history,
     NarrowBuilder, BadNarrowOperator, Query,
     LARGER_THAN_MAX_MESSAGE_ID,
 )
@@ -99,12 +100,12 @@ class NarrowBuilderTest(ZulipTestCase):
     def test_add_term_using_is_operator_and_private_operand(self):
         # type: () -> None
         term = dict(operator='is', operand='private')
-        self._do_add_term_test(term, 'WHERE type = :type_1 OR type = :type_2')
+        self._do_add_term_test(term, 'WHERE (flags & :flags_1) != :param_1')
 
     def test_add_term_using_is_operator_private_operand_and_negated(self):  # NEGATED
         # type: () -> None
         term = dict(operator='is', operand='private', negated=True)
-        self._do_add_term_test(term, 'WHERE NOT (type = :type_1 OR type = :type_2)')
+        self._do_add_term_test(term, 'WHERE (flags & :flags_1) = :param_1')
 
     def test_add_term_using_is_operator_and_non_private_operand(self):
         # type: () -> None
@@ -387,6 +388,20 @@ class BuildNarrowFilterTest(TestCase):
         with self.assertRaises(JsonableError):
             build_narrow_filter(["invalid_operator", "operand"])
 
+    def test_build_narrow_filter_case_insensitive(self):
+        # type: () -> None
+        narrow_filter = build_narrow_filter([['stream', 'Devel'], ['topic', 'bark']])
+        event = dict(message=dict(type='stream', display_recipient='devel', subject='BARK'),
+                     flags=[])
+        self.assertTrue(narrow_filter(event))
+        event['message']['subject'] = 'bark!'
+        self.assertFalse(narrow_filter(event))
+
+    def test_narrow_stream_name(self):
+        # type: () -> None
+        self.assertEqual(narrow_stream_name([['is', 'private']]), None)
+        self.assertEqual(narrow_stream_name([['topic', 'bark'], ['stream', 'Devel']]), 'devel')
+
 class IncludeHistoryTest(ZulipTestCase):
     def test_ok_to_include_history(self):
         # type: () -> None
@@ -566,6 +581,31 @@ class GetOldMessagesTest(ZulipTestCase):
             for message in result["messages"]:
                 self.assertEqual(dr_emails(message['display_recipient']), emails)
 
+    def test_get_messages_with_narrow_is_private(self):
+        # type: () -> None
+        """
+        A request for old messages with an is:private narrow returns all of
+        the user's private and group-private messages, including those
+        created by populate_db for the test database.
+        """
+        me = self.example_email('hamlet')
+        self.send_message(me, self.example_email("iago"), Recipient.PERSONAL)
+        self.send_message(self.example_email("iago"), [me, self.example_email("cordelia")],
+                          Recipient.HUDDLE)
+        self.send_message(me, "Verona", Recipient.STREAM)
+
+        expected_ids = [m.id for m in get_user_messages(self.example_user('hamlet'))
+                        if m.recipient.type in [Recipient.PERSONAL, Recipient.HUDDLE]]
+        self.assertGreater(len(expected_ids), 2)
+
+        self.login(me)
+        narrow = [dict(operator='is', operand='private')]
+        result = self.get_and_check_messages(dict(narrow=ujson.dumps(narrow),
+                                                  anchor=0, num_before=0,
+                                                  num_after=len(expected_ids) + 10))
+        self.assertEqual([message['id'] for message in result['messages']],
+                         sorted(expected_ids))
+
     def test_get_messages_with_narrow_group_pm_with(self):
         # type: () -> None
         """
@@ -614,6 +654,30 @@ class GetOldMessagesTest(ZulipTestCase):
             self.assertEqual(message["type"], "stream")
             self.assertEqual(message["recipient_id"], stream_id)
 
+    def test_get_messages_with_narrow_stream_history(self):
+        # type: () -> None
+        """
+        Stream narrows include messages sent before the user subscribed,
+        flagged as historical; the flags come from the same query.
+        """
+        self.login(self.example_email('hamlet'))
+        self.make_stream('history')
+        self.subscribe(self.example_user("othello"), 'history')
+        old_message_id = self.send_message(self.example_email("othello"), "history", Recipient.STREAM)
+        self.subscribe(self.example_user("hamlet"), 'history')
+        new_message_id = self.send_message(self.example_email("othello"), "history", Recipient.STREAM)
+
+        narrow = [dict(operator='stream', operand='history')]
+        result = self.get_and_check_messages(dict(narrow=ujson.dumps(narrow),
+                                                  anchor=new_message_id,
+                                                  num_before=10,
+                                                  num_after=0))
+        flags = {message['id']: message['flags'] for message in result['messages']}
+        self.assertEqual(flags, {
+            old_message_id: ['read', 'historical'],
+            new_message_id: [],
+        })
+
     def test_get_messages_with_narrow_stream_mit_unicode_regex(self):
         # type: () -> None
         """
@@ -1211,8 +1275,10 @@ class GetOldMessagesTest(ZulipTestCase):
                 return
         raise AssertionError("get_messages query not found")
 
+    @override_settings(RECENT_WINDOW_SIZE=0)
     def test_use_first_unread_anchor_with_some_unread_messages(self):
         # type: () -> None
+        # With the recent window cache disabled, so that we query the database.
         user_profile = self.example_user('hamlet')
 
         # Have Othello send messages to Hamlet that he hasn't read.
@@ -1248,8 +1314,10 @@ class GetOldMessagesTest(ZulipTestCase):
         cond = 'WHERE user_profile_id = %d AND message_id <= %d' % (user_profile.id, last_message_id_to_hamlet - 1)
         self.assertIn(cond, sql)
 
+    @override_settings(RECENT_WINDOW_SIZE=0)
     def test_use_first_unread_anchor_with_no_unread_messages(self):
         # type: () -> None
+        # With the recent window cache disabled, so that we query the database.
         user_profile = self.example_user('hamlet')
 
         query_params = dict(
@@ -1439,7 +1507,7 @@ class GetOldMessagesTest(ZulipTestCase):
                                               'narrow': '[["sender", "%s"]]' % (self.example_email("othello"),)},
                                              sql)
 
-        sql_template = 'SELECT anon_1.message_id \nFROM (SELECT id AS message_id \nFROM zerver_message \nWHERE recipient_id = {scotland_recipient} AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
+        sql_template = 'SELECT anon_1.message_id, anon_1.flags \nFROM (SELECT zerver_message.id AS message_id, flags \nFROM zerver_message LEFT OUTER JOIN zerver_usermessage ON zerver_usermessage.message_id = zerver_message.id AND zerver_usermessage.user_profile_id = {hamlet_id} \nWHERE recipient_id = {scotland_recipient} AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
         sql = sql_template.format(**query_ids)
         self.common_check_get_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                               'narrow': '[["stream", "Scotland"]]'},
@@ -1451,7 +1519,7 @@ class GetOldMessagesTest(ZulipTestCase):
                                               'narrow': '[["topic", "blah"]]'},
                                              sql)
 
-        sql_template = "SELECT anon_1.message_id \nFROM (SELECT id AS message_id \nFROM zerver_message \nWHERE recipient_id = {scotland_recipient} AND upper(subject) = upper('blah') AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
+        sql_template = "SELECT anon_1.message_id, anon_1.flags \nFROM (SELECT zerver_message.id AS message_id, flags \nFROM zerver_message LEFT OUTER JOIN zerver_usermessage ON zerver_usermessage.message_id = zerver_message.id AND zerver_usermessage.user_profile_id = {hamlet_id} \nWHERE recipient_id = {scotland_recipient} AND upper(subject) = upper('blah') AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
         sql = sql_template.format(**query_ids)
         self.common_check_get_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                               'narrow': '[["stream", "Scotland"], ["topic", "blah"]]'},
@@ -1475,24 +1543,35 @@ class GetOldMessagesTest(ZulipTestCase):
         # type: () -> None
         query_ids = self.get_query_ids()
 
-        sql_template = "SELECT anon_1.message_id, anon_1.flags, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.subject_matches \nFROM (SELECT message_id, flags, subject, rendered_content, ts_match_locs_array('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS subject_matches \nFROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \nWHERE user_profile_id = {hamlet_id} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) AND message_id >= 0 ORDER BY message_id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"  # type: Text
+        sql_template = "SELECT anon_1.message_id, anon_1.flags, zerver_message.subject, zerver_message.rendered_content, ts_match_locs_array('zulip.english_us_search', zerver_message.rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(zerver_message.subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS subject_matches \nFROM (SELECT message_id, flags \nFROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \nWHERE user_profile_id = {hamlet_id} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) AND message_id >= 0 ORDER BY message_id ASC \n LIMIT 10) AS anon_1 JOIN zerver_message ON zerver_message.id = anon_1.message_id ORDER BY message_id ASC"  # type: Text
         sql = sql_template.format(**query_ids)
         self.common_check_get_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                               'narrow': '[["search", "jumping"]]'},
                                              sql)
 
-        sql_template = "SELECT anon_1.message_id, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.subject_matches \nFROM (SELECT id AS message_id, subject, rendered_content, ts_match_locs_array('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS subject_matches \nFROM zerver_message \nWHERE recipient_id = {scotland_recipient} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
+        sql_template = "SELECT anon_1.message_id, anon_1.flags, zerver_message.subject, zerver_message.rendered_content, ts_match_locs_array('zulip.english_us_search', zerver_message.rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(zerver_message.subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS subject_matches \nFROM (SELECT zerver_message.id AS message_id, flags \nFROM zerver_message LEFT OUTER JOIN zerver_usermessage ON zerver_usermessage.message_id = zerver_message.id AND zerver_usermessage.user_profile_id = {hamlet_id} \nWHERE recipient_id = {scotland_recipient} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 JOIN zerver_message ON zerver_message.id = anon_1.message_id ORDER BY message_id ASC"
         sql = sql_template.format(**query_ids)
         self.common_check_get_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                               'narrow': '[["stream", "Scotland"], ["search", "jumping"]]'},
                                              sql)
 
-        sql_template = 'SELECT anon_1.message_id, anon_1.flags, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.subject_matches \nFROM (SELECT message_id, flags, subject, rendered_content, ts_match_locs_array(\'zulip.english_us_search\', rendered_content, plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AS content_matches, ts_match_locs_array(\'zulip.english_us_search\', escape_html(subject), plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AS subject_matches \nFROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \nWHERE user_profile_id = {hamlet_id} AND (content ILIKE \'%jumping%\' OR subject ILIKE \'%jumping%\') AND (search_tsvector @@ plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AND message_id >= 0 ORDER BY message_id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
+        sql_template = 'SELECT anon_1.message_id, anon_1.flags, zerver_message.subject, zerver_message.rendered_content, ts_match_locs_array(\'zulip.english_us_search\', zerver_message.rendered_content, plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AS content_matches, ts_match_locs_array(\'zulip.english_us_search\', escape_html(zerver_message.subject), plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AS subject_matches \nFROM (SELECT message_id, flags \nFROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \nWHERE user_profile_id = {hamlet_id} AND (content ILIKE \'%jumping%\' OR subject ILIKE \'%jumping%\') AND (search_tsvector @@ plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AND message_id >= 0 ORDER BY message_id ASC \n LIMIT 10) AS anon_1 JOIN zerver_message ON zerver_message.id = anon_1.message_id ORDER BY message_id ASC'
         sql = sql_template.format(**query_ids)
         self.common_check_get_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                               'narrow': '[["search", "\\"jumping\\" quickly"]]'},
                                              sql)
 
+    def test_highlight_string(self):
+        # type: () -> None
+        self.assertEqual(highlight_string(u'<p>jumping jack</p>', [(3, 7)]),
+                         u'<p><span class="highlight">jumping</span> jack</p>')
+        # Matches inside a tag, like in a link's URL, aren't highlighted.
+        self.assertEqual(highlight_string(u'<a href="/jumping">jumping</a>', [(10, 7), (19, 7)]),
+                         u'<a href="/jumping"><span class="highlight">jumping</span></a>')
+        self.assertEqual(highlight_string(u'jumping <b>jumping</b> jumping', [(0, 7), (11, 7), (23, 7)]),
+                         u'<span class="highlight">jumping</span> <b><span class="highlight">jumping</span></b> '
+                         u'<span class="highlight">jumping</span>')
+
     @override_settings(USING_PGROONGA=False)
     def test_get_messages_with_search_using_email(self):
         # type: () -> None
@@ -3,6 +3,7 @@
 from typing import Any, Dict, List, Mapping, Text
 
 from django.db import connection
+from django.test import override_settings
 
 from zerver.models import (
     get_realm,
@@ -20,8 +21,11 @@ from zerver.lib.fix_unreads import (
     fix_pre_pointer,
     fix_unsubscribed,
 )
+from zerver.lib.recent_window import RecentWindow, extend_recent_window, \
+    fetch_recent_window
 from zerver.lib.test_helpers import (
     get_subscription,
+    queries_captured,
     tornado_redirected_to_list,
 )
 from zerver.lib.test_classes import (
@@ -459,3 +463,103 @@ class FixUnreadTests(ZulipTestCase):
         assert_unread(um_muted_stream_id)
         assert_unread(um_post_pointer_id)
         assert_read(um_unsubscribed_id)
+
+class RecentWindowTest(ZulipTestCase):
+    def test_recent_window(self):
+        # type: () -> None
+        read = int(UserMessage.flags.read)
+        rows = [(10, read, 1, u'a'), (11, 0, 2, u'muted'), (12, 0, 1, u'b'), (13, read, 1, u'a')]
+        window = RecentWindow(rows, complete=False)
+
+        self.assertTrue(window.covers(10))
+        self.assertTrue(window.covers(20))
+        self.assertFalse(window.covers(9))
+
+        is_muted = lambda recipient_id, topic: topic == 'muted'
+        self.assertEqual(window.first_unread_message_id(0, is_muted), 12)
+        self.assertEqual(window.first_unread_message_id(13, is_muted), None)
+
+        self.assertEqual(window.get_rows(11, 2, 1), [(10, read), (11, 0), (12, 0)])
+        self.assertEqual(window.get_rows(13, 1, 5), [(13, read)])
+        # We don't know about messages before the window...
+        self.assertEqual(window.get_rows(11, 3, 0), None)
+        # ...unless it's all of the user's messages.
+        window = RecentWindow(rows, complete=True)
+        self.assertEqual(window.get_rows(11, 3, 0), [(10, read), (11, 0)])
+
+    def test_extend_recent_window(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        for i in range(3):
+            self.send_message(self.example_email("othello"), "Verona", Recipient.STREAM)
+        window = fetch_recent_window(hamlet.id, 2)
+        self.assertFalse(window.complete)
+        self.assertFalse(extend_recent_window(hamlet.id, window, 2))
+
+        message_ids = [self.send_message(self.example_email("othello"), "Verona", Recipient.STREAM)
+                       for i in range(3)]
+        self.assertTrue(extend_recent_window(hamlet.id, window, 2))
+        self.assertEqual([row[0] for row in window.rows], message_ids[-2:])
+        self.assertEqual(window.rows, fetch_recent_window(hamlet.id, 2).rows)
+
+    def test_home_view_from_recent_window(self):
+        # type: () -> None
+        self.login(self.example_email("hamlet"))
+        self.client_post("/json/mark_all_as_read")
+        first_message_id = self.send_message(self.example_email("othello"), "Verona",
+                                             Recipient.STREAM, "first")
+        # The window needs to have the messages after the pointer.
+        self.client_post("/json/users/me/pointer", {"pointer": first_message_id})
+
+        messages = self.get_messages(anchor=0, num_before=0, num_after=1,
+                                     use_first_unread_anchor=True)
+        self.assertEqual([message['id'] for message in messages], [first_message_id])
+
+        # Now that the window is cached, we only look for the user's
+        # messages at the end of the window.
+        with queries_captured() as queries:
+            messages = self.get_messages(anchor=0, num_before=0, num_after=1,
+                                         use_first_unread_anchor=True)
+        self.assertEqual([message['id'] for message in messages], [first_message_id])
+        usermessage_queries = [query['sql'] for query in queries
+                               if 'zerver_usermessage' in query['sql']]
+        self.assert_length(usermessage_queries, 1)
+        self.assertIn('"zerver_usermessage"."message_id" >= ', usermessage_queries[0])
+
+        # New messages are added to the window when we read it.
+        second_message_id = self.send_message(self.example_email("othello"), "Verona",
+                                              Recipient.STREAM, "second")
+        messages = self.get_messages(anchor=0, num_before=0, num_after=2,
+                                     use_first_unread_anchor=True)
+        self.assertEqual([message['id'] for message in messages],
+                         [first_message_id, second_message_id])
+
+        # Changing flags flushes the window.
+        self.client_post("/json/messages/flags",
+                         {"messages": ujson.dumps([first_message_id]),
+                          "op": "add",
+                          "flag": "read"})
+        messages = self.get_messages(anchor=0, num_before=1, num_after=1,
+                                     use_first_unread_anchor=True)
+        self.assertEqual([message['id'] for message in messages],
+                         [first_message_id, second_message_id])
+        self.assertEqual(messages[0]['flags'], ['read'])
+        self.assertEqual(messages[1]['flags'], [])
+
+    def test_home_view_outside_recent_window(self):
+        # type: () -> None
+        """
+        If the window doesn't have the messages the fetch needs, we get
+        the same results from the database.
+        """
+        self.login(self.example_email("hamlet"))
+        message_id = self.send_message(self.example_email("othello"), "Verona", Recipient.STREAM, "test")
+        self.client_post("/json/users/me/pointer", {"pointer": message_id})
+        for num_before in [2, 20]:
+            with override_settings(RECENT_WINDOW_SIZE=0):
+                expected = self.get_messages(anchor=0, num_before=num_before, num_after=20,
+                                             use_first_unread_anchor=True)
+            with override_settings(RECENT_WINDOW_SIZE=5):
+                messages = self.get_messages(anchor=0, num_before=num_before, num_after=20,
+                                             use_first_unread_anchor=True)
+            self.assertEqual(messages, expected)
@@ -26,6 +26,7 @@ from zerver.lib.avatar import avatar_url
 from zerver.lib.email_mirror import create_missed_message_address
 from zerver.lib.send_email import send_future_email
 from zerver.lib.actions import (
+    bulk_get_recipient_info,
     get_emails_from_user_ids,
     get_recipient_info,
     do_deactivate_user,
@@ -429,6 +430,68 @@ class RecipientInfoTest(ZulipTestCase):
 
         self.assertEqual(info['stream_push_user_ids'], set())
 
+    def test_bulk_recipient_info(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        othello = self.example_user('othello')
+
+        realm = hamlet.realm
+
+        for user in [hamlet, cordelia]:
+            self.subscribe(user, 'Test Stream')
+        for user in [hamlet, othello]:
+            self.subscribe(user, 'Other Stream')
+
+        stream = get_stream('Test Stream', realm)
+        other_stream = get_stream('Other Stream', realm)
+        recipient = get_recipient(Recipient.STREAM, stream.id)
+        other_recipient = get_recipient(Recipient.STREAM, other_stream.id)
+        personal_recipient = get_recipient(Recipient.PERSONAL, othello.id)
+
+        sub = get_subscription('Test Stream', cordelia)
+        sub.push_notifications = True
+        sub.save()
+
+        add_topic_mute(
+            user_profile=cordelia,
+            stream_id=stream.id,
+            recipient_id=recipient.id,
+            topic_name='muted',
+        )
+
+        targets = [
+            (recipient, hamlet.id, StreamTopicTarget(stream_id=stream.id, topic_name='muted')),
+            (recipient, hamlet.id, StreamTopicTarget(stream_id=stream.id, topic_name='MUTED')),
+            (recipient, hamlet.id, StreamTopicTarget(stream_id=stream.id, topic_name='other')),
+            (other_recipient, hamlet.id, StreamTopicTarget(stream_id=other_stream.id, topic_name='x')),
+            (personal_recipient, hamlet.id, None),
+        ]
+
+        with queries_captured() as queries:
+            infos = bulk_get_recipient_info(targets)
+
+        # One Subscription query, one UserProfile query, and one
+        # MutedTopic query per distinct (stream, topic) pair.
+        self.assert_length(queries, 5)
+
+        expected_infos = [
+            get_recipient_info(
+                recipient=target_recipient,
+                sender_id=sender_id,
+                stream_topic=stream_topic,
+            )
+            for target_recipient, sender_id, stream_topic in targets
+        ]
+        self.assertEqual(infos, expected_infos)
+
+        self.assertEqual(infos[0]['active_user_ids'], {hamlet.id, cordelia.id})
+        self.assertEqual(infos[0]['stream_push_user_ids'], set())
+        self.assertEqual(infos[1]['stream_push_user_ids'], set())
+        self.assertEqual(infos[2]['stream_push_user_ids'], {cordelia.id})
+        self.assertEqual(infos[3]['active_user_ids'], {hamlet.id, othello.id})
+        self.assertEqual(infos[4]['active_user_ids'], {hamlet.id, othello.id})
+
 class BulkUsersTest(ZulipTestCase):
     def test_client_gravatar_option(self):
         # type: () -> None
@@ -0,0 +1,96 @@
+from typing import Any, Dict, Iterable, Mapping, Optional, Text
+
+from django.http import HttpResponse
+
+import ujson
+
+class SharedMessageDict(dict):
+    """A message dict that is shared, unchanged, by the `message`
+    events for every client that receives a given message.
+
+    A message to a big stream is added to thousands of event queues,
+    and each of those queues gets serialized separately when its
+    client fetches events.  Instances of this class cache their JSON
+    encoding, so the message body is encoded at most once per
+    apply_markdown variant, and encode_events_response splices the
+    cached encoding into each client's response.
+
+    Since the cached encoding would go stale, instances can't be
+    modified; make a (plain dict) copy with .copy() instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # type: (*Any, **Any) -> None
+        super(SharedMessageDict, self).__init__(*args, **kwargs)
+        self._encoded = None  # type: Optional[str]
+
+    def encoded(self):
+        # type: () -> str
+        if self._encoded is None:
+            self._encoded = ujson.dumps(self)
+        return self._encoded
+
+    def _immutable(self, *args, **kwargs):
+        # type: (*Any, **Any) -> None
+        raise TypeError("SharedMessageDict objects can't be modified")
+
+    __setitem__ = _immutable
+    __delitem__ = _immutable
+    clear = _immutable
+    pop = _immutable
+    popitem = _immutable
+    setdefault = _immutable
+    update = _immutable
+
+    def copy(self):
+        # type: () -> Dict[str, Any]
+        return dict(self)
+
+    def __reduce__(self):
+        # type: () -> Any
+        # Used by copy.deepcopy and pickle.
+        return (SharedMessageDict, (dict(self),))
+
+def splice_json(encoded_object, key, encoded_value):
+    # type: (str, str, str) -> str
+    """Adds `key` with an already-JSON-encoded value to the
+    JSON-encoded object `encoded_object`."""
+    assert encoded_object.endswith('}')
+    separator = '' if encoded_object == '{}' else ','
+    return encoded_object[:-1] + separator + ujson.dumps(key) + ':' + encoded_value + '}'
+
+def encode_event(event):
+    # type: (Mapping[str, Any]) -> str
+    message = event.get('message')
+    if not isinstance(message, SharedMessageDict):
+        return ujson.dumps(event)
+
+    per_client_fields = {
+        key: value
+        for key, value in event.items()
+        if key != 'message'
+    }
+    return splice_json(ujson.dumps(per_client_fields), 'message', message.encoded())
+
+def encode_events_response(response):
+    # type: (Mapping[str, Any]) -> str
+    """Equivalent to ujson.dumps(response), where response['events']
+    is a list of events, but reusing the cached encoding of any
+    SharedMessageDict payloads."""
+    events = response['events']  # type: Iterable[Mapping[str, Any]]
+    other_fields = {
+        key: value
+        for key, value in response.items()
+        if key != 'events'
+    }
+    encoded_events = '[' + ','.join(encode_event(event) for event in events) + ']'
+    return splice_json(ujson.dumps(other_fields), 'events', encoded_events)
+
+def json_events_response(res_type="success", msg="", data=None, status=200):
+    # type: (Text, Text, Optional[Dict[str, Any]], int) -> HttpResponse
+    """Like json_response, for responses containing a list of events."""
+    content = {"result": res_type, "msg": msg}
+    if data is not None:
+        content.update(data)
+    return HttpResponse(content=encode_events_response(content) + "\n",
+                        content_type='application/json', status=status)
@@ -1,13 +1,16 @@
 # See http://zulip.readthedocs.io/en/latest/events-system.html for
 # high-level documentation on how this system works.
-from typing import cast, AbstractSet, Any, Callable, Dict, List, \
-    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Text, Union
+from typing import cast, AbstractSet, Any, Callable, Dict, Iterator, List, \
+    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Text, Tuple, Union
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
 from django.utils.timezone import now as timezone_now
 from collections import deque
+import collections.abc
 import datetime
+import heapq
+import itertools
 import os
 import time
 import socket
@@ -27,12 +30,16 @@ from zerver.tornado.handlers import clear_handler_by_id, get_handler_by_id, \
     finish_handler, handler_stats_string
 from zerver.lib.utils import statsd
 from zerver.middleware import async_request_restart
-from zerver.lib.narrow import build_narrow_filter
+from zerver.lib.narrow import build_narrow_filter, narrow_stream_name
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import JsonableError
 from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
+from zerver.tornado.event_encoding import SharedMessageDict
 from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado import sharding
+from zerver.tornado.sharding import get_shards_for_realms, get_tornado_uri, \
+    get_tornado_uri_for_realm, notify_tornado_queue_name, persistent_queue_filename
 import copy
 
 requests_client = requests.Session()
@@ -48,6 +55,13 @@ for host in ['127.0.0.1', 'localhost']:
 IDLE_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 5
 
+# When the persisted event queue file contains this many times more
+# records than there are live queues, the next snapshot rewrites it.
+EVENT_QUEUE_SNAPSHOT_COMPACTION_FACTOR = 3
+# Number of queues loaded from disk to rehydrate per IOLoop iteration
+# at startup; see hydrate_pending_clients_in_background.
+EVENT_QUEUE_HYDRATE_BATCH_SIZE = 500
+
 # Capped limit for how long a client can request an event queue
 # to live
 MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
@@ -83,6 +97,7 @@ class ClientDescriptor(object):
         self._timeout_handle = None  # type: Any # TODO: should be return type of ioloop.add_timeout
         self.narrow = narrow
         self.narrow_filter = build_narrow_filter(narrow)
+        self.narrow_stream_name = narrow_stream_name(narrow)
 
         # Clamp queue_timeout to between minimum and maximum timeouts
         self.queue_timeout = max(IDLE_EVENT_QUEUE_TIMEOUT_SECS, min(self.queue_timeout, MAX_QUEUE_TIMEOUT_SECS))
@@ -137,6 +152,7 @@ class ClientDescriptor(object):
             async_request_restart(handler._request)
 
         self.event_queue.push(event)
+        changed_queue_ids.add(self.event_queue.id)
         self.finish_current_handler()
 
     def finish_current_handler(self):
@@ -166,13 +182,15 @@ class ClientDescriptor(object):
         # type: () -> bool
         return self.event_types is None or "message" in self.event_types
 
-    def idle(self, now):
-        # type: (float) -> bool
+    def expiry_time(self):
+        # type: () -> float
         if not hasattr(self, 'queue_timeout'):
             self.queue_timeout = IDLE_EVENT_QUEUE_TIMEOUT_SECS
+        return self.last_connection_time + self.queue_timeout
 
-        return (self.current_handler_id is None and
-                now - self.last_connection_time >= self.queue_timeout)
+    def idle(self, now):
+        # type: (float) -> bool
+        return self.current_handler_id is None and now >= self.expiry_time()
 
     def connect_handler(self, handler_id, client_name):
         # type: (int, Text) -> None
@@ -206,6 +224,7 @@ class ClientDescriptor(object):
             ioloop = tornado.ioloop.IOLoop.instance()
             ioloop.remove_timeout(self._timeout_handle)
             self._timeout_handle = None
+        add_to_gc_index(self)
 
     def cleanup(self):
         # type: () -> None
@@ -228,6 +247,36 @@ def compute_full_event_type(event):
         return "flags/%s/%s" % (event["operation"], event["flag"])
     return event["type"]
 
+def event_message_bytes(event):
+    # type: (Mapping[str, Any]) -> int
+    # We only account for the (shared, cached) encoded message payloads,
+    # which dominate the memory used by event queues; queues restored
+    # from disk hold plain dicts, and are only limited by event count.
+    message = event.get('message')
+    if isinstance(message, SharedMessageDict):
+        return len(message.encoded())
+    return 0
+
+def missed_message_event_data(event):
+    # type: (Mapping[str, Any]) -> Optional[Dict[str, Any]]
+    """The parts of a message event that missedmessage_hook looks at, if
+    the event could trigger a notification; see EventQueue.compact."""
+    if event['type'] != 'message' or event.get('flags') is None:
+        return None
+    flags = event['flags']
+    message = event['message']
+    mentioned = 'mentioned' in flags and 'read' not in flags
+    if not (message['type'] == 'private' or mentioned or event.get('stream_push_notify', False)):
+        return None
+    data = dict(type='message', flags=flags,
+                message=dict(id=message['id'], type=message['type']))  # type: Dict[str, Any]
+    if message['type'] != 'private':
+        data['message']['display_recipient'] = message['display_recipient']
+    for key in ['stream_push_notify', 'push_notified', 'email_notified']:
+        if key in event:
+            data[key] = event[key]
+    return data
+
 class EventQueue(object):
     def __init__(self, id):
         # type: (str) -> None
@@ -235,6 +284,12 @@ class EventQueue(object):
         self.next_event_id = 0  # type: int
         self.id = id  # type: str
         self.virtual_events = {}  # type: Dict[str, Dict[str, Any]]
+        self.message_bytes = 0  # type: int
+        # Set once the queue has been compacted; see compact().
+        self.overflowed = False  # type: bool
+        # What missedmessage_hook needs from the message events we
+        # dropped since then.
+        self.dropped_message_events = []  # type: List[Dict[str, Any]]
 
     def to_dict(self):
         # type: () -> Dict[str, Any]
@@ -244,7 +299,9 @@ class EventQueue(object):
         return dict(id=self.id,
                     next_event_id=self.next_event_id,
                     queue=list(self.queue),
-                    virtual_events=self.virtual_events)
+                    virtual_events=self.virtual_events,
+                    overflowed=self.overflowed,
+                    dropped_message_events=self.dropped_message_events)
 
     @classmethod
     def from_dict(cls, d):
@@ -253,10 +310,16 @@ class EventQueue(object):
         ret.next_event_id = d['next_event_id']
         ret.queue = deque(d['queue'])
         ret.virtual_events = d.get("virtual_events", {})
+        ret.overflowed = d.get("overflowed", False)
+        ret.dropped_message_events = d.get("dropped_message_events", [])
+        ret.message_bytes = sum(event_message_bytes(event) for event in ret.queue)
         return ret
 
     def push(self, event):
         # type: (Dict[str, Any]) -> None
+        if self.overflowed:
+            self.keep_missed_message_data([event])
+            return
         event['id'] = self.next_event_id
         self.next_event_id += 1
         full_event_type = compute_full_event_type(event)
@@ -278,13 +341,59 @@ class EventQueue(object):
                 virtual_event["messages"] += event["messages"]
         else:
             self.queue.append(event)
+            self.message_bytes += event_message_bytes(event)
+            if (len(self.queue) > settings.EVENT_QUEUE_MAX_EVENTS or
+                    self.message_bytes > settings.EVENT_QUEUE_MAX_BYTES):
+                self.compact()
+
+    def compact(self):
+        # type: () -> None
+        # Called when a client has stopped fetching events from its
+        # queue for long enough (without the queue being idle, e.g. a
+        # mobile app in the background) that the queue has exceeded its
+        # limits.  We replace the queue's contents with a restart event:
+        # clients handle those by reloading and fetching fresh state,
+        # so there's no point in keeping or adding any other events.
+        #
+        # The exception is that missedmessage_hook looks through the
+        # queue's message events when it's garbage-collected, to notify
+        # the user about PMs and mentions they missed; so we keep what
+        # it needs from them.
+        self.keep_missed_message_data(self.queue)
+        self.queue.clear()
+        self.message_bytes = 0
+        self.virtual_events = {
+            "restart": dict(type="restart", id=self.next_event_id, immediate=True,
+                            server_generation=settings.SERVER_GENERATION),
+        }
+        self.next_event_id += 1
+        self.overflowed = True
+        statsd.incr('tornado.event_queue_overflows')
+
+    def keep_missed_message_data(self, events):
+        # type: (Iterable[Mapping[str, Any]]) -> None
+        for event in events:
+            data = missed_message_event_data(event)
+            if data is not None:
+                self.dropped_message_events.append(data)
+        # A client can only miss so many messages.
+        del self.dropped_message_events[:-settings.EVENT_QUEUE_MAX_EVENTS]
+
+    def missed_message_events(self):
+        # type: () -> List[Dict[str, Any]]
+        """The message events missedmessage_hook considers: those we
+        dropped when compacting the queue, and those still in it."""
+        return self.dropped_message_events + [
+            event for event in self.contents() if event['type'] == 'message']
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
     def pop(self):
         # type: () -> Dict[str, Any]
-        return self.queue.popleft()
+        event = self.queue.popleft()
+        self.message_bytes -= event_message_bytes(event)
+        return event
 
     def empty(self):
         # type: () -> bool
@@ -325,7 +434,11 @@ clients = {}  # type: Dict[str, ClientDescriptor]
 # maps user id to list of client descriptors
 user_clients = {}  # type: Dict[int, List[ClientDescriptor]]
 # maps realm id to list of client descriptors with all_public_streams=True
+# or a narrow, excluding those in realm_stream_clients
 realm_clients_all_streams = {}  # type: Dict[int, List[ClientDescriptor]]
+# maps (realm id, lowercased stream name) to list of client descriptors
+# with a narrow to that stream
+realm_stream_clients = {}  # type: Dict[Tuple[int, Text], List[ClientDescriptor]]
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -336,13 +449,55 @@ gc_hooks = []  # type: List[Callable[[int, ClientDescriptor, bool], None]]
 
 next_queue_id = 0
 
+# A heap of (expiry time, queue id) pairs, used by gc_event_queues to
+# find idle queues without scanning every queue.  Each queue has at
+# most one entry, whose expiry time may be earlier than the queue's
+# current one (since connecting pushes the expiry back); such entries
+# are re-added with the current expiry time when they come due.
+# Queues with a connected handler are dropped from the index, and
+# re-added by disconnect_handler.
+gc_index = []  # type: List[Tuple[float, str]]
+gc_indexed_queue_ids = set()  # type: Set[str]
+
+# Event queues loaded from disk at startup whose ClientDescriptor
+# objects haven't been rehydrated yet, mapping queue ids to their
+# PendingClient records (user_profile_id, realm_id, realm_wide, line);
+# see load_event_queues.  The two indexes parallel user_clients and
+# realm_clients_all_streams.
+PendingClient = Tuple[int, int, bool, str]
+pending_clients = {}  # type: Dict[str, PendingClient]
+pending_user_clients = {}  # type: Dict[int, List[str]]
+pending_realm_clients = {}  # type: Dict[int, List[str]]
+# The restart event sent at startup, to be added to queues as they
+# are rehydrated.
+pending_restart_event = None  # type: Optional[Dict[str, Any]]
+
+# Queues changed or garbage-collected since the last snapshot.
+changed_queue_ids = set()  # type: Set[str]
+removed_queue_ids = set()  # type: Set[str]
+# Number of records in the persisted file, including superseded ones.
+snapshot_record_count = 0
+snapshot_needs_rewrite = True
+
 def clear_client_event_queues_for_testing():
     # type: () -> None
     assert(settings.TEST_SUITE)
     clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    realm_stream_clients.clear()
     gc_hooks.clear()
+    del gc_index[:]
+    gc_indexed_queue_ids.clear()
+    pending_clients.clear()
+    pending_user_clients.clear()
+    pending_realm_clients.clear()
+    changed_queue_ids.clear()
+    removed_queue_ids.clear()
+    global pending_restart_event, snapshot_record_count, snapshot_needs_rewrite
+    pending_restart_event = None
+    snapshot_record_count = 0
+    snapshot_needs_rewrite = True
     global next_queue_id
     next_queue_id = 0
 
@@ -352,21 +507,53 @@ def add_client_gc_hook(hook):
 
 def get_client_descriptor(queue_id):
     # type: (str) -> ClientDescriptor
+    if queue_id in pending_clients:
+        hydrate_pending_client(queue_id)
     return clients.get(queue_id)
 
 def get_client_descriptors_for_user(user_profile_id):
     # type: (int) -> List[ClientDescriptor]
+    if user_profile_id in pending_user_clients:
+        for queue_id in list(pending_user_clients[user_profile_id]):
+            hydrate_pending_client(queue_id)
     return user_clients.get(user_profile_id, [])
 
+def hydrate_pending_realm_clients(realm_id):
+    # type: (int) -> None
+    if realm_id in pending_realm_clients:
+        for queue_id in list(pending_realm_clients[realm_id]):
+            hydrate_pending_client(queue_id)
+
 def get_client_descriptors_for_realm_all_streams(realm_id):
     # type: (int) -> List[ClientDescriptor]
+    hydrate_pending_realm_clients(realm_id)
     return realm_clients_all_streams.get(realm_id, [])
 
+def get_client_descriptors_for_realm_stream(realm_id, stream_name):
+    # type: (int, Text) -> List[ClientDescriptor]
+    hydrate_pending_realm_clients(realm_id)
+    return realm_stream_clients.get((realm_id, stream_name.lower()), [])
+
+def is_realm_wide_client(client):
+    # type: (ClientDescriptor) -> bool
+    return client.all_public_streams or client.narrow != []
+
 def add_to_client_dicts(client):
     # type: (ClientDescriptor) -> None
     user_clients.setdefault(client.user_profile_id, []).append(client)
-    if client.all_public_streams or client.narrow != []:
+    if client.narrow_stream_name is not None:
+        realm_stream_clients.setdefault((client.realm_id, client.narrow_stream_name),
+                                        []).append(client)
+    elif is_realm_wide_client(client):
         realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+    add_to_gc_index(client)
+
+def add_to_gc_index(client):
+    # type: (ClientDescriptor) -> None
+    queue_id = client.event_queue.id
+    if queue_id not in gc_indexed_queue_ids:
+        gc_indexed_queue_ids.add(queue_id)
+        heapq.heappush(gc_index, (client.expiry_time(), queue_id))
 
 def allocate_client_descriptor(new_queue_data):
     # type: (MutableMapping[str, Any]) -> ClientDescriptor
@@ -382,7 +569,7 @@ def allocate_client_descriptor(new_queue_data):
 def do_gc_event_queues(to_remove, affected_users, affected_realms):
     # type: (AbstractSet[str], AbstractSet[int], AbstractSet[int]) -> None
     def filter_client_dict(client_dict, key):
-        # type: (MutableMapping[int, List[ClientDescriptor]], int) -> None
+        # type: (MutableMapping[Any, List[ClientDescriptor]], Any) -> None
         if key not in client_dict:
             return
 
@@ -398,10 +585,17 @@ def do_gc_event_queues(to_remove, affected_users, affected_realms):
     for realm_id in affected_realms:
         filter_client_dict(realm_clients_all_streams, realm_id)
 
+    for id in to_remove:
+        if clients[id].narrow_stream_name is not None:
+            filter_client_dict(realm_stream_clients,
+                               (clients[id].realm_id, clients[id].narrow_stream_name))
+
     for id in to_remove:
         for cb in gc_hooks:
             cb(clients[id].user_profile_id, clients[id], clients[id].user_profile_id not in user_clients)
         del clients[id]
+    removed_queue_ids.update(to_remove)
+    changed_queue_ids.difference_update(to_remove)
 
 def gc_event_queues():
     # type: () -> None
@@ -409,74 +603,246 @@ def gc_event_queues():
     to_remove = set()  # type: Set[str]
     affected_users = set()  # type: Set[int]
     affected_realms = set()  # type: Set[int]
-    for (id, client) in clients.items():
+    while gc_index and gc_index[0][0] <= start:
+        (expiry_time, id) = heapq.heappop(gc_index)
+        gc_indexed_queue_ids.remove(id)
+        client = clients.get(id)
+        if client is None:
+            # Already removed, e.g. via ClientDescriptor.cleanup.
+            continue
         if client.idle(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
             affected_realms.add(client.realm_id)
+        elif client.current_handler_id is None:
+            # The client has connected since this entry was added.
+            add_to_gc_index(client)
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle and thus
     # not have a current handler.
     do_gc_event_queues(to_remove, affected_users, affected_realms)
+    if not settings.EVENT_QUEUE_SNAPSHOT_SECS:
+        # Without periodic snapshots, nothing else clears these.
+        changed_queue_ids.clear()
+        removed_queue_ids.clear()
 
     if settings.PRODUCTION:
         logging.info(('Tornado removed %d idle event queues owned by %d users in %.3fs.' +
                       '  Now %d active queues, %s')
                      % (len(to_remove), len(affected_users), time.time() - start,
                         len(clients), handler_stats_string()))
+    statsd.timing('tornado.gc_event_queues_ms', 1000 * (time.time() - start))
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
 
-def dump_event_queues():
+# Event queues are persisted to a line-oriented file (one per shard),
+# with one record per line: either a serialized queue,
+#
+#   <queue id>\t<user_profile_id>\t<realm_id>\t<realm-wide: 0 or 1>\t<JSON>
+#
+# where the JSON is ClientDescriptor.to_dict(), or a tombstone for a
+# garbage-collected queue,
+#
+#   <queue id>\tdeleted
+#
+# Later records for a queue supersede earlier ones.  While running,
+# Tornado periodically appends records for just the queues that changed
+# since the last snapshot (snapshot_event_queues), and rewrites the
+# whole file, dropping superseded records, on shutdown or once the file
+# has grown too large (dump_event_queues).  Since snapshots only append
+# and rewrites are done via an atomic rename, a crash loses at most the
+# changes since the last snapshot; an incomplete last line is ignored.
+#
+# The leading fields let load_event_queues index the queues by user and
+# realm without parsing their JSON, so that Tornado can start serving
+# right away and rehydrate ClientDescriptor objects lazily.
+QUEUE_RECORD_DELETED = 'deleted'
+
+def format_queue_record(queue_id, client):
+    # type: (str, ClientDescriptor) -> str
+    return '%s\t%d\t%d\t%d\t%s\n' % (queue_id, client.user_profile_id, client.realm_id,
+                                     is_realm_wide_client(client),
+                                     ujson.dumps(client.to_dict()))
+
+def parse_queue_records(lines):
+    # type: (Iterable[str]) -> Iterator[Tuple[str, Optional[PendingClient]]]
+    """Yields (queue id, record) pairs, where record is None for a
+    tombstone."""
+    for line in lines:
+        fields = line.rstrip('\n').split('\t', 4)
+        if not line.endswith('\n'):
+            # The process died in the middle of writing this record.
+            logging.warning('Ignoring incomplete event queue record for %s' % (fields[0],))
+        elif len(fields) == 2 and fields[1] == QUEUE_RECORD_DELETED:
+            yield (fields[0], None)
+        elif len(fields) == 5:
+            yield (fields[0], (int(fields[1]), int(fields[2]), fields[3] == '1', line))
+        else:
+            logging.warning('Ignoring malformed event queue record for %s' % (fields[0],))
+
+def hydrate_pending_client(queue_id):
+    # type: (str) -> Optional[ClientDescriptor]
+    (user_profile_id, realm_id, realm_wide, line) = pending_clients.pop(queue_id)
+    pending_user_clients[user_profile_id].remove(queue_id)
+    if not pending_user_clients[user_profile_id]:
+        del pending_user_clients[user_profile_id]
+    if realm_wide:
+        pending_realm_clients[realm_id].remove(queue_id)
+        if not pending_realm_clients[realm_id]:
+            del pending_realm_clients[realm_id]
+
+    try:
+        client = ClientDescriptor.from_dict(ujson.loads(line.split('\t', 4)[4]))
+    except Exception:
+        logging.exception("Could not deserialize event queue %s" % (queue_id,))
+        removed_queue_ids.add(queue_id)
+        return None
+
+    # Put code for migrations due to event queue data format changes here
+
+    clients[queue_id] = client
+    add_to_client_dicts(client)
+    if pending_restart_event is not None and client.accepts_event(pending_restart_event):
+        client.add_event(pending_restart_event.copy())
+    return client
+
+def hydrate_pending_clients(batch_size=None):
+    # type: (Optional[int]) -> bool
+    """Rehydrates up to batch_size (by default, all) of the queues that
+    haven't been yet; returns whether any remain."""
+    for queue_id in list(itertools.islice(pending_clients, batch_size)):
+        hydrate_pending_client(queue_id)
+    return len(pending_clients) > 0
+
+def hydrate_pending_clients_in_background():
     # type: () -> None
+    ioloop = tornado.ioloop.IOLoop.instance()
+    start = time.time()
+
+    def hydrate_batch():
+        # type: () -> None
+        if hydrate_pending_clients(EVENT_QUEUE_HYDRATE_BATCH_SIZE):
+            ioloop.add_callback(hydrate_batch)
+        else:
+            logging.info('Tornado rehydrated %d event queues in %.3fs'
+                         % (len(clients), time.time() - start))
+    ioloop.add_callback(hydrate_batch)
+
+def dump_event_queues(filename=None):
+    # type: (Optional[str]) -> None
+    global snapshot_record_count, snapshot_needs_rewrite
+    if filename is None:
+        filename = persistent_queue_filename(sharding.current_shard)
     start = time.time()
 
-    with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "w") as stored_queues:
-        ujson.dump([(qid, client.to_dict()) for (qid, client) in clients.items()],
-                   stored_queues)
+    # Queues that haven't been rehydrated are written back verbatim.
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, "w") as stored_queues:
+        for (qid, client) in clients.items():
+            stored_queues.write(format_queue_record(qid, client))
+        for (user_profile_id, realm_id, realm_wide, line) in pending_clients.values():
+            stored_queues.write(line)
+        stored_queues.flush()
+        os.fsync(stored_queues.fileno())
+    os.rename(tmp_filename, filename)
+
+    snapshot_record_count = len(clients) + len(pending_clients)
+    snapshot_needs_rewrite = False
+    changed_queue_ids.clear()
+    removed_queue_ids.clear()
 
     logging.info('Tornado dumped %d event queues in %.3fs'
-                 % (len(clients), time.time() - start))
+                 % (snapshot_record_count, time.time() - start))
+
+def snapshot_event_queues(filename=None):
+    # type: (Optional[str]) -> None
+    """Persists the changes to event queues since the last snapshot."""
+    global snapshot_record_count
+    if filename is None:
+        filename = persistent_queue_filename(sharding.current_shard)
+    live_queues = len(clients) + len(pending_clients)
+    if (snapshot_needs_rewrite or
+            snapshot_record_count > EVENT_QUEUE_SNAPSHOT_COMPACTION_FACTOR * max(live_queues, 100)):
+        dump_event_queues(filename)
+        return
 
-def load_event_queues():
-    # type: () -> None
-    global clients
     start = time.time()
+    records = [format_queue_record(qid, clients[qid])
+               for qid in changed_queue_ids if qid in clients]
+    records += ['%s\t%s\n' % (qid, QUEUE_RECORD_DELETED) for qid in removed_queue_ids]
+    changed_queue_ids.clear()
+    removed_queue_ids.clear()
+    if not records:
+        return
+
+    with open(filename, "a") as stored_queues:
+        stored_queues.writelines(records)
+        stored_queues.flush()
+        os.fsync(stored_queues.fileno())
+    snapshot_record_count += len(records)
+
+    statsd.timing('tornado.queue_snapshot_ms', 1000 * (time.time() - start))
+    statsd.incr('tornado.queue_snapshot_records', len(records))
 
-    # ujson chokes on bad input pretty easily.  We separate out the actual
-    # file reading from the loading so that we don't silently fail if we get
-    # bad input.
+def load_legacy_event_queues(json_data):
+    # type: (str) -> None
+    # The pre-snapshot format was a JSON list of [queue id, dict] pairs.
+    # ujson chokes on bad input pretty easily, so we make sure that we
+    # don't silently fail if we get bad input.
     try:
-        with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "r") as stored_queues:
-            json_data = stored_queues.read()
-        try:
-            clients = dict((qid, ClientDescriptor.from_dict(client))
-                           for (qid, client) in ujson.loads(json_data))
-        except Exception:
-            logging.exception("Could not deserialize event queues")
+        for (qid, client) in ujson.loads(json_data):
+            clients[qid] = ClientDescriptor.from_dict(client)
+            add_to_client_dicts(clients[qid])
+    except Exception:
+        logging.exception("Could not deserialize event queues")
+
+def load_event_queues(filename=None):
+    # type: (Optional[str]) -> None
+    """Indexes the persisted event queues; the queues themselves are
+    rehydrated on first use or by hydrate_pending_clients."""
+    if filename is None:
+        filename = persistent_queue_filename(sharding.current_shard)
+    start = time.time()
+
+    try:
+        with open(filename, "r") as stored_queues:
+            if stored_queues.read(1) == '[':
+                stored_queues.seek(0)
+                load_legacy_event_queues(stored_queues.read())
+            else:
+                stored_queues.seek(0)
+                for (qid, record) in parse_queue_records(stored_queues):
+                    if record is None:
+                        pending_clients.pop(qid, None)
+                    else:
+                        pending_clients[qid] = record
     except (IOError, EOFError):
         pass
 
-    for client in clients.values():
-        # Put code for migrations due to event queue data format changes here
-
-        add_to_client_dicts(client)
+    for (qid, (user_profile_id, realm_id, realm_wide, line)) in pending_clients.items():
+        pending_user_clients.setdefault(user_profile_id, []).append(qid)
+        if realm_wide:
+            pending_realm_clients.setdefault(realm_id, []).append(qid)
 
     logging.info('Tornado loaded %d event queues in %.3fs'
-                 % (len(clients), time.time() - start))
+                 % (len(clients) + len(pending_clients), time.time() - start))
 
 def send_restart_events(immediate=False):
     # type: (bool) -> None
+    global pending_restart_event
     event = dict(type='restart', server_generation=settings.SERVER_GENERATION)  # type: Dict[str, Any]
     if immediate:
         event['immediate'] = True
     for client in clients.values():
         if client.accepts_event(event):
             client.add_event(event.copy())
+    if pending_clients:
+        pending_restart_event = event
 
 def setup_event_queue():
     # type: () -> None
+    ioloop = tornado.ioloop.IOLoop.instance()
     if not settings.TEST_SUITE:
         load_event_queues()
         atexit.register(dump_event_queues)
@@ -484,18 +850,24 @@ def setup_event_queue():
         signal.signal(signal.SIGTERM, lambda signum, stack: sys.exit(1))
         tornado.autoreload.add_reload_hook(dump_event_queues)
 
+        if settings.EVENT_QUEUE_SNAPSHOT_SECS:
+            snapshot_pc = tornado.ioloop.PeriodicCallback(
+                snapshot_event_queues, settings.EVENT_QUEUE_SNAPSHOT_SECS * 1000, ioloop)
+            snapshot_pc.start()
+
     try:
-        os.rename(settings.JSON_PERSISTENT_QUEUE_FILENAME, "/var/tmp/event_queues.json.last")
+        os.rename(persistent_queue_filename(sharding.current_shard),
+                  persistent_queue_filename(sharding.current_shard, last=True))
     except OSError:
         pass
 
     # Set up event queue garbage collection
-    ioloop = tornado.ioloop.IOLoop.instance()
     pc = tornado.ioloop.PeriodicCallback(gc_event_queues,
                                          EVENT_QUEUE_GC_FREQ_MSECS, ioloop)
     pc.start()
 
     send_restart_events(immediate=settings.DEVELOPMENT)
+    hydrate_pending_clients_in_background()
 
 def fetch_events(query):
     # type: (Mapping[str, Any]) -> Dict[str, Any]
@@ -527,7 +899,12 @@ def fetch_events(query):
             if user_profile_id != client.user_profile_id:
                 raise JsonableError(_("You are not authorized to get events from this queue"))
             client.event_queue.prune(last_event_id)
+            if client.event_queue.overflowed and client.event_queue.empty():
+                # The client has seen the restart event, but is still
+                # using this queue; make it register a new one.
+                raise BadEventQueueIdError(queue_id)
             was_connected = client.finish_current_handler()
+        changed_queue_ids.add(queue_id)
 
         if not client.event_queue.empty() or dont_block:
             response = dict(events=client.event_queue.contents(),
@@ -570,7 +947,8 @@ def request_event_queue(user_profile, user_client, apply_markdown,
                         queue_lifespan_secs, event_types=None, all_public_streams=False,
                         narrow=[]):
     # type: (UserProfile, Client, bool, int, Optional[Iterable[str]], bool, Iterable[Sequence[Text]]) -> Optional[str]
-    if settings.TORNADO_SERVER:
+    tornado_uri = get_tornado_uri_for_realm(user_profile.realm_id)
+    if tornado_uri:
         req = {'dont_block': 'true',
                'apply_markdown': ujson.dumps(apply_markdown),
                'all_public_streams': ujson.dumps(all_public_streams),
@@ -582,7 +960,7 @@ def request_event_queue(user_profile, user_client, apply_markdown,
             req['event_types'] = ujson.dumps(event_types)
 
         try:
-            resp = requests_client.get(settings.TORNADO_SERVER + '/api/v1/events',
+            resp = requests_client.get(tornado_uri + '/api/v1/events',
                                        auth=requests.auth.HTTPBasicAuth(
                                            user_profile.email, user_profile.api_key),
                                        params=req)
@@ -592,7 +970,7 @@ def request_event_queue(user_profile, user_client, apply_markdown,
                           (settings.ERROR_FILE_LOG_PATH, "tornado.log"))
             raise requests.adapters.ConnectionError(
                 "Django cannot connect to Tornado server (%s); try restarting" %
-                (settings.TORNADO_SERVER))
+                (tornado_uri,))
 
         resp.raise_for_status()
 
@@ -602,8 +980,9 @@ def request_event_queue(user_profile, user_client, apply_markdown,
 
 def get_user_events(user_profile, queue_id, last_event_id):
     # type: (UserProfile, str, int) -> List[Dict]
-    if settings.TORNADO_SERVER:
-        resp = requests_client.get(settings.TORNADO_SERVER + '/api/v1/events',
+    tornado_uri = get_tornado_uri_for_realm(user_profile.realm_id)
+    if tornado_uri:
+        resp = requests_client.get(tornado_uri + '/api/v1/events',
                                    auth=requests.auth.HTTPBasicAuth(
                                        user_profile.email, user_profile.api_key),
                                    params={'queue_id': queue_id,
@@ -652,9 +1031,7 @@ def missedmessage_hook(user_profile_id, client, last_for_client):
     if not last_for_client:
         return
 
-    for event in client.event_queue.contents():
-        if event['type'] != 'message':
-            continue
+    for event in client.event_queue.missed_message_events():
         assert 'flags' in event
 
         flags = event['flags']
@@ -728,12 +1105,75 @@ def maybe_enqueue_notifications(user_profile_id, message_id, private_message,
 
     return notified
 
+MessageEventUsers = Union[Mapping[str, Any], Iterable[Mapping[str, Any]]]
+
+def build_message_event_users(active_user_ids, user_flags,
+                              push_notify_user_ids, stream_push_user_ids):
+    # type: (AbstractSet[int], Mapping[int, List[str]], AbstractSet[int], AbstractSet[int]) -> Dict[str, Any]
+    """Runs in the Django process to build the `users` payload for a
+    `message` event in a compact form.
+
+    Rather than one dict per recipient, we group recipients with
+    identical flags, and send user IDs as sorted lists of integers.
+    `user_flags` only needs to contain users with flags set; every
+    other active user is put in the group with no flags.  The
+    per-user push notification settings are sent as lists of the
+    user IDs for which they are set.
+    """
+    ids_by_flags = {}  # type: Dict[Tuple[str, ...], List[int]]
+    for user_id in active_user_ids:
+        flags = tuple(user_flags.get(user_id, []))
+        ids_by_flags.setdefault(flags, []).append(user_id)
+
+    return dict(
+        flag_groups=[
+            dict(flags=list(flags), user_ids=sorted(user_ids))
+            for flags, user_ids in sorted(ids_by_flags.items())
+        ],
+        always_push_notify=sorted(push_notify_user_ids & active_user_ids),
+        stream_push_notify=sorted(stream_push_user_ids & active_user_ids),
+    )
+
+def message_event_user_data(users):
+    # type: (MessageEventUsers) -> Iterator[Tuple[int, List[str], bool, bool]]
+    """Yields (user_profile_id, flags, always_push_notify,
+    stream_push_notify) for each recipient of a `message` event.
+
+    We accept both the compact format produced by
+    build_message_event_users and the older list of per-user dicts,
+    so that events queued by a server running older code are still
+    processed correctly after an upgrade.
+    """
+    if isinstance(users, Mapping):
+        always_push_notify_ids = set(users.get('always_push_notify', []))
+        stream_push_notify_ids = set(users.get('stream_push_notify', []))
+        for group in users['flag_groups']:
+            flags = group['flags']  # type: List[str]
+            for user_profile_id in group['user_ids']:
+                yield (user_profile_id, flags,
+                       user_profile_id in always_push_notify_ids,
+                       user_profile_id in stream_push_notify_ids)
+    else:
+        for user_data in users:
+            yield (user_data['id'], user_data.get('flags', []),
+                   user_data.get('always_push_notify', False),
+                   user_data.get('stream_push_notify', False))
+
+def count_message_event_users(users):
+    # type: (MessageEventUsers) -> int
+    if isinstance(users, Mapping):
+        return sum(len(group['user_ids']) for group in users['flag_groups'])
+    return len(list(users))
+
 def process_message_event(event_template, users):
-    # type: (Mapping[str, Any], Iterable[Mapping[str, Any]]) -> None
+    # type: (Mapping[str, Any], MessageEventUsers) -> None
     presence_idle_user_ids = set(event_template.get('presence_idle_user_ids', []))
     sender_queue_id = event_template.get('sender_queue_id', None)  # type: Optional[str]
-    message_dict_markdown = event_template['message_dict_markdown']  # type: Dict[str, Any]
-    message_dict_no_markdown = event_template['message_dict_no_markdown']  # type: Dict[str, Any]
+    # Every client receiving this message shares these two payloads
+    # (one per apply_markdown variant), which are then JSON-encoded
+    # at most once each; see SharedMessageDict.
+    message_dict_markdown = SharedMessageDict(event_template['message_dict_markdown'])  # type: Dict[str, Any]
+    message_dict_no_markdown = SharedMessageDict(event_template['message_dict_no_markdown'])  # type: Dict[str, Any]
     sender_id = message_dict_markdown['sender_id']  # type: int
     message_id = message_dict_markdown['id']  # type: int
     message_type = message_dict_markdown['type']  # type: str
@@ -746,15 +1186,17 @@ def process_message_event(event_template, users):
     extra_user_data = {}  # type: Dict[int, Any]
 
     if 'stream_name' in event_template and not event_template.get("invite_only"):
-        for client in get_client_descriptors_for_realm_all_streams(event_template['realm_id']):
+        # Clients narrowed to another stream can't accept this message,
+        # so we only look at those narrowed to this one.
+        realm_id = event_template['realm_id']
+        for client in itertools.chain(
+                get_client_descriptors_for_realm_all_streams(realm_id),
+                get_client_descriptors_for_realm_stream(realm_id, event_template['stream_name'])):
             send_to_clients[client.event_queue.id] = {'client': client, 'flags': None}
             if sender_queue_id is not None and client.event_queue.id == sender_queue_id:
                 send_to_clients[client.event_queue.id]['is_sender'] = True
 
-    for user_data in users:
-        user_profile_id = user_data['id']  # type: int
-        flags = user_data.get('flags', [])  # type: Iterable[str]
-
+    for user_profile_id, flags, always_push_notify, stream_push_notify in message_event_user_data(users):
         for client in get_client_descriptors_for_user(user_profile_id):
             send_to_clients[client.event_queue.id] = {'client': client, 'flags': flags}
             if sender_queue_id is not None and client.event_queue.id == sender_queue_id:
@@ -764,13 +1206,11 @@ def process_message_event(event_template, users):
         # or they were @-notified potentially notify more immediately
         private_message = message_type == "private" and user_profile_id != sender_id
         mentioned = 'mentioned' in flags and 'read' not in flags
-        stream_push_notify = user_data.get('stream_push_notify', False)
 
         # We first check if a message is potentially mentionable,
         # since receiver_is_off_zulip is somewhat expensive.
         if private_message or mentioned or stream_push_notify:
             idle = receiver_is_off_zulip(user_profile_id) or (user_profile_id in presence_idle_user_ids)
-            always_push_notify = user_data.get('always_push_notify', False)
             stream_name = event_template.get('stream_name')
             result = maybe_enqueue_notifications(user_profile_id, message_id, private_message,
                                                  mentioned, stream_push_notify, stream_name,
@@ -926,42 +1366,62 @@ def maybe_enqueue_notifications_for_message_update(user_profile_id,
 def process_notification(notice):
     # type: (Mapping[str, Any]) -> None
     event = notice['event']  # type: Mapping[str, Any]
-    users = notice['users']  # type: Union[List[int], List[Mapping[str, Any]]]
+    users = notice['users']  # type: Union[List[int], List[Mapping[str, Any]], Mapping[str, Any]]
     start_time = time.time()
     if event['type'] == "message":
-        process_message_event(event, cast(Iterable[Mapping[str, Any]], users))
+        process_message_event(event, cast(MessageEventUsers, users))
     elif event['type'] == "update_message":
         process_message_update_event(event, cast(Iterable[Mapping[str, Any]], users))
     elif event['type'] == "delete_message":
         process_userdata_event(event, cast(Iterable[Mapping[str, Any]], users))
     else:
         process_event(event, cast(Iterable[int], users))
+    if event['type'] == "message":
+        num_users = count_message_event_users(cast(MessageEventUsers, users))
+    else:
+        num_users = len(users)
     logging.debug("Tornado: Event %s for %s users took %sms" % (
-        event['type'], len(users), int(1000 * (time.time() - start_time))))
+        event['type'], num_users, int(1000 * (time.time() - start_time))))
 
 # Runs in the Django process to send a notification to Tornado.
 #
 # We use JSON rather than bare form parameters, so that we can represent
 # different types and for compatibility with non-HTTP transports.
 
-def send_notification_http(data):
-    # type: (Mapping[str, Any]) -> None
-    if settings.TORNADO_SERVER and not settings.RUNNING_INSIDE_TORNADO:
-        requests_client.post(settings.TORNADO_SERVER + '/notify_tornado', data=dict(
+def send_notification_http(data, shard=0):
+    # type: (Mapping[str, Any], int) -> None
+    tornado_uri = get_tornado_uri(shard)
+    if tornado_uri and not settings.RUNNING_INSIDE_TORNADO:
+        requests_client.post(tornado_uri + '/notify_tornado', data=dict(
             data   = ujson.dumps(data),
             secret = settings.SHARED_SECRET))
     else:
         process_notification(data)
 
-def send_notification(data):
-    # type: (Dict[str, Any]) -> None
-    queue_json_publish("notify_tornado", data, send_notification_http)
-
-def send_event(event, users):
-    # type: (Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> None
+def publish_notification(data, realm_ids=None):
+    # type: (Dict[str, Any], Optional[Iterable[int]]) -> None
+    """Sends a notification to the Tornado shards serving `realm_ids`,
+    or to all shards if realm_ids is None.  Since each shard only
+    delivers events to its own clients, sending to extra shards is
+    harmless (just wasteful)."""
+    for shard in get_shards_for_realms(realm_ids):
+        queue_json_publish(notify_tornado_queue_name(shard), data,
+                           lambda data, shard=shard: send_notification_http(data, shard))
+
+def send_notification(data, realm_ids=None):
+    # type: (Dict[str, Any], Optional[Iterable[int]]) -> None
+    publish_notification(data, realm_ids)
+
+def send_event(event, users, realm_ids=None):
+    # type: (Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]], Mapping[str, Any]], Optional[Iterable[int]]) -> None
     """`users` is a list of user IDs, or in the case of `message` type
-    events, a list of dicts describing the users and metadata about
-    the user/message pair."""
-    queue_json_publish("notify_tornado",
-                       dict(event=event, users=users),
-                       send_notification_http)
+    events, the compact description of the recipients and their
+    per-message metadata built by build_message_event_users.
+
+    `realm_ids` are the realms of the users, which we use to route
+    the event to the right Tornado shards when there is more than
+    one; if not provided, the event is sent to every shard."""
+    if isinstance(users, collections.abc.Iterator):
+        # We may need to serialize `users` once per shard.
+        users = list(users)
+    publish_notification(dict(event=event, users=users), realm_ids)
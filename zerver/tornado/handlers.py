@@ -21,6 +21,7 @@ from zerver.decorator import RespondAsynchronously
 from zerver.lib.response import json_response
 from zerver.middleware import async_request_stop, async_request_restart
 from zerver.tornado.descriptors import get_descriptor_by_handler_id
+from zerver.tornado.event_encoding import json_events_response
 
 from typing import Any, Callable, Dict, List, Optional
 
@@ -45,7 +46,9 @@ def clear_handler_by_id(handler_id):
 
 def handler_stats_string():
     # type: () -> str
-    return "%s handlers, latest ID %s" % (len(handlers), current_handler_id)
+    return "%s handlers, latest ID %s, queue limits %s events/%s bytes" % (
+        len(handlers), current_handler_id,
+        settings.EVENT_QUEUE_MAX_EVENTS, settings.EVENT_QUEUE_MAX_BYTES)
 
 def finish_handler(handler_id, event_queue_id, contents, apply_markdown):
     # type: (int, str, List[Dict[str, Any]], bool) -> None
@@ -355,8 +358,12 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
         # the headers from that since sending those to Tornado seems
         # tricky; instead just send the (already json-rendered)
         # content on to Tornado
-        django_response = json_response(res_type=response['result'],
-                                        data=response, status=self.get_status())
+        if 'events' in response:
+            django_response = json_events_response(res_type=response['result'],
+                                                   data=response, status=self.get_status())
+        else:
+            django_response = json_response(res_type=response['result'],
+                                            data=response, status=self.get_status())
         django_response = self.apply_response_middleware(request, django_response,
                                                          request._resolver)
         # Pass through the content-type from Django, as json content should be
@@ -0,0 +1,82 @@
+from django.conf import settings
+from typing import Iterable, List, Optional, Text
+
+from six.moves import urllib
+
+# Zulip can run several Tornado processes ("shards"), configured with
+# settings.TORNADO_PROCESSES, to spread event delivery across the
+# cores of a server.  Realms are partitioned between the shards, so
+# that every event queue for a given realm lives in the same process;
+# this keeps per-realm structures like realm_clients_all_streams
+# complete within a shard.  Shard N listens on the port of
+# settings.TORNADO_SERVER plus N, and the frontend proxy needs to
+# route each realm's /json/events traffic to its shard's port.
+
+# The shard served by this process, when running inside Tornado.
+current_shard = 0
+
+def set_current_shard(shard):
+    # type: (int) -> None
+    global current_shard
+    assert 0 <= shard < settings.TORNADO_PROCESSES
+    current_shard = shard
+
+def get_tornado_shard(realm_id):
+    # type: (int) -> int
+    return realm_id % settings.TORNADO_PROCESSES
+
+def get_shards_for_realms(realm_ids):
+    # type: (Optional[Iterable[int]]) -> List[int]
+    """Returns the shards that need to see an event for users in the
+    given realms; if we don't know the realms, that's all of them."""
+    if realm_ids is None:
+        return list(range(settings.TORNADO_PROCESSES))
+    return sorted({get_tornado_shard(realm_id) for realm_id in realm_ids})
+
+def get_tornado_uri(shard):
+    # type: (int) -> Optional[Text]
+    if settings.TORNADO_SERVER is None or settings.TORNADO_PROCESSES == 1:
+        return settings.TORNADO_SERVER
+    parsed = urllib.parse.urlsplit(settings.TORNADO_SERVER)
+    return '%s://%s:%d' % (parsed.scheme, parsed.hostname, parsed.port + shard)
+
+def get_tornado_uri_for_realm(realm_id):
+    # type: (int) -> Optional[Text]
+    return get_tornado_uri(get_tornado_shard(realm_id))
+
+def get_shard_for_port(port):
+    # type: (int) -> int
+    if settings.TORNADO_SERVER is None or settings.TORNADO_PROCESSES == 1:
+        return 0
+    base_port = urllib.parse.urlsplit(settings.TORNADO_SERVER).port
+    shard = port - base_port
+    if not 0 <= shard < settings.TORNADO_PROCESSES:
+        raise ValueError("Port %d is not a Tornado port; TORNADO_SERVER uses %d-%d." % (
+            port, base_port, base_port + settings.TORNADO_PROCESSES - 1))
+    return shard
+
+def shard_suffix(shard):
+    # type: (int) -> str
+    # We leave names unchanged in the default single-process
+    # configuration, for compatibility with existing deployments.
+    if settings.TORNADO_PROCESSES == 1:
+        return ''
+    return '_%d' % (shard,)
+
+def notify_tornado_queue_name(shard):
+    # type: (int) -> str
+    return 'notify_tornado' + shard_suffix(shard)
+
+def tornado_return_queue_name(shard):
+    # type: (int) -> str
+    return 'tornado_return' + shard_suffix(shard)
+
+def persistent_queue_filename(shard, last=False):
+    # type: (int, bool) -> str
+    if last:
+        filename = "/var/tmp/event_queues.json.last"
+    else:
+        filename = settings.JSON_PERSISTENT_QUEUE_FILENAME
+    if settings.TORNADO_PROCESSES == 1:
+        return filename
+    return filename + '.%d' % (shard,)
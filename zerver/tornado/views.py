@@ -10,6 +10,7 @@ from zerver.decorator import asynchronous, \
 
 from zerver.lib.response import json_success, json_error
 from zerver.lib.validator import check_bool, check_list, check_string
+from zerver.tornado.event_encoding import json_events_response
 from zerver.tornado.event_queue import get_client_descriptor, \
     process_notification, fetch_events
 from zerver.tornado.exceptions import BadEventQueueIdError
@@ -88,4 +89,4 @@ def get_events_backend(request, user_profile, handler,
         return RespondAsynchronously
     if result["type"] == "error":
         raise result["exception"]
-    return json_success(result["response"])
+    return json_events_response(data=result["response"])
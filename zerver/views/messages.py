@@ -36,7 +36,8 @@ from zerver.lib.response import json_success, json_error
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.streams import access_stream_by_id, is_public_stream_by_name
 from zerver.lib.timestamp import datetime_to_timestamp
-from zerver.lib.topic_mutes import exclude_topic_mutes
+from zerver.lib.recent_window import get_recent_window
+from zerver.lib.topic_mutes import build_topic_mute_checker, exclude_topic_mutes
 from zerver.lib.utils import statsd
 from zerver.lib.validator import \
     check_list, check_int, check_dict, check_string, check_bool
@@ -156,13 +157,11 @@ class NarrowBuilder(object):
 
     def by_is(self, query, operand, maybe_negate):
         # type: (Query, str, ConditionTransform) -> Query
+        # These conditions must match the WHERE clauses of the partial
+        # indexes on zerver_usermessage (see create_large_indexes), so
+        # that Postgres can use them.
         if operand == 'private':
-            # The `.select_from` method extends the query with a join.
-            query = query.select_from(join(query.froms[0], table("zerver_recipient"),
-                                           column("recipient_id") ==
-                                           literal_column("zerver_recipient.id")))
-            cond = or_(column("type") == Recipient.PERSONAL,
-                       column("type") == Recipient.HUDDLE)
+            cond = column("flags").op("&")(UserMessage.flags.is_private.mask) != 0
             return query.where(maybe_negate(cond))
         elif operand == 'starred':
             cond = column("flags").op("&")(UserMessage.flags.starred.mask) != 0
@@ -374,27 +373,12 @@ class NarrowBuilder(object):
 
     def _by_search_pgroonga(self, query, operand, maybe_negate):
         # type: (Query, str, ConditionTransform) -> Query
-        match_positions_character = func.pgroonga.match_positions_character
-        query_extract_keywords = func.pgroonga.query_extract_keywords
-        keywords = query_extract_keywords(operand)
-        query = query.column(match_positions_character(column("rendered_content"),
-                                                       keywords).label("content_matches"))
-        query = query.column(match_positions_character(column("subject"),
-                                                       keywords).label("subject_matches"))
         condition = column("search_pgroonga").op("@@")(operand)
         return query.where(maybe_negate(condition))
 
     def _by_search_tsearch(self, query, operand, maybe_negate):
         # type: (Query, str, ConditionTransform) -> Query
         tsquery = func.plainto_tsquery(literal("zulip.english_us_search"), literal(operand))
-        ts_locs_array = func.ts_match_locs_array
-        query = query.column(ts_locs_array(literal("zulip.english_us_search"),
-                                           column("rendered_content"),
-                                           tsquery).label("content_matches"))
-        # We HTML-escape the subject in Postgres to avoid doing a server round-trip
-        query = query.column(ts_locs_array(literal("zulip.english_us_search"),
-                                           func.escape_html(column("subject")),
-                                           tsquery).label("subject_matches"))
 
         # Do quoted string matching.  We really want phrase
         # search here so we can ignore punctuation and do
@@ -411,6 +395,44 @@ class NarrowBuilder(object):
         cond = column("search_tsvector").op("@@")(tsquery)
         return query.where(maybe_negate(cond))
 
+# The match locations for highlighting search results are expensive
+# to compute, so rather than having the search narrow compute them for
+# every message it considers, we add these columns to the outer query
+# that fetches just the messages we're returning.  The query must have
+# the message's subject and rendered_content columns.
+def add_search_match_columns(query, operand, subject_col, rendered_content_col):
+    # type: (Query, str, ColumnElement, ColumnElement) -> Query
+    if settings.USING_PGROONGA:
+        return _add_search_match_columns_pgroonga(query, operand, subject_col,
+                                                  rendered_content_col)
+    else:
+        return _add_search_match_columns_tsearch(query, operand, subject_col,
+                                                 rendered_content_col)
+
+def _add_search_match_columns_pgroonga(query, operand, subject_col, rendered_content_col):
+    # type: (Query, str, ColumnElement, ColumnElement) -> Query
+    match_positions_character = func.pgroonga.match_positions_character
+    query_extract_keywords = func.pgroonga.query_extract_keywords
+    keywords = query_extract_keywords(operand)
+    query = query.column(match_positions_character(rendered_content_col,
+                                                   keywords).label("content_matches"))
+    query = query.column(match_positions_character(subject_col,
+                                                   keywords).label("subject_matches"))
+    return query
+
+def _add_search_match_columns_tsearch(query, operand, subject_col, rendered_content_col):
+    # type: (Query, str, ColumnElement, ColumnElement) -> Query
+    tsquery = func.plainto_tsquery(literal("zulip.english_us_search"), literal(operand))
+    ts_locs_array = func.ts_match_locs_array
+    query = query.column(ts_locs_array(literal("zulip.english_us_search"),
+                                       rendered_content_col,
+                                       tsquery).label("content_matches"))
+    # We HTML-escape the subject in Postgres to avoid doing a server round-trip
+    query = query.column(ts_locs_array(literal("zulip.english_us_search"),
+                                       func.escape_html(subject_col),
+                                       tsquery).label("subject_matches"))
+    return query
+
 # Apparently, the offsets we get from tsearch_extras are counted in
 # unicode characters, not in bytes, so we do our processing with text,
 # not bytes.
@@ -420,25 +442,26 @@ def highlight_string(text, locs):
     highlight_start = u'<span class="highlight">'
     highlight_stop = u'</span>'
     pos = 0
-    result = u''
+    result = []  # type: List[Text]
     in_tag = False
     for loc in locs:
         (offset, length) = loc
-        for character in string[pos:offset + length]:
-            if character == u'<':
-                in_tag = True
-            elif character == u'>':
-                in_tag = False
+        # Whether the match ends inside an HTML tag depends only on
+        # the last '<' or '>' before its end.
+        last_open = string.rfind(u'<', pos, offset + length)
+        last_close = string.rfind(u'>', pos, offset + length)
+        if last_open != last_close:
+            in_tag = last_open > last_close
         if in_tag:
-            result += string[pos:offset + length]
+            result.append(string[pos:offset + length])
         else:
-            result += string[pos:offset]
-            result += highlight_start
-            result += string[offset:offset + length]
-            result += highlight_stop
+            result.append(string[pos:offset])
+            result.append(highlight_start)
+            result.append(string[offset:offset + length])
+            result.append(highlight_stop)
         pos = offset + length
-    result += string[pos:]
-    return result
+    result.append(string[pos:])
+    return u''.join(result)
 
 def get_search_fields(rendered_content, subject, content_matches, subject_matches):
     # type: (Text, Text, Iterable[Tuple[int, int]], Iterable[Tuple[int, int]]) -> Dict[str, Text]
@@ -556,6 +579,48 @@ def exclude_muting_conditions(user_profile, narrow):
 
     return conditions
 
+def build_home_view_muting_checker(user_profile):
+    # type: (UserProfile) -> Callable[[int, Text], bool]
+    # The Python equivalent of exclude_muting_conditions(user_profile, None).
+    rows = Subscription.objects.filter(
+        user_profile=user_profile,
+        active=True,
+        in_home_view=False,
+        recipient__type=Recipient.STREAM
+    ).values('recipient_id')
+    muted_recipient_ids = {row['recipient_id'] for row in rows}
+    topic_is_muted = build_topic_mute_checker(user_profile)
+
+    def is_muted(recipient_id, topic):
+        # type: (int, Text) -> bool
+        return recipient_id in muted_recipient_ids or topic_is_muted(recipient_id, topic)
+
+    return is_muted
+
+def get_home_view_rows_from_recent_window(user_profile, num_before, num_after):
+    # type: (UserProfile, int, int) -> Optional[List[Tuple[int, int]]]
+    """The (message_id, flags) rows for a home view fetch with
+    use_first_unread_anchor, computed like get_messages_backend's
+    queries but from the user's recent window (see
+    zerver/lib/recent_window.py); None if the window doesn't have all
+    the messages we need."""
+    window = get_recent_window(user_profile.id)
+    if not window.covers(user_profile.pointer):
+        # There may be unread messages older than the window.
+        return None
+
+    anchor = window.first_unread_message_id(user_profile.pointer,
+                                            build_home_view_muting_checker(user_profile))
+    if anchor is None:
+        anchor = LARGER_THAN_MAX_MESSAGE_ID
+
+    before_anchor = anchor
+    if num_after != 0:
+        before_anchor = anchor - 1
+    if anchor == LARGER_THAN_MAX_MESSAGE_ID:
+        num_after = 0
+    return window.get_rows(before_anchor, num_before, num_after)
+
 @has_request_variables
 def get_messages_backend(request, user_profile,
                          anchor = REQ(converter=int),
@@ -575,7 +640,17 @@ def get_messages_backend(request, user_profile,
         # This is OK only because we've made sure this is a narrow that
         # will cause us to limit the query appropriately later.
         # See `ok_to_include_history` for details.
-        query = select([column("id").label("message_id")], None, table("zerver_message"))
+        #
+        # We outer join to the user's UserMessage rows to get their
+        # flags; they're NULL for messages the user didn't receive.
+        query = select([literal_column("zerver_message.id").label("message_id"), column("flags")],
+                       None,
+                       join(table("zerver_message"), table("zerver_usermessage"),
+                            and_(literal_column("zerver_usermessage.message_id") ==
+                                 literal_column("zerver_message.id"),
+                                 literal_column("zerver_usermessage.user_profile_id") ==
+                                 literal(user_profile.id)),
+                            isouter=True))
         inner_msg_id_col = literal_column("zerver_message.id")
     elif narrow is None and not use_first_unread_anchor:
         # This is limited to messages the user received, as recorded in `zerver_usermessage`.
@@ -614,7 +689,6 @@ def get_messages_backend(request, user_profile,
             if term['operator'] == 'search':
                 if not is_search:
                     search_term = term
-                    query = query.column(column("subject")).column(column("rendered_content"))
                     is_search = True
                 else:
                     # Join the search operators if there are multiple of them
@@ -633,109 +707,110 @@ def get_messages_backend(request, user_profile,
     else:
         num_before += num_extra_messages
 
-    sa_conn = get_sqlalchemy_connection()
-    if use_first_unread_anchor:
-        condition = column("flags").op("&")(UserMessage.flags.read.mask) == 0
-
-        # We exclude messages on muted topics when finding the first unread
-        # message in this narrow
-        muting_conditions = exclude_muting_conditions(user_profile, narrow)
-        if muting_conditions:
-            condition = and_(condition, *muting_conditions)
-
-        # The mobile app uses narrow=[] and use_first_unread_anchor=True to
-        # determine what messages to show when you first load the app.
-        # Unfortunately, this means that if you have a years-old unread
-        # message, the mobile app could get stuck in the past.
-        #
-        # To fix this, we enforce that the "first unread anchor" must be on or
-        # after the user's current pointer location. Since the pointer
-        # location refers to the latest the user has read in the home view,
-        # we'll only apply this logic in the home view (ie, when narrow is
-        # empty).
-        if not narrow:
-            pointer_condition = inner_msg_id_col >= user_profile.pointer
-            condition = and_(condition, pointer_condition)
-
-        first_unread_query = query.where(condition)
-        first_unread_query = first_unread_query.order_by(inner_msg_id_col.asc()).limit(1)
-        first_unread_result = list(sa_conn.execute(first_unread_query).fetchall())
-        if len(first_unread_result) > 0:
-            anchor = first_unread_result[0][0]
-        else:
-            anchor = LARGER_THAN_MAX_MESSAGE_ID
+    query_result = None  # type: Optional[List[Any]]
+    if narrow is None and use_first_unread_anchor and settings.RECENT_WINDOW_SIZE > 0:
+        # The home view; we can often answer it from the cache.
+        query_result = get_home_view_rows_from_recent_window(user_profile, num_before, num_after)
+
+    if query_result is None:
+        sa_conn = get_sqlalchemy_connection()
+        if use_first_unread_anchor:
+            condition = column("flags").op("&")(UserMessage.flags.read.mask) == 0
+
+            # We exclude messages on muted topics when finding the first unread
+            # message in this narrow
+            muting_conditions = exclude_muting_conditions(user_profile, narrow)
+            if muting_conditions:
+                condition = and_(condition, *muting_conditions)
+
+            # The mobile app uses narrow=[] and use_first_unread_anchor=True to
+            # determine what messages to show when you first load the app.
+            # Unfortunately, this means that if you have a years-old unread
+            # message, the mobile app could get stuck in the past.
+            #
+            # To fix this, we enforce that the "first unread anchor" must be on or
+            # after the user's current pointer location. Since the pointer
+            # location refers to the latest the user has read in the home view,
+            # we'll only apply this logic in the home view (ie, when narrow is
+            # empty).
+            if not narrow:
+                pointer_condition = inner_msg_id_col >= user_profile.pointer
+                condition = and_(condition, pointer_condition)
+
+            first_unread_query = query.where(condition)
+            first_unread_query = first_unread_query.order_by(inner_msg_id_col.asc()).limit(1)
+            first_unread_result = list(sa_conn.execute(first_unread_query).fetchall())
+            if len(first_unread_result) > 0:
+                anchor = first_unread_result[0][0]
+            else:
+                anchor = LARGER_THAN_MAX_MESSAGE_ID
 
-    before_query = None
-    after_query = None
-    if num_before != 0:
-        before_anchor = anchor
+        before_query = None
+        after_query = None
+        if num_before != 0:
+            before_anchor = anchor
+            if num_after != 0:
+                # Don't include the anchor in both the before query and the after query
+                before_anchor = anchor - 1
+            before_query = query.where(inner_msg_id_col <= before_anchor) \
+                                .order_by(inner_msg_id_col.desc()).limit(num_before)
         if num_after != 0:
-            # Don't include the anchor in both the before query and the after query
-            before_anchor = anchor - 1
-        before_query = query.where(inner_msg_id_col <= before_anchor) \
-                            .order_by(inner_msg_id_col.desc()).limit(num_before)
-    if num_after != 0:
-        after_query = query.where(inner_msg_id_col >= anchor) \
-                           .order_by(inner_msg_id_col.asc()).limit(num_after)
+            after_query = query.where(inner_msg_id_col >= anchor) \
+                               .order_by(inner_msg_id_col.asc()).limit(num_after)
 
-    if anchor == LARGER_THAN_MAX_MESSAGE_ID:
-        # There's no need for an after_query if we're targeting just the target message.
-        after_query = None
+        if anchor == LARGER_THAN_MAX_MESSAGE_ID:
+            # There's no need for an after_query if we're targeting just the target message.
+            after_query = None
 
-    if before_query is not None:
-        if after_query is not None:
-            query = union_all(before_query.self_group(), after_query.self_group())
+        if before_query is not None:
+            if after_query is not None:
+                query = union_all(before_query.self_group(), after_query.self_group())
+            else:
+                query = before_query
+        elif after_query is not None:
+            query = after_query
         else:
-            query = before_query
-    elif after_query is not None:
-        query = after_query
-    else:
-        # This can happen when a narrow is specified.
-        query = query.where(inner_msg_id_col == anchor)
+            # This can happen when a narrow is specified.
+            query = query.where(inner_msg_id_col == anchor)
 
-    main_query = alias(query)
-    query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
-    # This is a hack to tag the query we use for testing
-    query = query.prefix_with("/* get_messages */")
-    query_result = list(sa_conn.execute(query).fetchall())
+        main_query = alias(query)
+        if is_search:
+            # Fetch the content we need to highlight the search results
+            # for just the messages we're returning.
+            subject_col = literal_column("zerver_message.subject")
+            rendered_content_col = literal_column("zerver_message.rendered_content")
+            query = select([main_query.c.message_id, main_query.c.flags,
+                            subject_col, rendered_content_col],
+                           None,
+                           join(main_query, table("zerver_message"),
+                                literal_column("zerver_message.id") == main_query.c.message_id))
+            query = add_search_match_columns(query, search_term['operand'],
+                                             subject_col, rendered_content_col)
+            query = query.order_by(column("message_id").asc())
+        else:
+            query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
+        # This is a hack to tag the query we use for testing
+        query = query.prefix_with("/* get_messages */")
+        query_result = list(sa_conn.execute(query).fetchall())
 
-    # The following is a little messy, but ensures that the code paths
-    # are similar regardless of the value of include_history.  The
-    # 'user_messages' dictionary maps each message to the user's
-    # UserMessage object for that message, which we will attach to the
-    # rendered message dict before returning it.  We attempt to
-    # bulk-fetch rendered message dicts from remote cache using the
-    # 'messages' list.
     search_fields = dict()  # type: Dict[int, Dict[str, Text]]
     message_ids = []  # type: List[int]
     user_message_flags = {}  # type: Dict[int, List[str]]
-    if include_history:
-        message_ids = [row[0] for row in query_result]
-
-        # TODO: This could be done with an outer join instead of two queries
-        user_message_flags = dict((user_message.message_id, user_message.flags_list()) for user_message in
-                                  UserMessage.objects.filter(user_profile=user_profile,
-                                                             message__id__in=message_ids))
-        for row in query_result:
-            message_id = row[0]
-            if user_message_flags.get(message_id) is None:
-                user_message_flags[message_id] = ["read", "historical"]
-            if is_search:
-                (_, subject, rendered_content, content_matches, subject_matches) = row
-                search_fields[message_id] = get_search_fields(rendered_content, subject,
-                                                              content_matches, subject_matches)
-    else:
-        for row in query_result:
-            message_id = row[0]
-            flags = row[1]
+    for row in query_result:
+        message_id = row[0]
+        flags = row[1]
+        if flags is None:
+            # The user didn't receive this message; see include_history.
+            user_message_flags[message_id] = ["read", "historical"]
+        else:
             user_message_flags[message_id] = parse_usermessage_flags(flags)
 
-            message_ids.append(message_id)
+        message_ids.append(message_id)
 
-            if is_search:
-                (_, _, subject, rendered_content, content_matches, subject_matches) = row
-                search_fields[message_id] = get_search_fields(rendered_content, subject,
-                                                              content_matches, subject_matches)
+        if is_search:
+            (_, _, subject, rendered_content, content_matches, subject_matches) = row
+            search_fields[message_id] = get_search_fields(rendered_content, subject,
+                                                          content_matches, subject_matches)
 
     cache_transformer = lambda row: MessageDict.build_dict_from_raw_db_row(row, apply_markdown)
     id_fetcher = lambda row: row['id']
@@ -1121,7 +1196,7 @@ def update_message_backend(request, user_profile,
 
     # Include the number of messages changed in the logs
     request._log_data['extra'] = "[%s]" % (number_changed,)
-    if links_for_embed and bugdown.url_embed_preview_enabled_for_realm(message):
+    if links_for_embed:
         event_data = {
             'message_id': message.id,
             'message_content': message.content,
@@ -1129,7 +1204,7 @@ def update_message_backend(request, user_profile,
             # `sender.realm_id` must match the decision made in the
             # `render_incoming_message` call earlier in this function.
             'message_realm_id': user_profile.realm_id,
-            'urls': links_for_embed}
+            'urls': list(links_for_embed)}
         queue_json_publish('embed_links', event_data, lambda x: None)
     return json_success()
 
@@ -1159,6 +1234,15 @@ def render_message_backend(request, user_profile, content=REQ()):
     message.sending_client = request.client
 
     rendered_content = render_markdown(message, content, realm=user_profile.realm)
+    # Rendering leaves Twitter and Dropbox previews that aren't cached
+    # yet to the embed_links worker, which nothing queues for a preview
+    # of a message we haven't sent; so we fetch them here, and render
+    # again.
+    urls = [url for url in message.links_for_preview
+            if bugdown.get_tweet_id(url) is not None or bugdown.is_dropbox_share_url(url)]
+    if urls:
+        bugdown.fetch_link_preview_data_many(urls)
+        rendered_content = render_markdown(message, content, realm=user_profile.realm)
     return json_success({"rendered": rendered_content})
 
 @has_request_variables
@@ -1181,6 +1265,11 @@ def messages_in_narrow_backend(request, user_profile,
         for term in narrow:
             query = builder.add_term(query, term)
 
+        search_operands = [term['operand'] for term in narrow if term['operator'] == 'search']
+        if search_operands:
+            query = add_search_match_columns(query, ' '.join(search_operands),
+                                             column("subject"), column("rendered_content"))
+
     sa_conn = get_sqlalchemy_connection()
     query_result = list(sa_conn.execute(query).fetchall())
 
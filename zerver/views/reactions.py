@@ -8,6 +8,7 @@ from zerver.decorator import authenticated_json_post_view,\
 from zerver.lib.actions import do_add_reaction, do_remove_reaction
 from zerver.lib.emoji import check_valid_emoji
 from zerver.lib.message import access_message
+from zerver.lib.recent_window import flush_recent_windows
 from zerver.lib.request import JsonableError
 from zerver.lib.response import json_success
 from zerver.models import Message, Reaction, UserMessage, UserProfile
@@ -22,6 +23,7 @@ def create_historical_message(user_profile, message):
     UserMessage.objects.create(user_profile=user_profile,
                                message=message,
                                flags=UserMessage.flags.historical | UserMessage.flags.read)
+    flush_recent_windows([user_profile.id])
 
 @has_request_variables
 def add_reaction_backend(request, user_profile, message_id, emoji_name):
@@ -377,6 +377,7 @@ def get_topics_backend(request, user_profile,
     result = get_topic_history_for_stream(
         user_profile=user_profile,
         recipient=recipient,
+        public_history=stream.is_public(),
     )
 
     return json_success(dict(topics=result))
@@ -27,7 +27,7 @@ from zerver.lib.actions import do_send_confirmation_email, \
     do_update_user_activity, do_update_user_activity_interval, do_update_user_presence, \
     internal_send_message, check_send_message, extract_recipients, \
     render_incoming_message, do_update_embedded_data
-from zerver.lib.url_preview import preview as url_preview
+from zerver.lib import bugdown
 from zerver.lib.digest import handle_digest_email
 from zerver.lib.send_email import send_future_email, send_email_from_dict, \
     FromAddress, EmailNotDeliveredException
@@ -428,12 +428,42 @@ class TestWorker(QueueProcessingWorker):
         with open(fn, 'a') as f:
             f.write(message + '\n')
 
-@assign_queue('embed_links')
+@assign_queue('embed_links', queue_type="loop")
 class FetchLinksEmbedData(QueueProcessingWorker):
+    # drain_queue acks the events it returns, so we take a few at a
+    # time; they're lost if the worker is restarted.
+    MAX_BATCH_SIZE = 100
+
+    def start(self):
+        # type: () -> None
+        while True:
+            if not self.process_one_batch():
+                time.sleep(1)
+
+    def process_one_batch(self):
+        # type: () -> int
+        events = self.q.drain_queue(self.queue_name, json=True,
+                                    max_messages=self.MAX_BATCH_SIZE)
+        self.consume_batch(events)
+        return len(events)
+
+    def consume_batch(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        # We fetch the previews for the whole batch concurrently, and
+        # each URL only once; consume then finds them in the cache.
+        try:
+            bugdown.fetch_link_preview_data_many(
+                url for event in events for url in event['urls'])
+        except Exception:
+            # consume fetches whatever is missing from the cache.
+            logging.exception("Problem fetching link previews for a batch of %d events" % (
+                len(events),))
+        for event in events:
+            self.consume_wrapper(event)
+
     def consume(self, event):
         # type: (Mapping[str, Any]) -> None
-        for url in event['urls']:
-            url_preview.get_link_embed_data(url)
+        bugdown.fetch_link_preview_data_many(event['urls'])
 
         message = Message.objects.get(id=event['message_id'])
         # If the message changed, we will run this task after updating the message
@@ -0,0 +1,81 @@
+import random
+import re
+import time
+
+from typing import Any, Dict, List, Set, Text
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+from zerver.lib.alert_words import AlertWordAutomaton
+
+def find_words_with_regexes(words, content):
+    # type: (Set[Text], Text) -> Set[Text]
+    # The previous implementation in AlertWordsNotificationProcessor.
+    allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
+    allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
+    found = set()  # type: Set[Text]
+    for word in words:
+        escaped = re.escape(word.lower())
+        match_re = re.compile(u'(?:%s)%s(?:%s)' %
+                              (allowed_before_punctuation,
+                               escaped,
+                               allowed_after_punctuation))
+        if re.search(match_re, content):
+            found.add(word)
+    return found
+
+class Command(BaseCommand):
+    help = """Compare finding alert words in messages with one regex per
+alert word against the per-realm AlertWordAutomaton.
+
+Usage: ./manage.py benchmark_alert_words --users=1000 --words-per-user=5"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--users', dest='users', type=int, default=1000)
+        parser.add_argument('--words-per-user', dest='words_per_user', type=int, default=5)
+        parser.add_argument('--messages', dest='messages', type=int, default=100)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        rng = random.Random(42)
+
+        def random_word():
+            # type: () -> Text
+            return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                           for i in range(rng.randint(4, 10)))
+
+        realm_alert_words = {
+            user_id: [random_word() for i in range(options['words_per_user'])]
+            for user_id in range(options['users'])
+        }  # type: Dict[int, List[Text]]
+        all_words = sorted({word for words in realm_alert_words.values() for word in words})
+        messages = [
+            ' '.join(rng.choice(all_words) if rng.random() < 0.02 else random_word()
+                     for i in range(100)).lower()
+            for j in range(options['messages'])
+        ]
+
+        start = time.time()
+        automaton = AlertWordAutomaton(realm_alert_words)
+        build_ms = (time.time() - start) * 1000
+
+        start = time.time()
+        for content in messages:
+            # The old code also rebuilt the word set on every message.
+            possible_words = set()  # type: Set[Text]
+            for words in realm_alert_words.values():
+                possible_words.update(words)
+            find_words_with_regexes(possible_words, content)
+        regex_ms = (time.time() - start) * 1000 / len(messages)
+
+        start = time.time()
+        for content in messages:
+            automaton.user_ids_for_words(automaton.find_words(content))
+        automaton_ms = (time.time() - start) * 1000 / len(messages)
+
+        self.stdout.write('%d users, %d distinct alert words' % (options['users'], len(all_words)))
+        self.stdout.write('Automaton build:         %8.1f ms (once per realm, cached)' % (build_ms,))
+        self.stdout.write('Regex per word:          %8.3f ms/message' % (regex_ms,))
+        self.stdout.write('Automaton:               %8.3f ms/message' % (automaton_ms,))
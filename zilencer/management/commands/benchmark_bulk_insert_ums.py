@@ -0,0 +1,74 @@
+import array
+import time
+
+from typing import Any, Callable, List
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from zerver.lib.actions import (
+    bulk_insert_ums_via_copy,
+    bulk_insert_ums_via_insert,
+    UserMessageBatch,
+)
+from zerver.models import Message, UserMessage, UserProfile
+
+class Command(BaseCommand):
+    help = """Compare the INSERT and COPY code paths of bulk_insert_ums.
+
+For each recipient count, we insert a fresh batch of UserMessage rows
+with each method inside a transaction that is then rolled back, so
+this is safe to run against a development database.
+
+Usage: ./manage.py benchmark_bulk_insert_ums --sizes=100,1000,10000,50000"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--sizes',
+                            dest='sizes',
+                            type=str,
+                            default='100,1000,10000,50000',
+                            help='Comma-separated list of recipient counts to try.')
+        parser.add_argument('--runs',
+                            dest='runs',
+                            type=int,
+                            default=3,
+                            help='Number of runs per size; we report the best one.')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        sizes = [int(size) for size in options['sizes'].split(',')]
+
+        # We use user and message ids that don't exist yet, so we
+        # can't collide with real rows.  Foreign key checks on these
+        # tables are deferred to commit, and we never commit.
+        first_user_id = (UserProfile.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+        message_id = (Message.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+
+        def time_insert(f, size):
+            # type: (Callable[[List[UserMessageBatch]], None], int) -> float
+            best = None
+            for run in range(options['runs']):
+                ums = [UserMessageBatch(
+                    message_id=message_id,
+                    user_ids=array.array('i', range(first_user_id, first_user_id + size)),
+                    flags=array.array('i', [0]) * size,
+                )]
+                with transaction.atomic():
+                    start = time.time()
+                    f(ums)
+                    duration = time.time() - start
+                    assert UserMessage.objects.filter(message_id=message_id).count() == size
+                    transaction.set_rollback(True)
+                if best is None or duration < best:
+                    best = duration
+            assert best is not None
+            return best * 1000
+
+        self.stdout.write('%10s %12s %12s' % ('recipients', 'INSERT ms', 'COPY ms'))
+        for size in sizes:
+            insert_ms = time_insert(bulk_insert_ums_via_insert, size)
+            copy_ms = time_insert(bulk_insert_ums_via_copy, size)
+            self.stdout.write('%10d %12.1f %12.1f' % (size, insert_ms, copy_ms))
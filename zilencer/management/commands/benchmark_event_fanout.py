@@ -0,0 +1,90 @@
+import time
+import tracemalloc
+
+from typing import Any, Callable, Dict, List
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+import ujson
+
+from zerver.tornado.event_encoding import SharedMessageDict, encode_events_response
+
+def make_message_dict(content_size):
+    # type: (int) -> Dict[str, Any]
+    return dict(
+        id=12345,
+        type='stream',
+        sender_id=10,
+        sender_email='hamlet@zulip.com',
+        sender_full_name='King Hamlet',
+        display_recipient='Denmark',
+        subject='fan-out',
+        content='<p>' + 'x' * content_size + '</p>',
+        content_type='text/html',
+        timestamp=1500000000,
+        reactions=[],
+    )
+
+class Command(BaseCommand):
+    help = """Measure the cost of delivering one message to many event
+queues, comparing plain message dicts (encoded once per queue) with
+SharedMessageDict payloads (encoded once per message).
+
+For each fan-out size, we build one `message` event per queue and
+then encode every queue's get_events response, reporting CPU time and
+the peak memory allocated while doing so.
+
+Usage: ./manage.py benchmark_event_fanout --sizes=100,1000,5000"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--sizes',
+                            dest='sizes',
+                            type=str,
+                            default='100,1000,5000,20000',
+                            help='Comma-separated list of fan-out sizes to try.')
+        parser.add_argument('--content-size',
+                            dest='content_size',
+                            type=int,
+                            default=2000,
+                            help='Size of the rendered message content, in bytes.')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        message_dict = make_message_dict(options['content_size'])
+
+        def encode_plain(size):
+            # type: (int) -> List[str]
+            return [
+                ujson.dumps(dict(result='success', msg='', queue_id='1:%d' % (i,), events=[
+                    dict(type='message', message=message_dict, flags=[], id=i)]))
+                for i in range(size)
+            ]
+
+        def encode_shared(size):
+            # type: (int) -> List[str]
+            shared_message_dict = SharedMessageDict(message_dict)
+            return [
+                encode_events_response(dict(result='success', msg='', queue_id='1:%d' % (i,), events=[
+                    dict(type='message', message=shared_message_dict, flags=[], id=i)]))
+                for i in range(size)
+            ]
+
+        def measure(f, size):
+            # type: (Callable[[int], List[str]], int) -> Dict[str, float]
+            tracemalloc.start()
+            start = time.time()
+            f(size)
+            duration = time.time() - start
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return dict(ms=duration * 1000, peak_kb=peak / 1024.0)
+
+        self.stdout.write('%10s %8s %12s %14s' % ('queues', 'payload', 'encode ms', 'peak KB'))
+        for size in sizes:
+            for name, f in [('plain', encode_plain), ('shared', encode_shared)]:
+                result = measure(f, size)
+                self.stdout.write('%10d %8s %12.1f %14.1f' % (
+                    size, name, result['ms'], result['peak_kb']))
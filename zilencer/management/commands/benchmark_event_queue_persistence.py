@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import time
+
+from typing import Any, Callable
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+import ujson
+
+from zerver.tornado import event_queue
+from zerver.tornado.event_queue import ClientDescriptor, EventQueue, \
+    add_to_client_dicts, dump_event_queues, hydrate_pending_clients, \
+    load_event_queues, load_legacy_event_queues, snapshot_event_queues
+
+def reset_event_queues():
+    # type: () -> None
+    event_queue.clients.clear()
+    event_queue.user_clients.clear()
+    event_queue.realm_clients_all_streams.clear()
+    event_queue.pending_clients.clear()
+    event_queue.pending_user_clients.clear()
+    event_queue.pending_realm_clients.clear()
+    event_queue.changed_queue_ids.clear()
+    event_queue.removed_queue_ids.clear()
+
+def make_client(i, events_per_queue):
+    # type: (int, int) -> ClientDescriptor
+    queue = EventQueue('1500000000:%d' % (i,))
+    for j in range(events_per_queue):
+        queue.push(dict(type='message', flags=['read'], message=dict(
+            id=j, sender_email='hamlet@zulip.com', subject='persistence',
+            content='<p>' + 'x' * 200 + '</p>', timestamp=1500000000)))
+    return ClientDescriptor(i // 3, 'user%d@zulip.com' % (i // 3,), 1, queue, None,
+                            'website', True, i % 10 == 0)
+
+class Command(BaseCommand):
+    help = """Measure how Tornado's event queue persistence scales with
+the number of queues: the old whole-file JSON format versus the
+line-oriented format, where startup only indexes the file and queues
+are rehydrated afterwards, and periodic snapshots append only changed
+queues.
+
+Usage: ./manage.py benchmark_event_queue_persistence --sizes=1000,10000"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--sizes',
+                            dest='sizes',
+                            type=str,
+                            default='1000,10000,50000',
+                            help='Comma-separated list of queue counts to try.')
+        parser.add_argument('--events-per-queue',
+                            dest='events_per_queue',
+                            type=int,
+                            default=5)
+        parser.add_argument('--changed-fraction',
+                            dest='changed_fraction',
+                            type=float,
+                            default=0.05,
+                            help='Fraction of queues changed between snapshots.')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        tmp_dir = tempfile.mkdtemp()
+        legacy_filename = os.path.join(tmp_dir, 'legacy.json')
+        filename = os.path.join(tmp_dir, 'event_queues.json')
+
+        def ms(f):
+            # type: (Callable[[], Any]) -> float
+            start = time.time()
+            f()
+            return (time.time() - start) * 1000
+
+        def legacy_dump():
+            # type: () -> None
+            with open(legacy_filename, 'w') as f:
+                ujson.dump([(qid, client.to_dict()) for (qid, client) in event_queue.clients.items()], f)
+
+        def legacy_load():
+            # type: () -> None
+            with open(legacy_filename) as f:
+                load_legacy_event_queues(f.read())
+
+        self.stdout.write('%8s | %10s %10s | %10s %12s %12s %12s' % (
+            'queues', 'old dump', 'old load', 'dump', 'start serve', 'rehydrate', 'snapshot'))
+        try:
+            for size in [int(size) for size in options['sizes'].split(',')]:
+                reset_event_queues()
+                for i in range(size):
+                    client = make_client(i, options['events_per_queue'])
+                    event_queue.clients[client.event_queue.id] = client
+                    add_to_client_dicts(client)
+
+                old_dump_ms = ms(legacy_dump)
+                dump_ms = ms(lambda: dump_event_queues(filename))
+                reset_event_queues()
+                old_load_ms = ms(legacy_load)
+
+                reset_event_queues()
+                serve_ms = ms(lambda: load_event_queues(filename))
+                hydrate_ms = ms(hydrate_pending_clients)
+
+                changed = list(event_queue.clients.values())[:int(size * options['changed_fraction'])]
+                for client in changed:
+                    client.add_event(dict(type='pointer', pointer=1))
+                snapshot_ms = ms(lambda: snapshot_event_queues(filename))
+
+                self.stdout.write('%8d | %10.1f %10.1f | %10.1f %12.1f %12.1f %12.1f' % (
+                    size, old_dump_ms, old_load_ms, dump_ms, serve_ms, hydrate_ms, snapshot_ms))
+        finally:
+            reset_event_queues()
+            shutil.rmtree(tmp_dir)
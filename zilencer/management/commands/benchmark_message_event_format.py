@@ -0,0 +1,97 @@
+import random
+import time
+
+from typing import Any, Callable
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+import ujson
+
+from zerver.tornado.event_queue import build_message_event_users, \
+    message_event_user_data
+
+def best_time_ms(f, runs):
+    # type: (Callable[[], Any], int) -> float
+    best = None
+    for run in range(runs):
+        start = time.time()
+        f()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    assert best is not None
+    return best * 1000
+
+class Command(BaseCommand):
+    help = """Compare the legacy per-user and the compact grouped wire
+formats for the `users` payload of `message` events sent to Tornado.
+
+For each recipient count, we report the JSON size, the time to build
+and serialize the payload in Django, and the time to deserialize and
+walk it in Tornado.  Roughly 1% of recipients get mentioned, and the
+given fractions have push notifications enabled.
+
+Usage: ./manage.py benchmark_message_event_format --sizes=100,1000,10000"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--sizes',
+                            dest='sizes',
+                            type=str,
+                            default='100,1000,10000,50000',
+                            help='Comma-separated list of recipient counts to try.')
+        parser.add_argument('--runs',
+                            dest='runs',
+                            type=int,
+                            default=5,
+                            help='Number of runs per size; we report the best one.')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        runs = options['runs']
+
+        self.stdout.write('%10s %8s %12s %12s %12s' % (
+            'recipients', 'format', 'bytes', 'encode ms', 'decode ms'))
+        for size in sizes:
+            active_user_ids = set(range(1, size + 1))
+            user_flags = {
+                user_id: ['mentioned']
+                for user_id in random.sample(sorted(active_user_ids), max(1, size // 100))
+            }
+            push_notify_user_ids = set(random.sample(sorted(active_user_ids), size // 10))
+            stream_push_user_ids = set(random.sample(sorted(active_user_ids), size // 20))
+
+            def encode_legacy():
+                # type: () -> str
+                users = [
+                    dict(
+                        id=user_id,
+                        flags=user_flags.get(user_id, []),
+                        always_push_notify=(user_id in push_notify_user_ids),
+                        stream_push_notify=(user_id in stream_push_user_ids),
+                    )
+                    for user_id in active_user_ids
+                ]
+                return ujson.dumps(users)
+
+            def encode_compact():
+                # type: () -> str
+                return ujson.dumps(build_message_event_users(
+                    active_user_ids=active_user_ids,
+                    user_flags=user_flags,
+                    push_notify_user_ids=push_notify_user_ids,
+                    stream_push_user_ids=stream_push_user_ids,
+                ))
+
+            for name, encode in [('legacy', encode_legacy), ('compact', encode_compact)]:
+                data = encode()
+
+                def decode():
+                    # type: () -> None
+                    for row in message_event_user_data(ujson.loads(data)):
+                        pass
+
+                self.stdout.write('%10d %8s %12d %12.2f %12.2f' % (
+                    size, name, len(data), best_time_ms(encode, runs), best_time_ms(decode, runs)))
@@ -0,0 +1,102 @@
+import random
+import time
+
+from typing import Any, Callable, Dict, List
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from zerver.lib.message import MessageDict, sew_messages_and_reactions
+from zerver.models import Message, Reaction, UserProfile
+
+def get_raw_db_rows_with_separate_queries(needed_ids):
+    # type: (List[int]) -> List[Dict[str, Any]]
+    # The previous implementation of MessageDict.get_raw_db_rows.
+    fields = [
+        'id',
+        'subject',
+        'pub_date',
+        'last_edit_time',
+        'edit_history',
+        'content',
+        'rendered_content',
+        'rendered_content_version',
+        'recipient_id',
+        'recipient__type',
+        'recipient__type_id',
+        'sender_id',
+        'sending_client__name',
+        'sender__realm_id',
+    ]
+    messages = Message.objects.filter(id__in=needed_ids).values(*fields)
+    reactions = Reaction.get_raw_db_rows(needed_ids)
+    return sew_messages_and_reactions(messages, reactions)
+
+class Command(BaseCommand):
+    help = """Compare fetching the rows for a cold-cache message list with
+separate Message and Reaction queries against the single query in
+MessageDict.get_raw_db_rows.
+
+We add reactions to the most recent messages inside a transaction that
+is then rolled back, so this is safe to run against a development
+database.
+
+Usage: ./manage.py benchmark_message_fetch --messages=1000 --runs=20"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--messages',
+                            dest='messages',
+                            type=int,
+                            default=1000,
+                            help='Number of recent messages to fetch.')
+        parser.add_argument('--reactions',
+                            dest='reactions',
+                            type=float,
+                            default=0.3,
+                            help='Fraction of messages to add a few reactions to.')
+        parser.add_argument('--runs',
+                            dest='runs',
+                            type=int,
+                            default=20)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        rng = random.Random(42)
+        message_ids = list(Message.objects.order_by('-id').values_list(
+            'id', flat=True)[:options['messages']])
+        user_profiles = list(UserProfile.objects.filter(is_bot=False, is_active=True)[:20])
+        emoji_names = ['smile', 'tada', 'octopus', 'heart', 'thumbs_up']
+
+        def time_fetch(f):
+            # type: (Callable[[List[int]], List[Dict[str, Any]]]) -> float
+            times = []  # type: List[float]
+            for run in range(options['runs']):
+                start = time.time()
+                rows = f(message_ids)
+                times.append(time.time() - start)
+                assert len(rows) == len(message_ids)
+            return sorted(times)[len(times) // 2] * 1000
+
+        with transaction.atomic():
+            reactions = []  # type: List[Reaction]
+            for message_id in message_ids:
+                if rng.random() >= options['reactions']:
+                    continue
+                for user_profile in rng.sample(user_profiles, min(len(user_profiles), 3)):
+                    reactions.append(Reaction(user_profile=user_profile,
+                                              message_id=message_id,
+                                              emoji_name=rng.choice(emoji_names),
+                                              emoji_code='1f600',
+                                              reaction_type=Reaction.UNICODE_EMOJI))
+            Reaction.objects.bulk_create(reactions)
+
+            separate_ms = time_fetch(get_raw_db_rows_with_separate_queries)
+            combined_ms = time_fetch(MessageDict.get_raw_db_rows)
+            transaction.set_rollback(True)
+
+        self.stdout.write('%d messages, %d reactions (median of %d runs):' % (
+            len(message_ids), len(reactions), options['runs']))
+        self.stdout.write('  Message and Reaction queries: %8.1f ms' % (separate_ms,))
+        self.stdout.write('  Single query:                 %8.1f ms' % (combined_ms,))
@@ -0,0 +1,188 @@
+import array
+import random
+import re
+import time
+
+from typing import Any, Dict, List, Optional, Text, Tuple
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils.timezone import now as timezone_now
+from sqlalchemy.sql import column, join, literal, literal_column, select, table
+from sqlalchemy.sql.expression import Select
+
+from zerver.lib.actions import bulk_insert_ums_via_copy, UserMessageBatch
+from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
+from zerver.models import Message, Recipient, Stream, UserMessage, UserProfile, \
+    get_client, get_realm, get_recipient
+from zerver.views.messages import LARGER_THAN_MAX_MESSAGE_ID, NarrowBuilder
+
+NARROWS = [
+    [],
+    [dict(operator='is', operand='private')],
+    [dict(operator='is', operand='starred')],
+    [dict(operator='is', operand='mentioned')],
+    [dict(operator='is', operand='unread')],
+    [dict(operator='is', operand='alerted')],
+]  # type: List[List[Dict[str, str]]]
+
+# The partial indexes on zerver_usermessage; see create_large_indexes.
+PARTIAL_INDEXES = [
+    'zerver_usermessage_starred_message_id',
+    'zerver_usermessage_mentioned_message_id',
+    'zerver_usermessage_unread_message_id',
+    'zerver_usermessage_has_alert_word_message_id',
+    'zerver_usermessage_wildcard_mentioned_message_id',
+    'zerver_usermessage_is_private_message_id',
+]
+
+PLAN_NODE_RE = re.compile(r'((?:Seq|Index|Index Only|Bitmap Index) Scan(?: Backward)?) (?:using|on) (\w+)')
+
+def narrow_query(user_profile, narrow, num_before):
+    # type: (UserProfile, List[Dict[str, str]], int) -> Select
+    # The before_query that get_messages_backend runs to load the
+    # most recent messages in a narrow.
+    query = select([column("message_id"), column("flags")],
+                   column("user_profile_id") == literal(user_profile.id),
+                   join(table("zerver_usermessage"), table("zerver_message"),
+                        literal_column("zerver_usermessage.message_id") ==
+                        literal_column("zerver_message.id")))
+    inner_msg_id_col = column("message_id")
+    builder = NarrowBuilder(user_profile, inner_msg_id_col)
+    for term in narrow:
+        query = builder.add_term(query, term)
+    return query.where(inner_msg_id_col <= LARGER_THAN_MAX_MESSAGE_ID) \
+                .order_by(inner_msg_id_col.desc()).limit(num_before)
+
+def percentile(times, p):
+    # type: (List[float], float) -> float
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * p))]
+
+class Command(BaseCommand):
+    help = """Time the queries behind the common `is:` narrows, with and
+without the partial indexes on zerver_usermessage.
+
+We generate the dataset, and drop the indexes, inside a transaction
+that is then rolled back, so this is safe to run against a development
+database.  For each narrow, we print the scans in the query plan and
+the p50/p99 latency in both cases.
+
+Usage: ./manage.py benchmark_narrow_queries --users=10 --messages=100000"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--users',
+                            dest='users',
+                            type=int,
+                            default=10,
+                            help='Number of users in the zulip realm to give messages to.')
+        parser.add_argument('--messages',
+                            dest='messages',
+                            type=int,
+                            default=100000,
+                            help='Number of messages to generate.')
+        parser.add_argument('--runs',
+                            dest='runs',
+                            type=int,
+                            default=100,
+                            help='Number of times to run each query.')
+        parser.add_argument('--num-before',
+                            dest='num_before',
+                            type=int,
+                            default=50)
+
+    def generate_messages(self, rng, user_profiles, num_messages):
+        # type: (random.Random, List[UserProfile], int) -> None
+        realm = user_profiles[0].realm
+        stream = Stream.objects.filter(realm=realm).order_by('id')[0]
+        stream_recipient = get_recipient(Recipient.STREAM, stream.id)
+        personal_recipient = get_recipient(Recipient.PERSONAL, user_profiles[0].id)
+        sending_client = get_client('benchmark_narrow_queries')
+
+        messages = [
+            Message(sender=user_profiles[-1],
+                    recipient=personal_recipient if rng.random() < 0.1 else stream_recipient,
+                    subject='benchmark',
+                    content='benchmark',
+                    pub_date=timezone_now(),
+                    sending_client=sending_client)
+            for i in range(num_messages)
+        ]
+        Message.objects.bulk_create(messages, batch_size=10000)
+
+        user_ids = array.array('i', sorted(user_profile.id for user_profile in user_profiles))
+        ums = []  # type: List[UserMessageBatch]
+        for message in messages:
+            base_flags = 0
+            if message.recipient_id == personal_recipient.id:
+                base_flags |= int(UserMessage.flags.is_private)
+            flags = array.array('i', [base_flags]) * len(user_ids)
+            for i in range(len(flags)):
+                if rng.random() < 0.9:
+                    flags[i] |= int(UserMessage.flags.read)
+                if rng.random() < 0.01:
+                    flags[i] |= int(UserMessage.flags.starred)
+                if rng.random() < 0.02:
+                    flags[i] |= int(UserMessage.flags.mentioned)
+                if rng.random() < 0.005:
+                    flags[i] |= int(UserMessage.flags.has_alert_word)
+            ums.append(UserMessageBatch(message_id=message.id, user_ids=user_ids, flags=flags))
+        bulk_insert_ums_via_copy(ums)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE zerver_message')
+            cursor.execute('ANALYZE zerver_usermessage')
+
+    def measure(self, user_profiles, narrow, runs, num_before):
+        # type: (List[UserProfile], List[Dict[str, str]], int, int) -> Tuple[Text, float, float]
+        sa_conn = get_sqlalchemy_connection()
+        plan = None  # type: Optional[Text]
+        times = []  # type: List[float]
+        for i in range(runs):
+            user_profile = user_profiles[i % len(user_profiles)]
+            query = narrow_query(user_profile, narrow, num_before)
+            if plan is None:
+                compiled = query.compile(dialect=sa_conn.dialect)
+                rows = sa_conn.execute('EXPLAIN ' + str(compiled), compiled.params).fetchall()
+                plan = ', '.join('%s %s' % m.groups()
+                                 for row in rows
+                                 for m in PLAN_NODE_RE.finditer(row[0]))
+            start = time.time()
+            sa_conn.execute(query).fetchall()
+            times.append((time.time() - start) * 1000)
+        assert plan is not None
+        return (plan, percentile(times, 0.5), percentile(times, 0.99))
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        rng = random.Random(42)
+        user_profiles = list(UserProfile.objects.filter(
+            realm=get_realm('zulip'), is_bot=False, is_active=True).order_by('id')[:options['users']])
+
+        with transaction.atomic():
+            self.generate_messages(rng, user_profiles, options['messages'])
+
+            for narrow in NARROWS:
+                name = ' '.join('%s:%s' % (term['operator'], term['operand'])
+                                for term in narrow) or '(home)'
+                results = []  # type: List[Tuple[Text, float, float]]
+                for drop_indexes in [True, False]:
+                    with transaction.atomic():
+                        if drop_indexes:
+                            with connection.cursor() as cursor:
+                                for index_name in PARTIAL_INDEXES:
+                                    cursor.execute('DROP INDEX IF EXISTS %s' % (index_name,))
+                        results.append(self.measure(user_profiles, narrow,
+                                                    options['runs'], options['num_before']))
+                        transaction.set_rollback(True)
+
+                self.stdout.write('%s:' % (name,))
+                for (label, (plan, p50, p99)) in zip(['without partial indexes', 'with partial indexes'],
+                                                     results):
+                    self.stdout.write('  %-24s p50 %8.2f ms  p99 %8.2f ms  %s' % (label + ':', p50, p99, plan))
+                if results[0][0] != results[1][0]:
+                    self.stdout.write('  (plan changed)')
+
+            transaction.set_rollback(True)
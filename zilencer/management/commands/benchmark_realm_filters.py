@@ -0,0 +1,116 @@
+import random
+import re
+import time
+
+from typing import Any, List, Text, Tuple
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+import markdown
+
+from zerver.lib import bugdown
+
+# realm_filters_keys for the engines we build; they don't clash with
+# realm ids or the special keys in bugdown.
+SEPARATE_KEY = -1001
+COMBINED_KEY = -1002
+
+class SeparateRealmFilterPattern(markdown.inlinepatterns.Pattern):
+    # The previous implementation: one inline pattern per filter.
+    def __init__(self, source_pattern, format_string):
+        # type: (Text, Text) -> None
+        self.format_string = format_string
+        markdown.inlinepatterns.Pattern.__init__(self, bugdown.prepare_realm_pattern(source_pattern))
+
+    def handleMatch(self, m):
+        # type: (Any) -> Any
+        return bugdown.url_to_a(self.format_string % m.groupdict(), m.group("name"))
+
+def subject_links_with_separate_regexes(realm_filters, subject):
+    # type: (List[Tuple[Text, Text, int]], Text) -> List[Text]
+    # The previous implementation of bugdown.subject_links.
+    matches = []  # type: List[Text]
+    for realm_filter in realm_filters:
+        pattern = bugdown.prepare_realm_pattern(realm_filter[0])
+        for m in re.finditer(pattern, subject):
+            matches += [realm_filter[1] % m.groupdict()]
+    return matches
+
+class Command(BaseCommand):
+    help = """Compare linkifying messages and topics with one regex per
+realm filter against the combined RealmFilterMatcher, for realms with
+1, 10 and 100 filters.
+
+Usage: ./manage.py benchmark_realm_filters --messages=200"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--messages', dest='messages', type=int, default=200)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        rng = random.Random(42)
+
+        def random_word():
+            # type: () -> Text
+            return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                           for i in range(rng.randint(2, 10)))
+
+        for num_filters in [1, 10, 100]:
+            realm_filters = [
+                (u'#P%d-(?P<id>[0-9]+)' % (i,), u'https://tracker.example.com/p%d/%%(id)s' % (i,), i)
+                for i in range(num_filters)
+            ]
+
+            def random_token():
+                # type: () -> Text
+                if rng.random() < 0.02:
+                    return u'#P%d-%d' % (rng.randrange(num_filters), rng.randint(1, 9999))
+                return random_word()
+
+            messages = [' '.join(random_token() for i in range(60))
+                        for j in range(options['messages'])]
+            topics = [' '.join(random_token() for i in range(5))
+                      for j in range(options['messages'])]
+
+            bugdown.make_realm_filters(COMBINED_KEY, realm_filters)
+            combined_engine = bugdown.md_engines[COMBINED_KEY]
+            bugdown.make_realm_filters(SEPARATE_KEY, [])
+            separate_engine = bugdown.md_engines[SEPARATE_KEY]
+            for (pattern, format_string, filter_id) in realm_filters:
+                separate_engine.inlinePatterns.add(
+                    'realm_filters/%s' % (pattern,),
+                    SeparateRealmFilterPattern(pattern, format_string), '>link')
+
+            def time_renders(engine):
+                # type: (markdown.Markdown) -> float
+                start = time.time()
+                for content in messages:
+                    bugdown.render_with_engine(engine, content, None, None)
+                return (time.time() - start) * 1000 / len(messages)
+
+            separate_render_ms = time_renders(separate_engine)
+            combined_render_ms = time_renders(combined_engine)
+
+            start = time.time()
+            for topic in topics:
+                subject_links_with_separate_regexes(realm_filters, topic)
+            separate_topic_ms = (time.time() - start) * 1000 / len(topics)
+
+            start = time.time()
+            for topic in topics:
+                # What bugdown.subject_links does, given the realm's filters.
+                bugdown.get_realm_filter_matcher(COMBINED_KEY, realm_filters).find_urls(topic)
+            combined_topic_ms = (time.time() - start) * 1000 / len(topics)
+
+            self.stdout.write('%d filters:' % (num_filters,))
+            self.stdout.write('  Message, regex per filter: %8.3f ms' % (separate_render_ms,))
+            self.stdout.write('  Message, combined:         %8.3f ms' % (combined_render_ms,))
+            self.stdout.write('  Topic, regex per filter:   %8.3f ms' % (separate_topic_ms,))
+            self.stdout.write('  Topic, combined:           %8.3f ms' % (combined_topic_ms,))
+
+        for key in [SEPARATE_KEY, COMBINED_KEY]:
+            del bugdown.md_engines[key]
+            del bugdown.realm_filter_data[key]
+            bugdown.realm_filter_matchers.pop(key, None)
@@ -0,0 +1,96 @@
+import time
+
+from typing import Any, Callable, List, Tuple
+
+from argparse import ArgumentParser
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from zerver.lib.actions import (
+    bulk_get_recipient_info,
+    get_recipient_info,
+    RecipientInfoTarget,
+)
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.stream_topic import StreamTopicTarget
+from zerver.models import Recipient, Stream, UserProfile, get_recipient
+
+def measure(f):
+    # type: (Callable[[], Any]) -> Tuple[int, float]
+    with CaptureQueriesContext(connection) as queries:
+        start = time.time()
+        f()
+        duration = time.time() - start
+    return (len(queries), duration * 1000)
+
+class Command(ZulipBaseCommand):
+    help = """Compare the query count and latency of resolving message
+recipients one message at a time versus with bulk_get_recipient_info.
+
+Messages in each batch are spread round-robin over the realm's
+largest streams, the way bot and email mirror traffic usually is.
+
+Usage: ./manage.py benchmark_recipient_info -r zulip --batch-sizes=1,10,100"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--batch-sizes',
+                            dest='batch_sizes',
+                            type=str,
+                            default='1,10,50,100,500',
+                            help='Comma-separated list of batch sizes to try.')
+        parser.add_argument('--num-streams',
+                            dest='num_streams',
+                            type=int,
+                            default=3,
+                            help='Number of distinct streams the batch is sent to.')
+        parser.add_argument('--num-topics',
+                            dest='num_topics',
+                            type=int,
+                            default=5,
+                            help='Number of distinct topics per stream.')
+        self.add_realm_args(parser, required=True)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm = self.get_realm(options)
+        assert realm is not None  # True because of required=True above
+
+        streams = list(Stream.objects.filter(realm=realm, deactivated=False))
+        if not streams:
+            raise CommandError("Realm %s has no streams." % (realm.string_id,))
+        recipients = sorted(
+            [get_recipient(Recipient.STREAM, stream.id) for stream in streams],
+            key=lambda recipient: -recipient.subscription_set.filter(active=True).count()
+        )[:options['num_streams']]
+        sender = UserProfile.objects.filter(realm=realm, is_active=True).first()
+
+        batch_sizes = [int(size) for size in options['batch_sizes'].split(',')]
+        num_topics = options['num_topics']
+
+        self.stdout.write('%10s %14s %14s %14s %14s' % (
+            'batch', 'single queries', 'single ms', 'bulk queries', 'bulk ms'))
+        for batch_size in batch_sizes:
+            targets = []  # type: List[RecipientInfoTarget]
+            for i in range(batch_size):
+                recipient = recipients[i % len(recipients)]
+                stream_topic = StreamTopicTarget(
+                    stream_id=recipient.type_id,
+                    topic_name='topic %d' % (i % num_topics,),
+                )
+                targets.append((recipient, sender.id, stream_topic))
+
+            def run_single():
+                # type: () -> None
+                for recipient, sender_id, stream_topic in targets:
+                    get_recipient_info(recipient, sender_id, stream_topic)
+
+            def run_bulk():
+                # type: () -> None
+                bulk_get_recipient_info(targets)
+
+            single_queries, single_ms = measure(run_single)
+            bulk_queries, bulk_ms = measure(run_bulk)
+            self.stdout.write('%10d %14d %14.1f %14d %14.1f' % (
+                batch_size, single_queries, single_ms, bulk_queries, bulk_ms))
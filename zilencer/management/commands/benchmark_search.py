@@ -0,0 +1,182 @@
+import array
+import random
+import time
+
+from typing import Any, List, Text, Tuple
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.utils.timezone import now as timezone_now
+from sqlalchemy.sql import alias, column, join, literal, literal_column, select, table
+from sqlalchemy.sql.expression import Select
+
+from zerver.lib.actions import bulk_insert_ums_via_copy, UserMessageBatch
+from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
+from zerver.models import Message, Recipient, Stream, UserProfile, \
+    get_client, get_realm, get_recipient
+from zerver.views.messages import LARGER_THAN_MAX_MESSAGE_ID, NarrowBuilder, \
+    add_search_match_columns, get_search_fields
+
+SEARCH_WORD = 'benchmark'
+
+def search_query(user_profile, num_before, lazy):
+    # type: (UserProfile, int, bool) -> Select
+    # The query get_messages_backend runs to load the most recent
+    # search results; with lazy=False, the match locations are
+    # computed in the narrow's query, as they were before.
+    query = select([column("message_id"), column("flags")],
+                   column("user_profile_id") == literal(user_profile.id),
+                   join(table("zerver_usermessage"), table("zerver_message"),
+                        literal_column("zerver_usermessage.message_id") ==
+                        literal_column("zerver_message.id")))
+    if not lazy:
+        query = query.column(column("subject")).column(column("rendered_content"))
+        query = add_search_match_columns(query, SEARCH_WORD,
+                                         column("subject"), column("rendered_content"))
+    inner_msg_id_col = column("message_id")
+    builder = NarrowBuilder(user_profile, inner_msg_id_col)
+    query = builder.add_term(query, dict(operator='search', operand=SEARCH_WORD))
+    query = query.where(inner_msg_id_col <= LARGER_THAN_MAX_MESSAGE_ID) \
+                 .order_by(inner_msg_id_col.desc()).limit(num_before)
+
+    main_query = alias(query)
+    if not lazy:
+        return select(main_query.c, None, main_query).order_by(column("message_id").asc())
+    subject_col = literal_column("zerver_message.subject")
+    rendered_content_col = literal_column("zerver_message.rendered_content")
+    query = select([main_query.c.message_id, main_query.c.flags,
+                    subject_col, rendered_content_col],
+                   None,
+                   join(main_query, table("zerver_message"),
+                        literal_column("zerver_message.id") == main_query.c.message_id))
+    query = add_search_match_columns(query, SEARCH_WORD, subject_col, rendered_content_col)
+    return query.order_by(column("message_id").asc())
+
+class Command(BaseCommand):
+    help = """Time full-text searches that match many messages, computing
+the match locations for every matching message (as we used to) and
+for just the messages returned, with the tsearch and (if installed)
+PGroonga backends.
+
+We generate the messages inside a transaction that is then rolled
+back, so this is safe to run against a development database.
+
+Usage: ./manage.py benchmark_search --messages=100000 --num-before=1000"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--messages',
+                            dest='messages',
+                            type=int,
+                            default=100000,
+                            help='Number of matching messages to generate.')
+        parser.add_argument('--runs',
+                            dest='runs',
+                            type=int,
+                            default=20)
+        parser.add_argument('--num-before',
+                            dest='num_before',
+                            type=int,
+                            default=1000)
+
+    def generate_messages(self, rng, user_profile, num_messages):
+        # type: (random.Random, UserProfile, int) -> None
+        stream = Stream.objects.filter(realm=user_profile.realm).order_by('id')[0]
+        recipient = get_recipient(Recipient.STREAM, stream.id)
+        sending_client = get_client('benchmark_search')
+        words = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'theta', 'kappa']
+
+        messages = []  # type: List[Message]
+        for i in range(num_messages):
+            content = ' '.join(rng.choice(words) for j in range(rng.randint(10, 100)))
+            position = rng.randint(0, len(content))
+            content = content[:position] + ' %s ' % (SEARCH_WORD,) + content[position:]
+            messages.append(Message(sender=user_profile,
+                                    recipient=recipient,
+                                    subject='%s %d' % (rng.choice(words), i % 100),
+                                    content=content,
+                                    rendered_content='<p>%s</p>' % (content,),
+                                    pub_date=timezone_now(),
+                                    sending_client=sending_client))
+        Message.objects.bulk_create(messages, batch_size=10000)
+
+        user_ids = array.array('i', [user_profile.id])
+        bulk_insert_ums_via_copy([
+            UserMessageBatch(message_id=message.id, user_ids=user_ids,
+                             flags=array.array('i', [0]))
+            for message in messages
+        ])
+
+        # In production, process_fts_updates updates these columns
+        # asynchronously.
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                UPDATE zerver_message SET
+                search_tsvector = to_tsvector('zulip.english_us_search', subject || rendered_content)
+                WHERE id >= %s
+            ''', [messages[0].id])
+            if self.have_pgroonga():
+                cursor.execute('''
+                    UPDATE zerver_message SET
+                    search_pgroonga = subject || ' ' || rendered_content
+                    WHERE id >= %s
+                ''', [messages[0].id])
+            cursor.execute('ANALYZE zerver_message')
+            cursor.execute('ANALYZE zerver_usermessage')
+
+    def have_pgroonga(self):
+        # type: () -> bool
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'zerver_message' AND column_name = 'search_pgroonga'
+            ''')
+            return cursor.fetchone() is not None
+
+    def measure(self, user_profile, num_before, runs, lazy):
+        # type: (UserProfile, int, int, bool) -> Tuple[float, float]
+        sa_conn = get_sqlalchemy_connection()
+        query_times = []  # type: List[float]
+        highlight_times = []  # type: List[float]
+        for i in range(runs):
+            start = time.time()
+            rows = sa_conn.execute(search_query(user_profile, num_before, lazy)).fetchall()
+            query_times.append(time.time() - start)
+
+            start = time.time()
+            for (message_id, flags, subject, rendered_content,
+                 content_matches, subject_matches) in rows:
+                get_search_fields(rendered_content, subject, content_matches, subject_matches)
+            highlight_times.append(time.time() - start)
+        return (sorted(query_times)[runs // 2] * 1000,
+                sorted(highlight_times)[runs // 2] * 1000)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        rng = random.Random(42)
+        user_profile = UserProfile.objects.filter(
+            realm=get_realm('zulip'), is_bot=False, is_active=True).order_by('id')[0]
+
+        backends = [('tsearch', False)]  # type: List[Tuple[Text, bool]]
+        if self.have_pgroonga():
+            backends.append(('pgroonga', True))
+        else:
+            self.stdout.write('zerver_message.search_pgroonga does not exist; skipping PGroonga.')
+
+        with transaction.atomic():
+            self.generate_messages(rng, user_profile, options['messages'])
+
+            for (backend, using_pgroonga) in backends:
+                with override_settings(USING_PGROONGA=using_pgroonga):
+                    self.stdout.write('%s, %d matches, returning %d (median of %d runs):' % (
+                        backend, options['messages'], options['num_before'], options['runs']))
+                    for (label, lazy) in [('Locations for all matches:', False),
+                                          ('Locations for returned messages:', True)]:
+                        (query_ms, highlight_ms) = self.measure(
+                            user_profile, options['num_before'], options['runs'], lazy)
+                        self.stdout.write('  %-33s query %8.1f ms  highlighting %8.1f ms' % (
+                            label, query_ms, highlight_ms))
+
+            transaction.set_rollback(True)
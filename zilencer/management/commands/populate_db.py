@@ -377,7 +377,7 @@ class Command(BaseCommand):
             create_users(zulip_realm, zulip_cross_realm_bots, bot_type=UserProfile.DEFAULT_BOT)
 
             # Mark all messages as read
-            UserMessage.objects.all().update(flags=UserMessage.flags.read)
+            UserMessage.objects.all().update(flags=F('flags').bitor(UserMessage.flags.read))
 
             if not options["test_suite"]:
                 # Update pointer of each user to point to the last message in their
@@ -340,6 +340,47 @@ DEFAULT_SETTINGS.update({
     # Configuration option for our email/Zulip error reporting.
     'STAGING_ERROR_NOTIFICATIONS': False,
 
+    # Number of Tornado processes to run.  Realms are partitioned
+    # between them; process N listens on the TORNADO_SERVER port plus
+    # N, and the frontend proxy must route each realm's event traffic
+    # accordingly.  See zerver/tornado/sharding.py.
+    'TORNADO_PROCESSES': 1,
+
+    # How often Tornado writes the event queues that have changed to
+    # disk, bounding how much queue state a crash can lose.  With 0,
+    # queues are only saved on shutdown.
+    'EVENT_QUEUE_SNAPSHOT_SECS': 30,
+
+    # Limits on the number of events, and the bytes of message content,
+    # that an event queue whose client has stopped fetching events can
+    # accumulate before Tornado replaces its contents with a restart
+    # event.  See EventQueue.compact.
+    'EVENT_QUEUE_MAX_EVENTS': 5000,
+    'EVENT_QUEUE_MAX_BYTES': 10 * 1024 * 1024,
+
+    # Messages with at least this many UserMessage rows (i.e. messages
+    # to large streams) are inserted with COPY rather than one big
+    # INSERT statement; see bulk_insert_ums.
+    'USERMESSAGE_COPY_THRESHOLD': 5000,
+
+    # The number of worker processes to render markdown in; see
+    # zerver/lib/bugdown_pool.py.  Only queue workers and management
+    # commands use the pool: uwsgi's processes, which render messages
+    # sent through the web app and the API, always render in-process,
+    # as with 0, where a rendering timeout can't always stop a runaway
+    # regex.
+    'BUGDOWN_WORKER_PROCESSES': 0,
+
+    # The number of threads the embed_links worker fetches link
+    # previews in; see bugdown.fetch_link_preview_data_many.
+    'EMBED_LINKS_FETCH_THREADS': 8,
+
+    # The number of each user's most recent messages whose ids and
+    # flags we cache, to answer home view fetches without querying
+    # zerver_usermessage; see zerver/lib/recent_window.py.  0 disables
+    # the cache.
+    'RECENT_WINDOW_SIZE': 1000,
+
     # How long to wait before presence should treat a user as offline.
     # TODO: Figure out why this is different from the corresponding
     # value in static/js/presence.js.  Also, probably move it out of